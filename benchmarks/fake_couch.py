@@ -0,0 +1,523 @@
+"""
+In-process stand-in for the parts of CouchDB (and the nEDM attachment
+endpoint) used by pynedm, so that benchmarks run without a server or network.
+
+Implemented:
+
+- GET / and POST /_session
+- GET <db>, GET/PUT/DELETE <db>/<docid>
+- <db>/_design/nedm_default/_update/insert_with_timestamp[/<docid>]
+- POST <db>/_bulk_docs (also gzip compressed bodies)
+- <db>/_changes: normal and continuous feeds with heartbeats, since,
+  include_docs, the execute_commands/execute_commands and _doc_ids filters
+  and Mango selectors ($exists, $in, $eq)
+- <db>/_design/execute_commands/_view/export_commands (grouped and
+  reduce=false with keys)
+- <db>/_design/pynedm_export/_view/by_variable (see pynedm.export)
+- /_attachments/<db>/<docid>/<name>: GET/HEAD with Range, PUT, DELETE
+
+Failures can be injected with :meth:`FakeCouch.fail_next`.
+
+Everything is kept in memory.  It is not a conforming CouchDB: revisions are
+counters and conflicts are not detected except for DELETE.
+"""
+import bisect
+import collections
+import datetime
+import json
+import re
+import socket
+import sys
+import threading
+import time
+import zlib
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+
+__all__ = [ "FakeCouch" ]
+
+_range_re = re.compile(r"bytes[= ](\d*)-(\d*)")
+
+def _timestamp():
+    now = datetime.datetime.utcnow()
+    return now.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (now.microsecond // 1000)
+
+def _decode(v):
+    try:
+        return json.loads(v)
+    except ValueError:
+        return v
+
+def _is_true(v):
+    return v is True or str(v).lower() == "true"
+
+def _mango(doc, selector):
+    """
+    Evaluate the subset of Mango selectors used by pynedm
+    """
+    for field, cond in selector.items():
+        present = field in doc
+        v = doc.get(field)
+        if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+            for op, arg in cond.items():
+                if op == "$exists" and present != bool(arg): return False
+                if op == "$in" and (not present or v not in arg): return False
+                if op == "$eq" and (not present or v != arg): return False
+        elif not present or v != cond:
+            return False
+    return True
+
+class _Database(object):
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.attachments = {}
+        self.seq = 0
+        # docid -> seq of its last change, ordered by seq
+        self.changes = collections.OrderedDict()
+        self.cond = threading.Condition()
+
+    def save(self, doc):
+        """
+        Store doc (the caller holds cond), returns the new revision
+        """
+        docid = doc["_id"]
+        old = self.docs.get(docid)
+        n = int(old["_rev"].split("-")[0]) + 1 if old else 1
+        doc["_rev"] = "{}-{:032x}".format(n, self.seq + 1)
+        self.docs[docid] = doc
+        self._changed(docid)
+        return doc["_rev"]
+
+    def delete(self, docid):
+        self.docs.pop(docid, None)
+        self._changed(docid)
+
+    def _changed(self, docid):
+        self.seq += 1
+        self.changes.pop(docid, None)
+        self.changes[docid] = self.seq
+        self.cond.notify_all()
+
+    def changes_since(self, since, match, include_docs):
+        out = []
+        for docid in reversed(self.changes):
+            seq = self.changes[docid]
+            if seq <= since: break
+            doc = self.docs.get(docid)
+            if doc is None:
+                out.append(dict(seq=seq, id=docid, deleted=True, changes=[]))
+                continue
+            if not match(doc): continue
+            line = dict(seq=seq, id=docid, changes=[dict(rev=doc["_rev"])])
+            if include_docs: line["doc"] = dict(doc)
+            out.append(line)
+        out.reverse()
+        return out
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, with Nagle's algorithm
+    # each response would wait for the delayed ACK of the client (~40 ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    # Request parsing
+
+    def _parse(self):
+        u = urlparse(self.path)
+        self.segments = [unquote(s) for s in u.path.split("/") if s]
+        self.query = {}
+        for k, vs in parse_qs(u.query, keep_blank_values=True).items():
+            self.query[k] = _decode(vs[0]) if len(vs) == 1 else [_decode(v) for v in vs]
+
+    def _body(self):
+        n = int(self.headers.get("content-length") or 0)
+        data = self.rfile.read(n) if n else b""
+        if self.headers.get("content-encoding") == "gzip":
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return data
+
+    def _json_body(self):
+        data = self._body()
+        if not data: return None
+        try:
+            return json.loads(data.decode("utf-8"))
+        except ValueError:
+            return None
+
+    # Responses
+
+    def _send(self, status, body=b"", headers=None, ctype="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items(): self.send_header(k, v)
+        self.end_headers()
+        if self.command != "HEAD": self.wfile.write(body)
+
+    def _send_json(self, status, obj, headers=None):
+        self._send(status, json.dumps(obj).encode("utf-8"), headers)
+
+    def _not_found(self):
+        self._send_json(404, dict(error="not_found", reason="missing"))
+
+    def _chunk(self, data):
+        self.wfile.write(("%x\r\n" % len(data)).encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    # Dispatch
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_HEAD(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def do_PUT(self):
+        # The HTTP server of python 2 does not answer "Expect: 100-continue",
+        # libcurl would wait 1 s before sending the body
+        if self.headers.get("expect", "").lower() == "100-continue" and \
+           not hasattr(self, "handle_expect_100"):
+            self.wfile.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        self._dispatch()
+
+    def do_DELETE(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        self._parse()
+        status = self.server.couch._failure(self.command, self.path)
+        if status is not None:
+            self._body()
+            return self._send_json(status, dict(error="injected", reason="fail_next"))
+        seg = self.segments
+        if not seg:
+            return self._send_json(200, dict(couchdb="Welcome", version="fake"))
+        if seg[0] == "_session":
+            self._body()
+            return self._send_json(200, dict(ok=True, name=None, roles=[]),
+                                   { "Set-Cookie" : "AuthSession=fake; Path=/" })
+        if seg[0] == "_attachments" and len(seg) >= 4:
+            return self._attachment(self.server.couch.db(seg[1]), seg[2], "/".join(seg[3:]))
+        db = self.server.couch.db(seg[0])
+        rest = seg[1:]
+        if rest[:1] == ["_design"] and len(rest) >= 2:
+            rest = ["_design/" + rest[1]] + rest[2:]
+        if not rest:
+            with db.cond:
+                return self._send_json(200, dict(db_name=db.name, update_seq=db.seq,
+                                                 doc_count=len(db.docs)))
+        if rest[0] == "_changes":
+            return self._changes(db)
+        if rest[0] == "_bulk_docs":
+            return self._bulk_docs(db)
+        if rest[0] == "_design/nedm_default" and rest[1:2] == ["_update"]:
+            return self._update(db, rest[3] if len(rest) > 3 else None)
+        if rest[0] == "_design/execute_commands" and rest[1:3] == ["_view", "export_commands"]:
+            return self._export_commands(db)
+        if rest[0] == "_design/pynedm_export" and rest[1:3] == ["_view", "by_variable"]:
+            return self._by_variable(db)
+        return self._document(db, "/".join(rest))
+
+    # Endpoints
+
+    def _document(self, db, docid):
+        body = self._json_body()
+        with db.cond:
+            doc = db.docs.get(docid)
+            if self.command == "PUT":
+                if doc is not None and (body or {}).get("_rev") != doc["_rev"]:
+                    return self._send_json(409, dict(error="conflict"))
+                body = dict(body or {}, _id=docid)
+                return self._send_json(201, dict(ok=True, id=docid, rev=db.save(body)))
+            if doc is None: return self._not_found()
+            if self.command == "DELETE":
+                if self.query.get("rev") not in (None, doc["_rev"]):
+                    return self._send_json(409, dict(error="conflict"))
+                db.delete(docid)
+                return self._send_json(200, dict(ok=True, id=docid))
+            return self._send_json(200, doc)
+
+    def _update(self, db, docid):
+        """
+        nedm_default/_update/insert_with_timestamp: fields are taken from the
+        JSON body, an existing document is updated
+        """
+        fields = self._json_body()
+        if not isinstance(fields, dict):
+            return self._send_json(400, dict(error="bad_request", reason="Document must be a JSON object"))
+        with db.cond:
+            if docid is None:
+                docid = fields.get("_id") or "{:032x}".format(db.seq + 1)
+            doc = dict(db.docs.get(docid, {}))
+            doc.update(fields)
+            doc["_id"] = docid
+            if "timestamp" not in doc: doc["timestamp"] = _timestamp()
+            rev = db.save(doc)
+        self._send_json(201, dict(ok=True, id=docid, rev=rev))
+
+    def _bulk_docs(self, db):
+        body = self._json_body() or {}
+        out = []
+        with db.cond:
+            for d in body.get("docs", []):
+                d = dict(d)
+                if "_id" not in d: d["_id"] = "{:032x}".format(db.seq + 1)
+                old = db.docs.get(d["_id"])
+                if old is not None and d.get("_rev") != old["_rev"]:
+                    out.append(dict(id=d["_id"], error="conflict", reason="Document update conflict."))
+                    continue
+                out.append(dict(ok=True, id=d["_id"], rev=db.save(d)))
+        self._send_json(201, out)
+
+    def _export_commands(self, db):
+        """
+        View emitting the command keys of export_commands documents, reduced
+        by count
+        """
+        body = self._json_body() or {}
+        with db.cond:
+            rows = [ dict(id=d["_id"], key=k, value=1) for d in db.docs.values()
+                     if d.get("type") == "export_commands" for k in d.get("keys", {}) ]
+        if "keys" in body:
+            rows = [ r for r in rows if r["key"] in body["keys"] ]
+        if self.query.get("reduce") is False or str(self.query.get("reduce")).lower() == "false":
+            return self._send_json(200, dict(total_rows=len(rows), offset=0,
+                                             rows=sorted(rows, key=lambda r: r["key"])))
+        counts = collections.Counter(r["key"] for r in rows)
+        self._send_json(200, dict(rows=[ dict(key=k, value=counts[k]) for k in sorted(counts) ]))
+
+    def _by_variable(self, db):
+        """
+        View of pynedm.export: [variable, timestamp] -> numeric value of
+        data documents, reduced by count
+        """
+        self._body()
+        q = self.query
+        with db.cond:
+            seq, rows = getattr(db, "by_variable", (None, None))
+            if seq != db.seq:
+                rows = sorted(([k, d["timestamp"]], d["_id"], v) for d in db.docs.values()
+                              if d.get("type") == "data" and isinstance(d.get("value"), dict)
+                              and "timestamp" in d for k, v in d["value"].items()
+                              if isinstance(v, (int, float)))
+                db.by_variable = (db.seq, rows)
+        lo = bisect.bisect_left(rows, (q["startkey"],)) if "startkey" in q else 0
+        if "endkey" not in q:
+            hi = len(rows)
+        elif q.get("inclusive_end") is False:
+            hi = bisect.bisect_left(rows, (q["endkey"],))
+        else:
+            hi = bisect.bisect_right(rows, (q["endkey"], u"\uffff"))
+        if q.get("reduce") is not False:
+            return self._send_json(200, dict(rows=[dict(key=None, value=hi - lo)] if hi > lo else []))
+        self._send_json(200, dict(total_rows=len(rows), offset=lo,
+          rows=[ dict(id=i, key=k, value=v) for k, i, v in rows[lo:hi] ]))
+
+    def _matcher(self, body):
+        q = self.query
+        if q.get("filter") == "execute_commands/execute_commands":
+            keys = q.get("only_commands", [])
+            if not isinstance(keys, list): keys = [keys]
+            return lambda d: d.get("type") == "command" and d.get("execute") in keys \
+                             and "response" not in d
+        if q.get("filter") == "_doc_ids":
+            ids = set(q.get("doc_ids") or (body or {}).get("doc_ids") or [])
+            return lambda d: d["_id"] in ids
+        if q.get("filter") == "_selector":
+            selector = (body or {}).get("selector", {})
+            return lambda d: _mango(d, selector)
+        return lambda d: True
+
+    def _changes(self, db):
+        q = self.query
+        match = self._matcher(self._json_body())
+        include_docs = _is_true(q.get("include_docs"))
+        with db.cond:
+            since = db.seq if q.get("since") == "now" else int(q.get("since") or 0)
+        if q.get("feed") != "continuous":
+            with db.cond:
+                results = db.changes_since(since, match, include_docs)
+                last = db.seq
+            return self._send_json(200, dict(results=results, last_seq=last))
+
+        heartbeat = float(q.get("heartbeat") or 60000) / 1000.
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.close_connection = True
+        couch = self.server.couch
+        last = time.time()
+        try:
+            while not couch.stopping:
+                with db.cond:
+                    # Woken by changes or by the ticker of FakeCouch, timed
+                    # waits of python 2 poll and would delay changes
+                    if db.seq <= since: db.cond.wait()
+                    if couch.stopping: break
+                    lines = db.changes_since(since, match, include_docs)
+                    since = db.seq
+                if lines:
+                    self._chunk(b"".join(json.dumps(l).encode("utf-8") + b"\n" for l in lines))
+                    last = time.time()
+                elif time.time() - last >= heartbeat:
+                    self._chunk(b"\n")
+                    last = time.time()
+            self.wfile.write(b"0\r\n\r\n")
+        except Exception:
+            # Client went away
+            pass
+
+    def _attachment(self, db, docid, name):
+        key = (docid, name)
+        if self.command == "PUT":
+            data = self._body()
+            # Attachments are only written as a whole
+            if self.headers.get("content-range"):
+                return self._send_json(400, dict(error="bad_request",
+                                                 reason="Content-Range not supported"))
+            with db.cond:
+                version = db.attachments.get(key, (b"", 0))[1] + 1
+                db.attachments[key] = (data, version)
+                rev = None
+                if docid in db.docs:
+                    rev = db.save(dict(db.docs[docid]))
+            return self._send_json(201, dict(ok=True, id=docid, rev=rev))
+        if self.command == "DELETE":
+            with db.cond:
+                if db.attachments.pop(key, None) is None: return self._not_found()
+            return self._send_json(200, dict(ok=True, id=docid))
+        with db.cond:
+            data, version = db.attachments.get(key, (None, 0))
+        if data is None: return self._not_found()
+        headers = { "Accept-Ranges" : "bytes", "ETag" : '"{}"'.format(version) }
+        ctype = "application/octet-stream"
+        m = _range_re.match(self.headers.get("range", ""))
+        if m is None or self.command == "HEAD":
+            if self.command == "HEAD":
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in headers.items(): self.send_header(k, v)
+                self.end_headers()
+                return
+            return self._send(200, data, headers, ctype)
+        start = int(m.group(1) or 0)
+        end = min(int(m.group(2)) + 1 if m.group(2) else len(data), len(data))
+        if start >= len(data):
+            return self._send(416, b"", { "Content-Range" : "bytes */{}".format(len(data)) })
+        headers["Content-Range"] = "bytes {}-{}/{}".format(start, end - 1, len(data))
+        self._send(206, data[start:end], headers, ctype)
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # Daemon threads may still run while the interpreter exits
+        if sys is None: return
+        # Clients closing feeds or keep-alive connections are expected
+        if not isinstance(sys.exc_info()[1], (IOError, socket.error)):
+            HTTPServer.handle_error(self, request, client_address)
+
+class FakeCouch(object):
+    """
+    In-memory CouchDB stand-in serving HTTP from a background thread::
+
+          with FakeCouch() as couch:
+              po = pynedm.ProcessObject(uri=couch.uri, adb="bench")
+
+    Databases are created on first use.
+
+    :param address: listening address
+    :param port: TCP port, 0 picks a free one
+    """
+    def __init__(self, address="127.0.0.1", port=0):
+        self._lock = threading.Lock()
+        self._dbs = {}
+        self.stopping = False
+        self.server = _Server((address, port), _Handler)
+        self.server.couch = self
+        self.uri = "http://{}:{}".format(*self.server.server_address[:2])
+        # Interval (s) at which continuous feeds check for heartbeats
+        self.tick = 0.5
+        self._stopped = threading.Event()
+        self._failures = []
+        self._threads = []
+
+    def fail_next(self, status, count=1, method=None, path=""):
+        """
+        Answer the next count requests with an error
+
+        :param status: HTTP status of the error response
+        :param method: only fail requests with this method (e.g. "PUT")
+        :param path: only fail requests whose path contains this string
+        """
+        with self._lock:
+            self._failures.append([status, count, method, path])
+
+    def _failure(self, method, path):
+        with self._lock:
+            for f in self._failures:
+                if (f[2] is None or f[2] == method) and f[3] in path:
+                    f[1] -= 1
+                    if f[1] <= 0: self._failures.remove(f)
+                    return f[0]
+        return None
+
+    def db(self, name):
+        with self._lock:
+            if name not in self._dbs:
+                self._dbs[name] = _Database(name)
+            return self._dbs[name]
+
+    def _tick(self):
+        while not self._stopped.wait(self.tick):
+            self._notify()
+
+    def _notify(self):
+        with self._lock:
+            dbs = list(self._dbs.values())
+        for db in dbs:
+            with db.cond: db.cond.notify_all()
+
+    def start(self):
+        for target in (self.server.serve_forever, self._tick):
+            th = threading.Thread(target=target)
+            th.daemon = True
+            th.start()
+            self._threads.append(th)
+        return self
+
+    def stop(self):
+        """
+        Stop serving, open continuous feeds are closed
+        """
+        self.stopping = True
+        self._stopped.set()
+        self._notify()
+        self.server.shutdown()
+        self.server.server_close()
+        for th in self._threads: th.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
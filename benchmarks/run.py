@@ -0,0 +1,313 @@
+"""
+Benchmarks of pynedm against an in-process CouchDB stand-in
+(:mod:`fake_couch`), no server or network needed::
+
+    python benchmarks/run.py                  # full run, saves results
+    python benchmarks/run.py --quick          # smaller sizes
+    python benchmarks/run.py --only write,command
+    python benchmarks/run.py --compare 1a2b3c4
+
+Results are saved to benchmarks/results/<commit>.json (with a -dirty suffix
+for uncommitted changes), --compare prints the relative change against a
+previous result file (path or commit).  The pynedm of this checkout is
+benchmarked, not an installed one.
+
+Metrics ending in _ms or _us are latencies (lower is better), the others
+rates (higher is better).  Absolute numbers include the cost of the
+stand-in server running in the same process and are only comparable between
+runs on the same machine.
+"""
+from __future__ import print_function
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+_here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(_here))
+sys.path.insert(0, _here)
+
+from fake_couch import FakeCouch
+
+_clock = getattr(time, "perf_counter", time.time)
+_db = "bench"
+_mb = 1024. * 1024
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def _process_object(couch):
+    import pynedm
+    return pynedm.ProcessObject(uri=couch.uri, adb=_db)
+
+def bench_write(couch, size):
+    """
+    write_document_to_db, direct and batched
+    """
+    n = size["docs"]
+    po = _process_object(couch)
+    start = _clock()
+    for i in range(n):
+        po.write_document_to_db({ "type" : "data", "value" : { "x" : i, "y" : 0.5 * i } })
+    direct = n / (_clock() - start)
+
+    po.enable_batch_writes()
+    start = _clock()
+    for i in range(n):
+        po.write_document_to_db({ "type" : "data", "value" : { "x" : i, "y" : 0.5 * i } })
+    po.close()
+    batched = n / (_clock() - start)
+    return dict(write_direct_docs_per_s=direct, write_batched_docs_per_s=batched)
+
+def _listen(couch, funcs, feed_mode="filter"):
+    # pynedm.listen is shadowed by the pynedm.listen module once imported
+    from pynedm.utils import listen
+    return listen(funcs, _db, uri=couch.uri, feed_mode=feed_mode)
+
+def _stop(po):
+    po.stop_listening()
+    po.wait()
+
+def bench_command(couch, size):
+    """
+    Round trip of send_command to a listener in the same process
+    """
+    listener = _listen(couch, { "bench_echo" : lambda x: x })
+    try:
+        po = _process_object(couch)
+        po.send_command("bench_echo", 0)
+        times = []
+        for i in range(size["commands"]):
+            start = _clock()
+            po.send_command("bench_echo", i)
+            times.append(_clock() - start)
+    finally:
+        _stop(listener)
+    return dict(command_mean_ms=1000 * sum(times) / len(times),
+                command_p50_ms=1000 * _percentile(times, 0.5),
+                command_p99_ms=1000 * _percentile(times, 0.99))
+
+def bench_dispatch(couch, size):
+    """
+    Rate at which a listener picks up and executes commands inserted in bulk,
+    for each feed mode
+    """
+    from pynedm.exception import PynEDMException
+    from pynedm.writer import _post_bulk, _stamp
+    n = size["dispatch"]
+    out = {}
+    for mode in ("filter", "selector", "shared"):
+        done = threading.Event()
+        count = [0]
+        lock = threading.Lock()
+        def _count(i):
+            with lock:
+                count[0] += 1
+                if count[0] == n: done.set()
+        listener = _listen(couch, { "bench_count" : _count }, mode)
+        try:
+            db = listener.acct[_db]
+            docs = [ _stamp({ "type" : "command", "execute" : "bench_count",
+                              "arguments" : [i] }) for i in range(n) ]
+            start = _clock()
+            for i in range(0, n, 500):
+                _post_bulk(db, docs[i:i+500])
+            if not done.wait(60):
+                raise PynEDMException("Only {} of {} commands executed".format(count[0], n))
+            out["dispatch_{}_commands_per_s".format(mode)] = n / (_clock() - start)
+        finally:
+            _stop(listener)
+    return out
+
+def _put_attachment(po, docid, name, data):
+    r = po.acct.put(po._attachment_path(docid, name), data=data)
+    r.raise_for_status()
+
+def bench_read(couch, size):
+    """
+    Random and sequential reads with AttachmentFile
+    """
+    po = _process_object(couch)
+    data = os.urandom(size["attachment"])
+    docid = po.write_document_to_db({ "type" : "data" })["id"]
+    _put_attachment(po, docid, "read.bin", data)
+    rnd = random.Random(0)
+    offsets = [ rnd.randrange(len(data) - 4096) for _ in range(size["reads"]) ]
+    out = {}
+    for label, kw in (("cached", {}), ("uncached", dict(block_size=0))):
+        f = po.open_file(docid, "read.bin", **kw)
+        start = _clock()
+        for off in offsets:
+            f.seek(off)
+            f.read(4096)
+        out["read_random_{}_us".format(label)] = 1e6 * (_clock() - start) / len(offsets)
+    f = po.open_file(docid, "read.bin")
+    start = _clock()
+    total = sum(len(c) for c in f.iterate(1024 * 1024))
+    out["read_sequential_mb_per_s"] = total / _mb / (_clock() - start)
+    return out
+
+def bench_transfer(couch, size):
+    """
+    upload_file, download_file and download_to_file throughput
+    """
+    po = _process_object(couch)
+    data = os.urandom(size["attachment"])
+    docid = po.write_document_to_db({ "type" : "data" })["id"]
+    out = {}
+    try:
+        import pycurl
+        start = _clock()
+        res = po.upload_file(io.BytesIO(data), docid, attachment_name="up.bin")
+        out["upload_mb_per_s"] = len(data) / _mb / (_clock() - start)
+        if "error" in res: raise Exception(res)
+    except ImportError:
+        print("  pycurl not available, skipping upload")
+        _put_attachment(po, docid, "up.bin", data)
+
+    start = _clock()
+    it = po.download_file(docid, "up.bin")
+    total = next(it)
+    if sum(len(c) for c in it) != total: raise Exception("Short download")
+    out["download_mb_per_s"] = total / _mb / (_clock() - start)
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        for name, workers in (("download_to_file", 1), ("download_parallel", 4)):
+            start = _clock()
+            po.download_to_file(docid, "up.bin", path, workers=workers,
+                                range_size=max(1, len(data) // 16), resume=False)
+            out[name + "_mb_per_s"] = len(data) / _mb / (_clock() - start)
+    finally:
+        for p in (path, path + ".progress"):
+            if os.path.exists(p): os.remove(p)
+    return out
+
+def bench_export(couch, size):
+    """
+    read_data of a variable written once per second
+    """
+    try:
+        import numpy
+    except ImportError:
+        print("  numpy not available, skipping export")
+        return {}
+    from pynedm.timestamps import iso_timestamp
+    from pynedm.export import install_view
+    from pynedm.writer import _post_bulk
+    po = _process_object(couch)
+    db = po.acct[_db]
+    install_view(db)
+    n, t0 = size["export"], 1.4e9
+    for i in range(0, n, 5000):
+        _post_bulk(db, [ { "type" : "data", "timestamp" : iso_timestamp(t0 + j),
+                           "value" : { "bench_export" : 0.5 * j } }
+                         for j in range(i, min(n, i + 5000)) ])
+    # Build the index of the stand-in outside of the timing
+    po.read_data(["bench_export"], t0, t0 + 1)
+    start = _clock()
+    times, values = po.read_data(["bench_export"], t0, t0 + n)["bench_export"]
+    elapsed = _clock() - start
+    if len(values) != n: raise Exception("Read {} of {} values".format(len(values), n))
+    return dict(export_values_per_s=n / elapsed)
+
+_benchmarks = [ ("write", bench_write), ("command", bench_command),
+                ("dispatch", bench_dispatch), ("read", bench_read),
+                ("transfer", bench_transfer), ("export", bench_export) ]
+
+_sizes = dict(docs=2000, commands=200, dispatch=2000, reads=2000,
+              attachment=32 * 1024 * 1024, export=100000)
+
+def _lower_is_better(name):
+    return name.endswith("_ms") or name.endswith("_us")
+
+def _best(runs):
+    """
+    Best value of each metric over repeated runs
+    """
+    out = {}
+    for k in runs[0]:
+        values = [r[k] for r in runs if k in r]
+        out[k] = min(values) if _lower_is_better(k) else max(values)
+    return out
+
+def _git(*args):
+    try:
+        return subprocess.check_output(("git",) + args, cwd=_here,
+                                       stderr=subprocess.STDOUT).decode("utf-8").strip()
+    except Exception:
+        return None
+
+def _commit():
+    sha = _git("rev-parse", "--short", "HEAD")
+    if sha is None: return "unknown"
+    if _git("status", "--porcelain", "--untracked-files=no"): sha += "-dirty"
+    return sha
+
+def _load(ref, results_dir):
+    path = ref if os.path.exists(ref) else os.path.join(results_dir, ref + ".json")
+    with open(path) as f:
+        return json.load(f)
+
+def compare(old, new):
+    if old.get("sizes") != new["sizes"]:
+        print("\nWarning: the runs used different sizes")
+    print("\n{:<40} {:>14} {:>14} {:>9}".format("metric", old["commit"], new["commit"], "change"))
+    for k in sorted(new["results"]):
+        if k not in old["results"]: continue
+        a, b = old["results"][k], new["results"][k]
+        change = (b - a) / a * 100 if a else 0.
+        better = (change < 0) == _lower_is_better(k)
+        mark = "" if abs(change) < 5 else (" +" if better else " -")
+        print("{:<40} {:>14.3f} {:>14.3f} {:>8.1f}%{}".format(k, a, b, change, mark))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="pynedm benchmarks")
+    parser.add_argument("--quick", action="store_true", help="run with 1/10 of the sizes")
+    parser.add_argument("--only", help="comma-separated benchmarks ({})".format(
+                        ",".join(n for n, _ in _benchmarks)))
+    parser.add_argument("--repeat", type=int, default=1, help="runs per benchmark, best is kept")
+    parser.add_argument("--results", default=os.path.join(_here, "results"),
+                        help="directory of result files")
+    parser.add_argument("--no-save", action="store_true", help="do not save the results")
+    parser.add_argument("--compare", help="result file or commit to compare with")
+    args = parser.parse_args(argv)
+
+    import pynedm
+    from pynedm import codec
+    size = dict((k, v // 10 if args.quick else v) for k, v in _sizes.items())
+    only = args.only.split(",") if args.only else None
+    results = {}
+    with FakeCouch() as couch:
+        for name, func in _benchmarks:
+            if only is not None and name not in only: continue
+            print("Running {}...".format(name))
+            res = _best([ func(couch, size) for _ in range(args.repeat) ])
+            for k in sorted(res):
+                print("  {:<38} {:>12.3f}".format(k, res[k]))
+            results.update(res)
+
+    out = dict(commit=_commit(), date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+               python=platform.python_version(), platform=platform.platform(),
+               codec=codec.backend, quick=args.quick, sizes=size, results=results)
+    if not args.no_save:
+        if not os.path.isdir(args.results): os.makedirs(args.results)
+        path = os.path.join(args.results, out["commit"] + ".json")
+        with open(path, "w") as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+        print("Saved {}".format(path))
+    if args.compare:
+        compare(_load(args.compare, args.results), out)
+    pynedm.stop_listening()
+
+if __name__ == "__main__":
+    main()
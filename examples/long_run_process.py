@@ -1,17 +1,19 @@
+from __future__ import print_function
 import pynedm
+from pynedm.cancel import CancelToken
 
 _my_process = None
-_should_stop = False
 
-def long_function(*args):
+def long_function(msg, cancel_token=None):
     """
     Simulated a long function, for example a measurement process
     """
-    import time
+    if cancel_token is None:
+        # Called directly, run until interrupted
+        cancel_token = CancelToken()
     i = 0
-    while not _should_stop:    
-        print i, args 
-        time.sleep(1)
+    while not cancel_token.wait(1):
+        print(i, msg)
         i += 1
     return i
         
@@ -31,10 +33,10 @@ def stop_process():
     """
     Stop the long process and return the value
     """ 
-    global _should_stop, _my_process
+    global _my_process
     if _my_process is None:
         raise Exception("Process not running!")
-    _should_stop = True
+    _my_process.cancel()
     return _my_process.result.get()
 
 
@@ -65,7 +67,7 @@ def command_process(url,un,pw,db):
     # Push to the database
     # Start the process
     r = des.post("_update/insert_with_timestamp", params=adoc)
-    print "Command: ", r.json()
+    print("Command: ", r.json())
     
     del adoc["arguments"]
     time.sleep(5)
@@ -73,14 +75,14 @@ def command_process(url,un,pw,db):
     # Stop the process
     adoc["execute"] = "stop_process"
     r = des.post("_update/insert_with_timestamp", params=adoc)
-    print "Command: ", r.json()
+    print("Command: ", r.json())
 
     time.sleep(1)
 
     # Stop the program 
     adoc["execute"] = "stop"
     r = des.post("_update/insert_with_timestamp", params=adoc)
-    print "Command: ", r.json()
+    print("Command: ", r.json())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,237 @@
+import array
+import math
+import sys
+import threading as _th
+import time as _ti
+from .exception import PynEDMException
+from .log import exception
+from .timestamps import iso_timestamp
+
+__all__ = [ "WindowAggregator" ]
+
+def _stats(values):
+    """
+    min, max, mean, (population) standard deviation and count of values, an
+    array.array("d")
+    """
+    np = sys.modules.get("numpy")
+    if np is not None:
+        v = np.frombuffer(values, dtype=np.float64)
+        return dict(min=float(v.min()), max=float(v.max()), mean=float(v.mean()),
+                    std=float(v.std()), count=len(v))
+    n = len(values)
+    mean = math.fsum(values) / n
+    std = math.sqrt(math.fsum((x - mean)**2 for x in values) / n)
+    return dict(min=min(values), max=max(values), mean=mean, std=std, count=n)
+
+class _Buffer(object):
+    """
+    Samples of one variable in the current window
+    """
+    __slots__ = ("values", "times")
+
+    def __init__(self, raw):
+        self.values = array.array("d")
+        self.times = array.array("d") if raw else None
+
+    def extend(self, values, t):
+        np = sys.modules.get("numpy")
+        if np is not None and isinstance(values, np.ndarray):
+            v = values.astype(np.float64, copy=False).ravel()
+            v = v[~np.isnan(v)]
+            # frombytes is called fromstring in python 2
+            frombytes = getattr(self.values, "frombytes", None) or self.values.fromstring
+            frombytes(v.tobytes())
+            n = len(v)
+        else:
+            before = len(self.values)
+            self.values.extend(x for x in map(float, values) if x == x)
+            n = len(self.values) - before
+        if self.times is not None:
+            self.times.extend([t] * n)
+
+class WindowAggregator(object):
+    """
+    Aggregates samples of variables over fixed time windows and writes one
+    document per window instead of one per sample::
+
+          { "type" : "data",
+            "value" : { "temp" : <mean>, ... },
+            "stats" : { "temp" : { "min" : .., "max" : .., "mean" : ..,
+                                   "std" : .., "count" : .. }, ... },
+            "window" : { "start" : "2016-05-04T12:00:00.000Z",
+                         "end" : "2016-05-04T12:00:10.000Z" } }
+
+    Windows are aligned to multiples of window seconds.  A window is written
+    when a sample of a later window arrives, otherwise by the shared
+    :class:`pynedm.scheduler.Scheduler` at most 10 s (or window, if shorter)
+    after its end.  Samples older than the current window are counted in the
+    current window, NaN samples are ignored.
+
+    With raw_every, every raw_every-th sample is kept and written as::
+
+          "raw" : { "temp" : <array of (time, value) rows> }
+
+    which is stored as a binary attachment (see
+    :func:`pynedm.utils.ProcessObject.write_document_to_db`, requires
+    NumPy).
+
+    Samples are buffered in :class:`array.array` (8 bytes per sample, 16 with
+    raw_every), statistics are computed with NumPy if it is imported.
+    Writes are made by the thread adding the sample that ends a window, so
+    enabling batched writes (:func:`pynedm.utils.ProcessObject.enable_batch_writes`)
+    keeps the readout loop from waiting for the server.
+
+    Normally created with :func:`pynedm.utils.ProcessObject.aggregator`.
+
+    :param process_object: :class:`pynedm.utils.ProcessObject` used to write
+    :param window: length of the windows (s)
+    :param raw_every: keep every raw_every-th sample, None to keep none
+    :param db: database name, default is the database of process_object
+    :param doc_type: "type" of the documents
+    :type window: float
+    :type raw_every: int
+    :type db: str
+    :type doc_type: str
+    """
+    def __init__(self, process_object, window=10., raw_every=None, db=None, doc_type="data"):
+        if window <= 0:
+            raise PynEDMException("window must be positive")
+        if raw_every is not None:
+            if raw_every < 1:
+                raise PynEDMException("raw_every must be at least 1")
+            try:
+                import numpy
+            except ImportError:
+                raise PynEDMException("raw_every requires NumPy")
+        self.process_object = process_object
+        self.window = float(window)
+        self.raw_every = raw_every
+        self.db = db
+        self.doc_type = doc_type
+        self._lock = _th.Lock()
+        self._start = None
+        self._buffers = {}
+        self._stats = dict(samples=0, windows=0)
+        from .scheduler import get_scheduler
+        self._task = get_scheduler().call_every(min(self.window, 10.), self._expire)
+
+    def add(self, name, value, t=None):
+        """
+        Add a sample of variable name
+
+        :param name: variable name
+        :param value: value
+        :param t: UNIX time of the sample, default is now
+        :type name: str
+        :type value: float
+        :type t: float
+        """
+        self.extend(name, [value], t)
+
+    def add_many(self, values, t=None):
+        """
+        Add one sample of several variables
+
+        :param values: { name : value }
+        :param t: UNIX time of the samples, default is now
+        :type values: dict
+        :type t: float
+        """
+        for name in values:
+            self.extend(name, [values[name]], t)
+
+    def extend(self, name, values, t=None):
+        """
+        Add a block of samples of variable name, all at time t
+
+        :param name: variable name
+        :param values: values, e.g. a list or NumPy array
+        :param t: UNIX time of the samples, default is now
+        :type name: str
+        :type t: float
+        """
+        if t is None: t = _ti.time()
+        with self._lock:
+            done = None
+            if self._start is None or t >= self._start + self.window:
+                done = self._take()
+                self._start = t - t % self.window
+            buf = self._buffers.get(name)
+            if buf is None:
+                buf = self._buffers[name] = _Buffer(self.raw_every is not None)
+            n = len(buf.values)
+            buf.extend(values, t)
+            self._stats["samples"] += len(buf.values) - n
+        if done is not None: self._write(*done)
+
+    def _take(self):
+        """
+        Remove the current window, returns (start, buffers) or None if empty
+        """
+        buffers, self._buffers = self._buffers, {}
+        buffers = dict((k, b) for k, b in buffers.items() if len(b.values))
+        if not buffers: return None
+        self._stats["windows"] += 1
+        return self._start, buffers
+
+    def _expire(self):
+        with self._lock:
+            if self._start is None or _ti.time() < self._start + self.window: return
+            done = self._take()
+            self._start = None
+        if done is None: return
+        # Don't hold up the scheduler with the write
+        th = _th.Thread(target=self._write_thread, args=done)
+        th.daemon = True
+        th.start()
+
+    def _write_thread(self, start, buffers):
+        try:
+            self._write(start, buffers)
+        except Exception:
+            exception("Exception writing aggregated window")
+
+    def _document(self, start, buffers):
+        adoc = { "type" : self.doc_type, "value" : {}, "stats" : {},
+                 "window" : { "start" : iso_timestamp(start),
+                             "end" : iso_timestamp(start + self.window) } }
+        if self.raw_every is not None:
+            import numpy as np
+            adoc["raw"] = {}
+        for name, buf in buffers.items():
+            st = _stats(buf.values)
+            adoc["value"][name] = st["mean"]
+            adoc["stats"][name] = st
+            if self.raw_every is not None:
+                adoc["raw"][name] = np.column_stack((
+                  np.frombuffer(buf.times, dtype=np.float64)[::self.raw_every],
+                  np.frombuffer(buf.values, dtype=np.float64)[::self.raw_every]))
+        return adoc
+
+    def _write(self, start, buffers):
+        return self.process_object.write_document_to_db(self._document(start, buffers),
+          db=self.db, attach_arrays=self.raw_every is not None, deadband=False)
+
+    def stats(self):
+        """
+        :returns: dict -- samples added and windows written
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def flush(self):
+        """
+        Write the current window now, even if it is incomplete
+        """
+        with self._lock:
+            done = self._take()
+            self._start = None
+        if done is not None: self._write(*done)
+
+    def close(self):
+        """
+        Write the current window and stop
+        """
+        self._task.cancel()
+        self.flush()
@@ -0,0 +1,539 @@
+"""
+asyncio variant of :class:`pynedm.utils.ProcessObject`, requires Python 3.6+
+and `aiohttp`.  The changes feed, the heartbeat and command dispatch all run
+on one event loop and share one pooled HTTP connection, e.g.::
+
+    import asyncio
+    from pynedm.aio import AsyncProcessObject
+
+    async def main():
+        async with AsyncProcessObject(uri=_server, username=_un,
+                                      password=_pw, adb=_db) as po:
+            await po.listen({ "do_work_key" : do_work })
+            await po.wait()
+
+    if __name__ == "__main__":
+        asyncio.get_event_loop().run_until_complete(main())
+"""
+import asyncio
+import json
+import os
+import traceback
+import uuid as _uuid
+
+import aiohttp
+
+from . import codec
+
+from .cancel import CancelToken, _accepts_token
+from .checkpoint import FeedCheckpoint
+from .exception import PynEDMException, PynEDMNoFile, CommandError, CommandCollision
+from .listen import _backoff, _get_response, _reconnects, _response_retries
+from .log import log, exception, listening_addresses
+
+__all__ = [ "AsyncProcessObject", "AsyncAttachmentFile" ]
+
+def _encode_params(params):
+    """
+    Encode query parameters like cloudant does: non-string values are sent as
+    JSON.
+    """
+    return dict((k, v if isinstance(v, str) else json.dumps(v))
+                for k, v in params.items())
+
+class AsyncAttachmentFile(object):
+    """
+    asyncio version of :class:`pynedm.fileutils.AttachmentFile`, returned by
+    :func:`AsyncProcessObject.open_file`
+    """
+    def __init__(self, session, url, total_length):
+        self._session = session
+        self.url = url
+        self.total_length = total_length
+        self.curr_pos = 0
+
+    def seek(self, seekpos, whence=0):
+        """
+        Seek to a position in the file (see
+        :func:`pynedm.fileutils.AttachmentFile.seek`)
+        """
+        if whence == 1:
+            seekpos += self.curr_pos
+        elif whence == 2:
+            seekpos = self.total_length - seekpos
+        self.curr_pos = min(seekpos, self.total_length)
+
+    def tell(self):
+        return self.curr_pos
+
+    async def read(self, numbytes=-1):
+        """
+        Read number of bytes from current position, returns None at the end of
+        the file.
+        """
+        if numbytes < 0:
+            numbytes = self.total_length
+        to = min(self.curr_pos + numbytes, self.total_length) - 1
+        if self.curr_pos > to:
+            return None
+        headers = { "Range" : "bytes={}-{}".format(self.curr_pos, to) }
+        try:
+            async with self._session.get(self.url, headers=headers) as r:
+                r.raise_for_status()
+                content = await r.read()
+        except aiohttp.ClientError as e:
+            raise PynEDMNoFile(str(e))
+        self.seek(to+1)
+        return content
+
+    async def iterate(self, chunk_size):
+        """
+        Iterates from this current position to the end of the file
+        """
+        while True:
+            ri = await self.read(chunk_size)
+            if ri is None: break
+            yield ri
+
+class AsyncProcessObject(object):
+    """
+    Process object using asyncio, the coroutine methods mirror those of
+    :class:`pynedm.utils.ProcessObject`.
+
+    :param uri: address of server
+    :param username: username
+    :param password: password
+    :param adb: name of database
+    :param verbose: vebosity
+    :param limit: maximum number of pooled connections
+    :param cancel_token: token stopping this object, as for
+                         :class:`pynedm.utils.ProcessObject`
+    :type uri: str
+    :type username: str
+    :type password: str
+    :type adb: str
+    :type verbose: bool
+    :type limit: int
+    :type cancel_token: :class:`pynedm.cancel.CancelToken`
+    """
+    def __init__(self, uri="http://localhost:5984", username=None,
+                 password=None, adb=None, verbose=False, limit=10, cancel_token=None):
+        from .utils import _tokens
+        self.uri = uri.rstrip("/")
+        self.db = adb
+        self.verbose = verbose
+        self._credentials = (username, password)
+        self._limit = limit
+        self._session = None
+        self._tasks = []
+        self._commands_doc = None
+        self._stop = None
+        self.cancel_token = cancel_token or CancelToken()
+        _tokens.add(self.cancel_token)
+        self.checkpoint = None
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def login(self):
+        """
+        Open the connection pool and log in (if credentials were given)
+
+        :raises: :class:`pynedm.exception.PynEDMException`
+        """
+        if self._session is not None: return
+        self._stop = asyncio.Event()
+        self._session = aiohttp.ClientSession(
+          connector=aiohttp.TCPConnector(limit=self._limit),
+          cookie_jar=aiohttp.CookieJar(unsafe=True))
+        username, password = self._credentials
+        if username and password:
+            async with self._session.post(self.uri + "/_session",
+                data=dict(name=username, password=password)) as r:
+                if r.status != 200:
+                    raise PynEDMException("User credentials incorrect")
+
+    async def close(self):
+        """
+        Stop listening and close the connection pool
+        """
+        self.stop_listening()
+        await self.wait()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _db_url(self, db=None):
+        if db is None:
+            db = self.db
+        if db is None:
+            raise PynEDMException("db must be defined")
+        return self.uri + "/" + db
+
+    def _attachment_path(self, docid, attachment_name, db=None):
+        if db is None:
+            db = self.db
+        if db is None:
+            raise PynEDMException("db must be defined")
+        return '/'.join([self.uri, '_attachments', db, docid, attachment_name])
+
+    async def _update(self, method, adoc, db=None, docid=None):
+        url = self._db_url(db) + "/_design/nedm_default/_update/insert_with_timestamp"
+        if docid is not None:
+            url += "/" + docid
+        async with self._session.request(method, url, data=codec.dumpb(adoc),
+                                         headers={ "Content-Type" : "application/json" }) as r:
+            return await r.json(content_type=None)
+
+    async def write_document_to_db(self, adoc, db=None, ignoreErrors=True):
+        """
+        Write a document to the database.
+
+        :returns: dict -- response from the server
+        :raises: :class:`pynedm.exception.PynEDMException`
+        """
+        try:
+            return await self._update("POST", adoc, db)
+        except Exception as e:
+            if ignoreErrors:
+                log("Exception ({}) when posting doc({})".format(e,adoc))
+                return {}
+            raise
+
+    async def send_command(self, cmd_name, *args, db=None, timeout=10000):
+        """
+        Send command and wait for the response
+
+        :returns: return of remotely-called function
+        :raises: :class:`pynedm.exception.CommandError`
+        """
+        ret = await self.write_document_to_db({
+               "type" : "command",
+            "execute" : cmd_name,
+          "arguments" : args }, db, ignoreErrors=False)
+        if "ok" not in ret:
+            raise CommandError("Error saving document")
+        params = _encode_params(dict(filter="_doc_ids", timeout=timeout,
+          feed="continuous", include_docs=True, doc_ids=[ ret["id"] ]))
+        async with self._session.get(self._db_url(db) + "/_changes", params=params,
+          timeout=aiohttp.ClientTimeout(total=None)) as r:
+            async for l in r.content:
+                if not l.strip(): continue
+                l = json.loads(l.decode())
+                if 'doc' not in l: continue
+                if 'response' not in l['doc']: continue
+                resp = l['doc']['response']
+                if resp["content"].startswith("Exception"):
+                    raise CommandError(resp["content"])
+                return resp["return"]
+        raise CommandError("Timeout")
+
+    async def _check_keys(self, docid):
+        url = self._db_url() + "/_design/execute_commands/_view/export_commands"
+        async with self._session.get(url, params=dict(group_level="1")) as r:
+            rows = (await r.json())["rows"]
+        bad_keys = [x["key"] for x in rows if x["value"] > 1]
+        if bad_keys:
+            async with self._session.post(url, params=dict(reduce="false"),
+              json=dict(keys=bad_keys)) as r:
+                rows = (await r.json())["rows"]
+            s = set([x["id"] for x in rows if x["id"] != docid])
+            raise CommandCollision("\nKey conflicts:\n{}\n\ncheck the following documents:\n{}".format(
+              '\n'.join(bad_keys), '\n'.join(s)))
+
+    async def listen(self, function_dict, checkpoint=None):
+        """
+        Export the commands in function_dict (same format as for
+        :func:`pynedm.utils.listen`) and start executing them.  Coroutine
+        functions are awaited on the loop, plain functions are run in the
+        loop's default executor.  Functions accepting a cancel_token argument
+        are passed :attr:`cancel_token`.  Returns once listening has started,
+        use :func:`wait` to wait until it ends.
+
+        As with :func:`pynedm.utils.listen`, the feed resumes from checkpoint
+        (a file, see :class:`pynedm.checkpoint.FeedCheckpoint`) and responses
+        are written with retries.
+
+        :param checkpoint: file to save the position in the changes feed
+        :type checkpoint: str
+        """
+        import pydoc as _pyd
+        from .utils import _tokens
+        await self.login()
+        if self.cancel_token.cancelled():
+            # Stopped before, tokens can't be reset
+            self.cancel_token = CancelToken()
+            _tokens.add(self.cancel_token)
+        document = { "uuid" : _uuid.getnode(),
+                     "type" : "export_commands",
+                     "keys" : {},
+                     "log_servers" : list(listening_addresses()) }
+        fd = {}
+        for k, o in function_dict.items():
+            if callable(o):
+                fd[k] = o
+                info = _pyd.plain(_pyd.text.document(o, k))
+            else:
+                fd[k] = o[0]
+                info = o[1] if o[1] is not None else _pyd.plain(_pyd.text.document(o[0], k))
+            document["keys"][k] = dict(Info=info)
+        r = await self.write_document_to_db(document)
+        if not "ok" in r:
+            raise PynEDMException("Error seen: {}".format(r))
+        self._commands_doc = r["id"]
+        await self._check_keys(r["id"])
+        self.checkpoint = FeedCheckpoint(checkpoint)
+        if self.checkpoint.seq is None:
+            # Commands sent once this returns must not be missed
+            await self._advance_to_current()
+        self._stop.clear()
+        loop, stop = asyncio.get_event_loop(), self._stop
+        def _cancelled():
+            try:
+                loop.call_soon_threadsafe(stop.set)
+            except RuntimeError:
+                # Loop closed
+                pass
+        self.cancel_token.add_callback(_cancelled)
+        self._tasks = [asyncio.ensure_future(self._watch_changes_feed(fd)),
+                       asyncio.ensure_future(self._heartbeat())]
+
+    def stop_listening(self):
+        """
+        Request the listening to stop (cancels :attr:`cancel_token`),
+        :func:`wait` will return.
+        """
+        self.cancel_token.cancel()
+        if self._stop is not None: self._stop.set()
+
+    async def wait(self):
+        """
+        Wait until listening has stopped and remove the commands document
+        """
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = []
+        if self.checkpoint is not None: self.checkpoint.save()
+        if self._commands_doc is not None:
+            doc_url = self._db_url() + "/" + self._commands_doc
+            self._commands_doc = None
+            log("Removing commands doc {}".format(doc_url))
+            try:
+                async with self._session.get(doc_url) as r:
+                    rev = (await r.json())["_rev"]
+                async with self._session.delete(doc_url, params=dict(rev=rev)) as r:
+                    r.raise_for_status()
+            except Exception as e:
+                log("Error removing document ({})".format(e))
+
+    async def _stopped(self, timeout):
+        try:
+            await asyncio.wait_for(self._stop.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _heartbeat(self):
+        adoc = { "type" : "heartbeat" }
+        docid = "heartbeat_" + str(_uuid.getnode())
+        while not await self._stopped(10):
+            try:
+                await self._update("POST", adoc, docid=docid)
+            except Exception:
+                exception("Heartbeat exception")
+
+    async def _execute(self, fd, label, args, docid):
+        try:
+            func = fd[label]
+            kw = dict(cancel_token=self.cancel_token) if _accepts_token(func) else {}
+            if asyncio.iscoroutinefunction(func):
+                retVal = await func(*args, **kw)
+            else:
+                retVal = await asyncio.get_event_loop().run_in_executor(None,
+                  lambda: func(*args, **kw))
+            resp = _get_response("'%s' success" % label, retVal, True)
+        except Exception:
+            resp = _get_response("Exception:\n{}".format(traceback.format_exc()))
+        await self._respond(resp, docid)
+
+    async def _respond(self, resp, docid):
+        """
+        Write the response of command docid, retried with backoff (see
+        :func:`pynedm.listen._watch_changes_feed`)
+        """
+        attempt = 0
+        while True:
+            try:
+                r = await self._update("PUT", resp, docid=docid)
+                if "ok" not in r: raise PynEDMException(str(r))
+                break
+            except Exception:
+                if self._stop.is_set():
+                    # Left pending, so the command is delivered again after
+                    # a restart
+                    exception("Response of command {} not written".format(docid))
+                    return
+                if attempt >= _response_retries:
+                    exception("Giving up writing the response of command {}".format(docid))
+                    break
+                await self._stopped(_backoff(attempt))
+                attempt += 1
+        self.checkpoint.finished(docid)
+
+    async def _advance_to_current(self):
+        async with self._session.get(self._db_url()) as r:
+            r.raise_for_status()
+            self.checkpoint.advance((await r.json())["update_seq"])
+
+    async def _watch_changes_feed(self, fd):
+        params = dict(feed="continuous", heartbeat=2000, include_docs=True,
+          only_commands=list(fd.keys()), filter="execute_commands/execute_commands")
+        running = set()
+        if self.verbose: log("Waiting for command...")
+        attempt = 0
+        while not self._stop.is_set():
+            try:
+                if self.checkpoint.seq is None: await self._advance_to_current()
+                async with self._session.get(self._db_url() + "/_changes",
+                  params=_encode_params(dict(params, since=self.checkpoint.seq)),
+                  timeout=aiohttp.ClientTimeout(total=None, sock_read=10)) as r:
+                    r.raise_for_status()
+                    attempt = 0
+                    stop = asyncio.ensure_future(self._stop.wait())
+                    try:
+                        await self._read_feed(r, stop, fd, running)
+                    finally:
+                        stop.cancel()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log("Seen error in changes feed: {}".format(traceback.format_exc()))
+                _reconnects.inc(feed="aio")
+                await self._stopped(_backoff(attempt))
+                attempt += 1
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+    async def _read_feed(self, r, stop, fd, running):
+        while not self._stop.is_set():
+            read = asyncio.ensure_future(r.content.readline())
+            await asyncio.wait([read, stop], return_when=asyncio.FIRST_COMPLETED)
+            if not read.done():
+                read.cancel()
+                break
+            line = read.result()
+            if not line: break
+            if not line.strip(): continue
+            await self._handle(json.loads(line.decode()), fd, running)
+
+    async def _handle(self, line, fd, running):
+        """
+        Start the command of a change, errors only affect this change (as in
+        :func:`pynedm.listen._watch_changes_feed`)
+        """
+        checkpoint = self.checkpoint
+        if "id" not in line:
+            if "last_seq" in line: checkpoint.advance(line["last_seq"])
+            return
+        try:
+            doc = line["doc"]
+            if "response" in doc or checkpoint.seen(line["id"]):
+                # Already executed, seen again after a resume
+                checkpoint.advance(line["seq"])
+                return
+            label = doc["execute"]
+            args = doc.get("arguments", [])
+            if self.verbose: log("    command (%s) received" % label)
+            checkpoint.started(line["id"], line["seq"])
+            if not isinstance(args, list):
+                coro = self._respond(_get_response(
+                  "Exception:\n'arguments' field must be a list"), line["id"])
+            else:
+                coro = self._execute(fd, label, args, line["id"])
+            t = asyncio.ensure_future(coro)
+            running.add(t)
+            t.add_done_callback(running.discard)
+        except Exception:
+            exception("Unexpected exception while listening")
+            if "seq" in line and not checkpoint.seen(line["id"]):
+                checkpoint.advance(line["seq"])
+
+    async def open_file(self, docid, attachment_name, db=None):
+        """
+        open file for reading, allows reading ranges of data.
+
+        :returns: :class:`AsyncAttachmentFile`
+        """
+        url = self._attachment_path(docid, attachment_name, db)
+        try:
+            async with self._session.head(url) as r:
+                r.raise_for_status()
+                total_length = int(r.headers['content-length'])
+        except Exception as e:
+            raise PynEDMNoFile(str(e))
+        return AsyncAttachmentFile(self._session, url, total_length)
+
+    async def download_file(self, docid, attachment_name, db=None, chunk_size=100*1024, headers=None):
+        """
+        Async generator: yields the total expected size, then the data of the
+        file in chunks.
+        """
+        url = self._attachment_path(docid, attachment_name, db)
+        async with self._session.get(url, headers=headers or {}) as r:
+            r.raise_for_status()
+            yield int(r.headers['content-length'])
+            async for chunk in r.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def upload_file(self, file_or_name, docid, db=None, attachment_name=None,
+                          callback=None, chunk_size=1024*1024):
+        """
+        Upload file associated with a particular doc id, see
+        :func:`pynedm.utils.ProcessObject.upload_file`.  File reads are done in
+        the loop's default executor.
+        """
+        actual_file = file_or_name
+        if not hasattr(file_or_name, "read"):
+            if not attachment_name:
+                attachment_name = os.path.basename(file_or_name)
+            actual_file = open(file_or_name, "rb")
+        elif not attachment_name:
+            raise PynEDMException("Must include attachment name for file-like objects")
+        actual_file.seek(0, 2)
+        total_size = actual_file.tell()
+        actual_file.seek(0)
+        loop = asyncio.get_event_loop()
+
+        async def _body():
+            total_read = 0
+            while True:
+                x = await loop.run_in_executor(None, actual_file.read, chunk_size)
+                if not x: break
+                total_read += len(x)
+                if callback: callback(total_read, total_size)
+                yield x
+
+        url = self._attachment_path(docid, attachment_name, db)
+        try:
+            async with self._session.put(url, data=_body(),
+              headers={ "Content-Length" : str(total_size) }) as r:
+                content = await r.text()
+        finally:
+            if actual_file is not file_or_name: actual_file.close()
+        try:
+            return json.loads(content)
+        except ValueError:
+            return { "error" : True, "content" : content }
+
+    async def delete_file(self, docid, attachment_name, db=None):
+        """
+        delete file associated with docid.
+
+        :returns: json response from server
+        """
+        async with self._session.delete(self._attachment_path(docid, attachment_name, db)) as r:
+            return await r.json(content_type=None)
@@ -0,0 +1,121 @@
+import sys
+from .exception import PynEDMException
+
+__all__ = [ "split_arrays", "join_arrays", "read_array", "ArrayReader" ]
+
+_KEY = "_ndarray"
+
+class ArrayReader(object):
+    """
+    Read-only file-like view of the bytes of an array, used to upload an
+    array.  read returns slices of a memoryview of the array, which libcurl
+    copies directly into its buffer, so the data isn't copied into bytes
+    objects.  With Python 2 (no memoryview.cast), the array is copied once and
+    read returns bytes.
+    """
+    def __init__(self, arr):
+        self._slices = hasattr(memoryview, "cast")
+        self._view = memoryview(arr).cast("B") if self._slices \
+                     else memoryview(arr.tobytes())
+        self._pos = 0
+
+    def seek(self, pos, whence=0):
+        if whence == 1: pos += self._pos
+        elif whence == 2: pos += len(self._view)
+        self._pos = max(0, min(pos, len(self._view)))
+
+    def tell(self):
+        return self._pos
+
+    def read(self, numbytes=-1):
+        end = len(self._view) if numbytes < 0 else min(self._pos + numbytes, len(self._view))
+        data = self._view[self._pos:end]
+        self._pos = end
+        return data if self._slices else data.tobytes()
+
+def _offloadable(np, v, min_size):
+    return isinstance(v, np.ndarray) and v.dtype.kind in "biufc" and v.nbytes >= min_size
+
+def split_arrays(adoc, min_size=64*1024):
+    """
+    Replace NumPy arrays of at least min_size bytes in adoc by references
+    of the form::
+
+          { "_ndarray" : { "dtype" : "<f8", "shape" : [1000, 2],
+                           "attachment" : "value.waveform" } }
+
+    The attachment name is the path of the field in the document.
+
+    :param adoc: document
+    :param min_size: minimum size (bytes) of an offloaded array
+    :type adoc: dict
+    :type min_size: int
+    :returns: (dict, list) -- document and a list of (attachment name,
+              :class:`ArrayReader`) for the little-endian, C-ordered data of
+              each array
+    """
+    np = sys.modules.get("numpy")
+    if np is None: return adoc, []
+    arrays = []
+
+    def _split(v, path):
+        if _offloadable(np, v, min_size):
+            le = np.ascontiguousarray(v, dtype=v.dtype.newbyteorder("<"))
+            name = ".".join(path)
+            arrays.append((name, ArrayReader(le)))
+            return { _KEY : dict(dtype=le.dtype.str, shape=list(le.shape), attachment=name) }
+        if isinstance(v, dict):
+            return dict((k, _split(x, path + [str(k)])) for k, x in v.items())
+        if isinstance(v, (list, tuple)):
+            return [_split(x, path + [str(i)]) for i, x in enumerate(v)]
+        return v
+
+    out = _split(adoc, [])
+    return (out, arrays) if arrays else (adoc, [])
+
+def join_arrays(adoc, load):
+    """
+    Replace the array references in adoc (see :func:`split_arrays`) by the
+    arrays returned by load(reference)
+
+    :returns: dict -- copy of adoc
+    """
+    def _join(v):
+        if isinstance(v, dict):
+            if _KEY in v and len(v) == 1: return load(v[_KEY])
+            return dict((k, _join(x)) for k, x in v.items())
+        if isinstance(v, list):
+            return [_join(x) for x in v]
+        return v
+    return _join(adoc)
+
+def read_array(fp, ref, start=None, stop=None):
+    """
+    Read an array stored as an attachment.  The data is read with a single
+    request and wrapped without copying or decoding (the array is read-only).
+    start and stop select rows (along the first axis), only those bytes are
+    requested.
+
+    :param fp: attachment, e.g. a :class:`pynedm.fileutils.AttachmentFile`
+    :param ref: array reference from the document ("_ndarray" field)
+    :param start: first row
+    :param stop: end row (exclusive)
+    :type ref: dict
+    :type start: int
+    :type stop: int
+    :rtype: :class:`numpy.ndarray`
+    """
+    import numpy as np
+    dtype = np.dtype(str(ref["dtype"]))
+    shape = list(ref["shape"])
+    if shape:
+        start, stop, _ = slice(start, stop).indices(shape[0])
+        stop = max(start, stop)
+        row = dtype.itemsize * int(np.prod(shape[1:]))
+        shape[0] = stop - start
+        fp.seek(start * row)
+    nbytes = dtype.itemsize * int(np.prod(shape))
+    data = fp.read(nbytes) if nbytes else b""
+    if data is None or len(data) != nbytes:
+        raise PynEDMException("Attachment '{}' is too short for array".format(ref["attachment"]))
+    return np.frombuffer(data, dtype=dtype).reshape(shape)
@@ -0,0 +1,106 @@
+import collections
+import threading as _th
+import time as _ti
+from . import codec, metrics
+from .exception import PynEDMException
+from .future import Future
+
+__all__ = [ "ResultCache" ]
+
+_lookups = metrics.counter("pynedm_command_cache_total",
+  "Calls of cached commands by result (hit, miss or coalesced)")
+
+class ResultCache(object):
+    """
+    Caches the return values of commands for a limited time.  Results are
+    stored by (command, arguments) in a least-recently-used cache of at most
+    max_entries results, a call with the same arguments within ttl seconds
+    after the end of the last execution returns the stored value.  A call
+    arriving while the same command is already executing with the same
+    arguments waits for that execution instead of starting another one.
+
+    Exceptions are passed to the waiting calls but not stored.  Arguments
+    must be JSON serializable (as they are when coming from a command
+    document).
+
+    :param ttls: time (s) results of each command are kept, commands not
+                 listed are not cached, e.g. { "get_voltage" : 2. }
+    :param max_entries: maximum number of stored results
+    :type ttls: dict
+    :type max_entries: int
+    """
+    def __init__(self, ttls=None, max_entries=256):
+        if max_entries < 1:
+            raise PynEDMException("max_entries must be >= 1")
+        self.ttls = dict(ttls or {})
+        self.max_entries = max_entries
+        self._lock = _th.Lock()
+        self._results = collections.OrderedDict()
+        self._running = {}
+        self._stats = dict(hit=0, miss=0, coalesced=0)
+
+    def call(self, key, func, *args, **kwargs):
+        """
+        Return func(*args, **kwargs), from the cache if key (the command name)
+        is cached.  kwargs are not part of the cache key.
+        """
+        ttl = self.ttls.get(key)
+        if ttl is None: return func(*args, **kwargs)
+        k = (key, codec.dumps(args))
+        with self._lock:
+            entry = self._results.pop(k, None)
+            if entry is not None and _ti.time() < entry[0]:
+                # Move to the end (most recently used)
+                self._results[k] = entry
+            else:
+                entry = None
+                fut = self._running.get(k)
+                owner = fut is None
+                if owner:
+                    fut = self._running[k] = Future()
+        if entry is not None:
+            return self._count("hit", key, entry[1])
+        if not owner:
+            return self._count("coalesced", key, fut.result())
+        ok = False
+        try:
+            result = func(*args, **kwargs)
+            ok = True
+        except Exception as e:
+            fut.set_exception(e)
+            raise
+        except BaseException:
+            # e.g. KeyboardInterrupt, which isn't passed to the waiting calls
+            fut.set_exception(PynEDMException("Call of {} was interrupted".format(key)))
+            raise
+        finally:
+            with self._lock:
+                del self._running[k]
+                if ok:
+                    self._results[k] = (_ti.time() + ttl, result)
+                    while len(self._results) > self.max_entries:
+                        self._results.popitem(last=False)
+        fut.set_result(result)
+        return self._count("miss", key, result)
+
+    def _count(self, result, key, value):
+        with self._lock:
+            self._stats[result] += 1
+        _lookups.inc(command=key, result=result)
+        return value
+
+    def invalidate(self, key=None):
+        """
+        Drop the stored results (of command key, if given)
+        """
+        with self._lock:
+            for k in list(self._results):
+                if key is None or k[0] == key:
+                    del self._results[k]
+
+    def stats(self):
+        """
+        :returns: dict -- hits, misses, coalesced calls and stored results
+        """
+        with self._lock:
+            return dict(self._stats, entries=len(self._results))
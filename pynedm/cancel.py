@@ -0,0 +1,90 @@
+import threading as _th
+from .log import exception
+
+__all__ = [ "CancelToken" ]
+
+class CancelToken(object):
+    """
+    Cancellation flag shared between a :class:`pynedm.utils.ProcessObject`
+    and the work it runs.  Waiting on the token returns as soon as it is
+    cancelled, and callbacks registered with :func:`add_callback` are called
+    at that moment (e.g. to close a blocking connection).
+
+    Functions run by :func:`pynedm.utils.listen` or
+    :func:`pynedm.utils.start_process` receive the token if they accept a
+    cancel_token keyword argument, e.g.::
+
+        def measure(channel, cancel_token=None):
+            while not cancel_token.wait(1.0):
+                read_out(channel)
+
+    :param parent: token whose cancellation also cancels this one
+    :type parent: :class:`CancelToken`
+    """
+    def __init__(self, parent=None):
+        self._event = _th.Event()
+        self._lock = _th.Lock()
+        self._callbacks = []
+        if parent is not None:
+            parent.add_callback(self.cancel)
+
+    def cancel(self):
+        """
+        Cancel the token, wakes up all waiters and runs the callbacks
+        """
+        with self._lock:
+            if self._event.is_set(): return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            try:
+                func()
+            except Exception:
+                exception("Exception in cancel callback")
+
+    def cancelled(self):
+        """
+        :returns: bool -- whether the token has been cancelled
+        """
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the token is cancelled or timeout (s) passed
+
+        :returns: bool -- whether the token has been cancelled
+        """
+        return self._event.wait(timeout)
+
+    def add_callback(self, func):
+        """
+        Call func() when the token is cancelled, immediately if it already is.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(func)
+                return
+        func()
+
+    def remove_callback(self, func):
+        with self._lock:
+            if func in self._callbacks:
+                self._callbacks.remove(func)
+
+def _accepts_token(func):
+    """
+    Whether func accepts a cancel_token keyword argument
+    """
+    import inspect
+    try:
+        spec = inspect.getfullargspec(func)
+        names = spec.args + spec.kwonlyargs
+    except AttributeError:
+        # Python 2
+        try:
+            names = inspect.getargspec(func).args
+        except TypeError:
+            return False
+    except TypeError:
+        return False
+    return "cancel_token" in names
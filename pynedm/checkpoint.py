@@ -0,0 +1,119 @@
+import collections
+import json
+import os
+import threading as _th
+import time as _ti
+from .log import exception
+
+__all__ = [ "FeedCheckpoint" ]
+
+class FeedCheckpoint(object):
+    """
+    Position of a listener in the changes feed, used to resume the feed
+    without missing commands.
+
+    The checkpoint sequence only advances past a command once it has
+    finished, so commands interrupted by a crash are delivered again after a
+    restart.  Ids of recently executed commands are kept to avoid running a
+    command twice when the feed is replayed.
+
+    With a path, the state is saved (at most every save_interval seconds and
+    after every finished command) as JSON to that file, and loaded from it
+    when created.
+
+    :param path: file holding the checkpoint, None keeps it in memory
+    :param max_ids: number of executed command ids remembered
+    :param save_interval: minimum time (s) between saves of an advancing sequence
+    :type path: str
+    :type max_ids: int
+    :type save_interval: float
+    """
+    def __init__(self, path=None, max_ids=1000, save_interval=1.0):
+        self.path = path
+        self.max_ids = max_ids
+        self.save_interval = save_interval
+        self._lock = _th.Lock()
+        self._seq = None
+        self._pending = collections.OrderedDict()
+        self._done = collections.OrderedDict()
+        self._last_save = 0
+        self._dirty = False
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self._seq = state.get("seq")
+            for docid in state.get("done", []): self._done[docid] = True
+
+    @property
+    def seq(self):
+        """
+        Sequence to resume the feed from (None if unknown)
+        """
+        with self._lock:
+            return self._committed()
+
+    def _committed(self):
+        if self._pending:
+            return next(iter(self._pending.values()))
+        return self._seq
+
+    def seen(self, docid):
+        """
+        :returns: bool -- whether the command docid is running or has been executed
+        """
+        with self._lock:
+            return docid in self._done or docid in self._pending
+
+    def advance(self, seq):
+        """
+        Record that the feed has been processed up to seq
+        """
+        with self._lock:
+            self._seq = seq
+            self._dirty = True
+        self.save(force=False)
+
+    def started(self, docid, seq):
+        """
+        Record that the command docid, seen at seq, was started.  The
+        checkpoint stays before it until :func:`finished` is called.
+        """
+        with self._lock:
+            self._pending[docid] = self._seq
+            self._seq = seq
+            self._dirty = True
+
+    def finished(self, docid):
+        """
+        Record that the command docid has been executed
+        """
+        with self._lock:
+            self._pending.pop(docid, None)
+            self._done[docid] = True
+            while len(self._done) > self.max_ids:
+                self._done.popitem(last=False)
+            self._dirty = True
+        self.save()
+
+    def save(self, force=True):
+        """
+        Write the checkpoint to its file (if any)
+
+        :param force: if False, only write when save_interval has passed
+        :type force: bool
+        """
+        if self.path is None: return
+        with self._lock:
+            if not self._dirty: return
+            now = _ti.time()
+            if not force and now - self._last_save < self.save_interval: return
+            state = dict(seq=self._committed(), done=list(self._done))
+            self._last_save = now
+            self._dirty = False
+            try:
+                with open(self.path + ".tmp", "w") as f:
+                    json.dump(state, f)
+                os.rename(self.path + ".tmp", self.path)
+            except Exception:
+                self._dirty = True
+                exception("Error saving checkpoint {}".format(self.path))
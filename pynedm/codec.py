@@ -0,0 +1,128 @@
+import datetime
+import json
+import sys
+import zlib
+
+__all__ = [ "dumps", "dumpb", "loads", "plain", "encode_body", "configure" ]
+
+def _default(obj):
+    """
+    Encode the types not known to JSON: NumPy arrays and scalars become lists
+    and numbers, datetimes ISO 8601 strings
+    """
+    if "numpy" in sys.modules:
+        np = sys.modules["numpy"]
+        if isinstance(obj, np.ndarray): return obj.tolist()
+        if isinstance(obj, np.generic): return obj.item()
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+def _json_dumpb(obj):
+    s = json.dumps(obj, default=_default)
+    return s if isinstance(s, bytes) else s.encode("utf-8")
+
+def _json_backend():
+    return "json", lambda obj: json.dumps(obj, default=_default), _json_dumpb, json.loads
+
+def _ujson_backend():
+    import ujson
+    # Versions without a default hook can't encode NumPy arrays
+    ujson.dumps(0, default=_default)
+    def _dumps(obj):
+        try:
+            return ujson.dumps(obj, default=_default, escape_forward_slashes=False)
+        except OverflowError:
+            # Integers beyond 64 bits
+            return json.dumps(obj, default=_default)
+    def _dumpb(obj):
+        s = _dumps(obj)
+        return s if isinstance(s, bytes) else s.encode("utf-8")
+    return "ujson", _dumps, _dumpb, ujson.loads
+
+def _orjson_backend():
+    import orjson
+    opt = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    def _dumpb(obj):
+        try:
+            return orjson.dumps(obj, default=_default, option=opt)
+        except orjson.JSONEncodeError:
+            # Integers beyond 64 bits (and types unknown to both, which then
+            # raise TypeError again)
+            return _json_dumpb(obj)
+    return "orjson", lambda obj: _dumpb(obj).decode("utf-8"), _dumpb, orjson.loads
+
+_backends = dict(orjson=_orjson_backend, ujson=_ujson_backend, json=_json_backend)
+
+backend = None
+_dumps = _dumpb = _loads = None
+compress = False
+compress_min_size = 16384
+
+def configure(backend=None, compress=None, compress_min_size=None):
+    """
+    Configure the encoding of database traffic for the whole process
+
+    :param backend: JSON library, "orjson", "ujson" or "json".  By default
+                    the first one available is used.
+    :param compress: gzip request bodies of bulk writes (the server must
+                     accept Content-Encoding: gzip, as CouchDB does)
+    :param compress_min_size: minimum size (bytes) of a body to compress
+    :type backend: str
+    :type compress: bool
+    :type compress_min_size: int
+    """
+    global _dumps, _dumpb, _loads
+    g = globals()
+    if backend is not None or g["backend"] is None:
+        names = [backend] if backend is not None else ["orjson", "ujson", "json"]
+        for name in names:
+            try:
+                g["backend"], _dumps, _dumpb, _loads = _backends[name]()
+                break
+            except (ImportError, TypeError):
+                if backend is not None: raise
+    if compress is not None: g["compress"] = compress
+    if compress_min_size is not None: g["compress_min_size"] = compress_min_size
+
+def dumps(obj):
+    """
+    :returns: str -- JSON encoding of obj
+    """
+    return _dumps(obj)
+
+def dumpb(obj):
+    """
+    :returns: bytes -- UTF-8 JSON encoding of obj
+    """
+    return _dumpb(obj)
+
+def loads(s):
+    """
+    Decode JSON from str or bytes
+    """
+    return _loads(s)
+
+def plain(obj):
+    """
+    :returns: obj converted to types encodable by the standard json module,
+              e.g. for the query parameters of a request
+    """
+    return _loads(_dumpb(obj))
+
+def encode_body(obj):
+    """
+    Encode obj as a request body, compressed with gzip if configured and the
+    body is large enough
+
+    :returns: (bytes, dict) -- body and request headers
+    """
+    data = _dumpb(obj)
+    headers = { "Content-Type" : "application/json" }
+    if compress and len(data) >= compress_min_size:
+        c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = c.compress(data) + c.flush()
+        headers["Content-Encoding"] = "gzip"
+    return data, headers
+
+configure()
@@ -0,0 +1,121 @@
+import numbers
+import threading as _th
+import time as _ti
+from . import metrics
+
+__all__ = [ "DeadbandFilter" ]
+
+_values = metrics.counter("pynedm_deadband_values_total",
+  "Values seen by deadband filters by result (written, forced or suppressed)")
+
+def _is_number(v):
+    return isinstance(v, numbers.Real) and not isinstance(v, bool)
+
+def _is_array(v):
+    return getattr(v, "ndim", 0) > 0
+
+class DeadbandFilter(object):
+    """
+    Drops values that did not change significantly from the "value" field of
+    data documents::
+
+          { "type" : "data", "value" : { "setpoint" : 1.5, "valve" : "open" } }
+
+    A numeric value is kept if it differs from the last value kept for the
+    same variable by more than max(absolute, relative * abs(last value)),
+    other values if they differ at all (NumPy arrays are always kept).  A
+    value is also kept if the last one kept for its variable is at least
+    max_silence seconds old, so that unchanged variables still show up
+    regularly.  A document whose values are all dropped is not written.
+    Documents without a "value" dictionary are not changed.
+
+    The last kept value and its time are stored per database and variable by
+    :func:`record`, once the document is written.
+
+    Normally used via :func:`pynedm.utils.ProcessObject.enable_deadband`.
+
+    :param absolute: absolute threshold
+    :param relative: threshold relative to the last kept value
+    :param max_silence: maximum time (s) between kept values of a variable,
+                        None for no limit
+    :param variables: thresholds for single variables, e.g.
+                      { "pressure" : { "relative" : 0.01 } }, overriding the
+                      ones above
+    :type absolute: float
+    :type relative: float
+    :type max_silence: float
+    :type variables: dict
+    """
+    def __init__(self, absolute=0., relative=0., max_silence=600., variables=None):
+        self.default = dict(absolute=absolute, relative=relative, max_silence=max_silence)
+        self._settings = {}
+        for name, opts in (variables or {}).items():
+            self._settings[name] = dict(self.default, **opts)
+        self._lock = _th.Lock()
+        self._last = {}
+
+    def _keep(self, key, name, v, now):
+        """
+        Whether v is kept, called with the lock held
+        """
+        last = self._last.get(key)
+        if last is None or _is_array(v): return "written"
+        s = self._settings.get(name, self.default)
+        old, t = last
+        if s["max_silence"] is not None and now - t >= s["max_silence"]:
+            return "forced"
+        if _is_number(v) and _is_number(old):
+            if v != v or old != old:
+                # NaN
+                return "written" if (v != v) != (old != old) else None
+            band = max(s["absolute"], s["relative"] * abs(old))
+            return "written" if abs(v - old) > band else None
+        return "written" if v != old else None
+
+    def filter(self, adoc, db=None):
+        """
+        :param adoc: document
+        :param db: database name, values are compared per database
+        :returns: dict -- adoc with only the kept values (a copy if values
+                  were dropped), None if no value was kept
+        """
+        values = adoc.get("value")
+        if not isinstance(values, dict) or not values: return adoc
+        now = _ti.time()
+        kept = {}
+        with self._lock:
+            for name, v in values.items():
+                result = self._keep((db, name), name, v, now)
+                _values.inc(result=result or "suppressed")
+                if result is not None: kept[name] = v
+        if not kept: return None
+        if len(kept) == len(values): return adoc
+        adoc = dict(adoc)
+        adoc["value"] = kept
+        return adoc
+
+    def record(self, adoc, db=None):
+        """
+        Store the values of adoc (as returned by :func:`filter`) as the last
+        kept ones, to be called once adoc is written
+
+        :param adoc: document
+        :param db: database name
+        """
+        values = adoc.get("value")
+        if not isinstance(values, dict): return
+        now = _ti.time()
+        with self._lock:
+            for name, v in values.items():
+                self._last[(db, name)] = (None if _is_array(v) else v, now)
+
+    def reset(self, name=None, db=None):
+        """
+        Forget the last values (of variable name, if given), so that the next
+        value is kept
+        """
+        with self._lock:
+            if name is None:
+                self._last.clear()
+            else:
+                self._last.pop((db, name), None)
@@ -0,0 +1,158 @@
+import threading as _th
+import time as _ti
+import traceback
+from .cancel import CancelToken
+from .exception import CommandError
+from .future import Future
+from .listen import _iter_changes, _reconnects, ShouldStop
+from .log import log
+
+__all__ = [ "ResponseDispatcher" ]
+
+# Answered commands, whatever documents are awaited
+_response_selector = { "type" : "command", "response" : { "$exists" : True } }
+
+def _command_result(resp):
+    """
+    Convert the "response" field of a command document into the return value,
+    raises :class:`pynedm.exception.CommandError` if the command failed.
+    """
+    exc = "Exception"
+    if resp["content"][:len(exc)] == exc:
+        raise CommandError(resp["content"])
+    return resp["return"]
+
+class ResponseDispatcher(object):
+    """
+    Waits for responses to command documents of one database using a single
+    continuous changes feed, shared by all callers.  The feed runs in a
+    background thread while responses are awaited, and is closed once no
+    response has been awaited for idle_timeout seconds.
+
+    The feed is filtered by the server with a Mango selector (CouchDB >=
+    2.0) to command documents with a response, so other writes to the
+    database are not transferred.  The selector doesn't depend on the
+    awaited documents, so the feed stays open while commands are sent.
+
+    Used by :func:`pynedm.utils.ProcessObject.send_command`.
+
+    :param db: database resource
+    :param idle_timeout: time (s) to keep the feed open without waiters
+    :type idle_timeout: float
+    """
+    def __init__(self, db, idle_timeout=60.):
+        self.db = db
+        self.idle_timeout = idle_timeout
+        self._lock = _th.Lock()
+        self._waiters = {}
+        self._since = None
+        self._thread = None
+        self._closed = False
+        self._idle_since = _ti.time()
+        # Token stopping the current feed
+        self._token = None
+
+    def expect(self, docid, timeout=None):
+        """
+        Register interest in the response to command document docid, which
+        should be called *before* the document is inserted.
+
+        :param docid: id of command document
+        :param timeout: seconds after which the returned future fails with a
+                        timeout (checked with a granularity of ~2 s)
+        :type docid: str
+        :type timeout: float
+        :returns: :class:`pynedm.future.Future` -- resolves to the return value
+                  of the command or raises :class:`pynedm.exception.CommandError`
+        """
+        if self._since is None:
+            self._since = self.db.get().json()["update_seq"]
+        fut = Future()
+        deadline = None if timeout is None else _ti.time() + timeout
+        with self._lock:
+            self._waiters[docid] = (fut, deadline)
+            self._closed = False
+            if self._thread is None:
+                self._thread = _th.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return fut
+
+    def cancel(self, docid, exc=None):
+        """
+        Stop waiting for docid, its future fails with exc (default
+        :class:`pynedm.exception.CommandError`)
+        """
+        w = self._pop(docid)
+        if w is not None:
+            w[0].set_exception(exc or CommandError("Cancelled"))
+
+    def close(self):
+        """
+        Stop the feed, pending waiters fail.
+        """
+        with self._lock:
+            self._closed = True
+            waiters, self._waiters = self._waiters, {}
+            token = self._token
+        if token is not None: token.cancel()
+        for fut, _ in waiters.values():
+            fut.set_exception(CommandError("Dispatcher closed"))
+
+    def _pop(self, docid):
+        with self._lock:
+            w = self._waiters.pop(docid, None)
+            if not self._waiters: self._idle_since = _ti.time()
+        return w
+
+    def _check_timeouts(self):
+        now = _ti.time()
+        with self._lock:
+            expired = [k for k, (_, d) in self._waiters.items() if d is not None and d < now]
+        for k in expired:
+            w = self._pop(k)
+            if w is not None: w[0].set_exception(CommandError("Timeout"))
+
+    def _should_exit(self):
+        with self._lock:
+            if self._closed or (not self._waiters and
+                     _ti.time() - self._idle_since > self.idle_timeout):
+                self._thread = None
+                return True
+        return False
+
+    def _handle(self, line):
+        self._since = line.get("seq", self._since)
+        doc = line.get("doc") or {}
+        if "response" not in doc: return
+        w = self._pop(line["id"])
+        if w is None: return
+        try:
+            w[0].set_result(_command_result(doc["response"]))
+        except CommandError as e:
+            w[0].set_exception(e)
+
+    def _run(self):
+        errors = 0
+        while not self._should_exit():
+            token = CancelToken()
+            with self._lock:
+                self._token = token
+            params = dict(feed="continuous", heartbeat=2000, since=self._since,
+                          include_docs=True)
+            try:
+                for line in _iter_changes(self.db, params, token, _response_selector):
+                    errors = 0
+                    self._check_timeouts()
+                    if self._should_exit(): return
+                    if line is None: continue
+                    self._handle(line)
+            except ShouldStop:
+                # Closed
+                continue
+            except Exception:
+                errors += 1
+                log("Error in response feed ({}): {}".format(errors, traceback.format_exc()))
+                _reconnects.inc(feed="responses")
+                self._check_timeouts()
+                _ti.sleep(min(errors, 10))
@@ -0,0 +1,138 @@
+import collections
+import threading as _th
+import time as _ti
+from .exception import PynEDMException
+from .future import Future
+from .log import exception
+
+__all__ = [ "CommandExecutor" ]
+
+class CommandExecutor(object):
+    """
+    Bounded pool of worker threads executing commands.  Workers are started on
+    demand up to max_workers and are reused afterwards.
+
+    Every task is submitted with a key (e.g. the command name).  limits can
+    restrict the number of tasks with a given key running concurrently, e.g.
+    { "set_voltage" : 1 } serializes all "set_voltage" commands.  Tasks waiting
+    on such a limit do not block workers.
+
+    :param max_workers: maximum number of worker threads
+    :param limits: maximum number of concurrently running tasks per key
+    :type max_workers: int
+    :type limits: dict
+    """
+    def __init__(self, max_workers=4, limits=None):
+        if max_workers < 1:
+            raise PynEDMException("max_workers must be >= 1")
+        self.max_workers = max_workers
+        self.limits = dict(limits or {})
+        self._cond = _th.Condition()
+        self._queue = collections.deque()
+        self._deferred = {}
+        self._running = {}
+        self._workers = []
+        self._idle = 0
+        self._shutdown = False
+        self._stats = dict(submitted=0, completed=0, failed=0,
+                           total_wait=0., max_wait=0.)
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) for execution
+
+        :param key: key used for concurrency limits
+        :returns: :class:`pynedm.future.Future` -- return value of func
+        :raises: :class:`pynedm.exception.PynEDMException` after shutdown
+        """
+        fut = Future()
+        task = (key, func, args, kwargs, fut, _ti.time())
+        with self._cond:
+            if self._shutdown:
+                raise PynEDMException("Executor has been shut down")
+            self._stats["submitted"] += 1
+            if self._running.get(key, 0) >= self.limits.get(key, self.max_workers):
+                self._deferred.setdefault(key, collections.deque()).append(task)
+                return fut
+            self._running[key] = self._running.get(key, 0) + 1
+            self._queue.append(task)
+            if self._idle < len(self._queue) and len(self._workers) < self.max_workers:
+                th = _th.Thread(target=self._work)
+                th.daemon = True
+                th.start()
+                self._workers.append(th)
+            else:
+                self._cond.notify()
+        return fut
+
+    def stats(self):
+        """
+        :returns: dict -- queue depth ("queued" ready to run, "deferred" waiting
+                  on a key limit), number of running tasks and workers,
+                  submitted/completed/failed counters, and mean/max time (s)
+                  tasks waited before starting
+        """
+        with self._cond:
+            s = dict(self._stats)
+            s["queued"] = len(self._queue)
+            s["deferred"] = sum(len(d) for d in self._deferred.values())
+            s["running"] = sum(self._running.values()) - s["queued"]
+            s["workers"] = len(self._workers)
+            started = s["completed"] + s["failed"] + s["running"]
+            s["mean_wait"] = s.pop("total_wait")/started if started else 0.
+        return s
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting tasks, the workers exit after the queued tasks are done.
+
+        :param wait: wait until all tasks are finished
+        :type wait: bool
+        """
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+            workers = list(self._workers)
+        if wait:
+            for th in workers:
+                while th.is_alive(): th.join(0.1)
+
+    def _next_task(self):
+        with self._cond:
+            while not self._queue:
+                if self._shutdown and not self._deferred: return None
+                self._idle += 1
+                self._cond.wait()
+                self._idle -= 1
+            task = self._queue.popleft()
+            wait = _ti.time() - task[5]
+            self._stats["total_wait"] += wait
+            self._stats["max_wait"] = max(self._stats["max_wait"], wait)
+            return task
+
+    def _task_done(self, key, ok):
+        with self._cond:
+            self._stats["completed" if ok else "failed"] += 1
+            deferred = self._deferred.get(key)
+            if deferred:
+                self._queue.append(deferred.popleft())
+                if not deferred: del self._deferred[key]
+                self._cond.notify()
+                return
+            self._running[key] -= 1
+            if self._running[key] == 0: del self._running[key]
+            if self._shutdown: self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            task = self._next_task()
+            if task is None: break
+            key, func, args, kwargs, fut, _ = task
+            try:
+                fut.set_result(func(*args, **kwargs))
+                ok = True
+            except Exception as e:
+                exception("Exception in task ({})".format(key))
+                fut.set_exception(e)
+                ok = False
+            self._task_done(key, ok)
@@ -0,0 +1,214 @@
+import calendar as _cal
+import datetime
+import math
+import numbers
+import threading as _th
+import time as _ti
+from . import codec
+from .exception import PynEDMException
+from .timestamps import iso_timestamp
+
+try:
+    import Queue as _queue
+except ImportError:
+    import queue as _queue
+
+__all__ = [ "DataExporter", "install_view" ]
+
+_DESIGN = "pynedm_export"
+_VIEW = "by_variable"
+
+# Numeric (and boolean) values of data documents by [variable, timestamp]
+_map = """function(doc) {
+  if (doc.type !== "data" || !doc.value || !doc.timestamp) return;
+  for (var k in doc.value) {
+    var v = doc.value[k];
+    if (typeof v === "number" || typeof v === "boolean") emit([k, doc.timestamp], v);
+  }
+}"""
+
+def install_view(db):
+    """
+    Create the view used by :class:`DataExporter` (design document
+    _design/pynedm_export), requires admin rights on the database.  Building
+    the index for an existing database may take a while.
+
+    :param db: database resource, e.g. process_object.acct["nedm%2Fmydb"]
+    """
+    doc = { "language" : "javascript",
+            "views" : { _VIEW : { "map" : _map, "reduce" : "_count" } } }
+    r = db.document("_design/" + _DESIGN).put(data=codec.dumps(doc),
+          headers={ "Content-Type" : "application/json" })
+    if r.status_code not in (201, 202, 409):
+        raise PynEDMException("Could not create export view: {}".format(r.text))
+
+def _key_time(t):
+    """
+    Timestamp key (as written by insert_with_timestamp) of t: UNIX time,
+    datetime (UTC if naive) or ISO 8601 string
+    """
+    if isinstance(t, datetime.datetime):
+        if t.tzinfo is not None:
+            t = t.replace(tzinfo=None) - t.utcoffset()
+        t = _cal.timegm(t.timetuple()) + t.microsecond / 1e6
+    if isinstance(t, numbers.Real):
+        return iso_timestamp(t)
+    return str(t)
+
+def _unix_time(key):
+    ts = key[:19]
+    frac = key[19:].rstrip("Z")
+    return _cal.timegm(_ti.strptime(ts, "%Y-%m-%dT%H:%M:%S")) + (float(frac) if frac else 0.)
+
+def _parse_times(np, keys):
+    """
+    UNIX times (float64 array) of ISO 8601 (UTC) timestamps
+    """
+    try:
+        stamps = np.array([k[:-1] if k.endswith("Z") else k for k in keys],
+                          dtype="datetime64[us]")
+        return stamps.astype(np.int64) / 1e6
+    except ValueError:
+        return np.array([_unix_time(k) for k in keys], dtype=np.float64)
+
+class DataExporter(object):
+    """
+    Reads the values of variables over a time range from data documents
+    ({ "type" : "data", "value" : { ... } }) into NumPy arrays, using the view
+    created by :func:`install_view`.
+
+    The time range is split into chunks of about chunk_size documents
+    (estimated from the number of values in the range), which are requested
+    by a background thread while the previous chunk is being decoded.  At
+    most prefetch chunks are held in memory, so memory use is bounded when
+    iterating with :func:`iter_batches`.
+
+    Normally used via :func:`pynedm.utils.ProcessObject.read_data` and
+    :func:`pynedm.utils.ProcessObject.iter_data`.
+
+    :param db: database resource, e.g. process_object.acct["nedm%2Fmydb"]
+    :param chunk_size: approximate number of values per request, chunks are
+                       split by time and may hold more values
+    :param prefetch: number of chunks requested ahead
+    :type chunk_size: int
+    :type prefetch: int
+    """
+    def __init__(self, db, chunk_size=10000, prefetch=2):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+
+    def _get(self, params):
+        r = self.db.design(_DESIGN).view(_VIEW).get(params=params)
+        if r.status_code == 404:
+            raise PynEDMException("Export view missing, create it with pynedm.export.install_view")
+        r.raise_for_status()
+        return r
+
+    def _range(self, name, start, end, **kw):
+        params = dict(startkey=codec.dumps([name, _key_time(start)]),
+                      endkey=codec.dumps([name, _key_time(end)]),
+                      inclusive_end="false")
+        params.update(kw)
+        return params
+
+    def count(self, name, start, end):
+        """
+        :returns: int -- number of values of variable name in [start, end)
+        """
+        rows = codec.loads(self._get(self._range(name, start, end, reduce="true")).content)["rows"]
+        return rows[0]["value"] if rows else 0
+
+    def _chunks(self, name, start, end, n):
+        """
+        Split [start, end) into time ranges of about chunk_size values
+        """
+        first, last = _key_time(start), _key_time(end)
+        a, b = _unix_time(first), _unix_time(last)
+        chunks = max(1, int(math.ceil(float(n) / self.chunk_size)))
+        return [first] + [ iso_timestamp(a + (b - a) * i / float(chunks)) for i in range(1, chunks) ] + [last]
+
+    def _fetch(self, name, keys, q, stop):
+        """
+        Request the chunks and queue their bodies, an exception is queued on
+        errors
+        """
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.5)
+                    return True
+                except _queue.Full:
+                    pass
+            return False
+
+        try:
+            for a, b in zip(keys[:-1], keys[1:]):
+                if not _put(self._get(self._range(name, a, b, reduce="false")).content):
+                    return
+            _put(None)
+        except Exception as e:
+            _put(e)
+
+    def iter_batches(self, name, start, end, n=None):
+        """
+        Iterate over the values of variable name in [start, end)
+
+        :param name: variable name
+        :param start: start time, UNIX time, datetime (UTC) or ISO 8601 string
+        :param end: end time (exclusive)
+        :param n: number of values in the range, if known
+        :type name: str
+        :type n: int
+        :returns: generator yielding (times, values) -- float64 arrays of
+                  UNIX times and values, one pair per chunk
+        """
+        import numpy as np
+        if n is None: n = self.count(name, start, end)
+        keys = self._chunks(name, start, end, n)
+        q = _queue.Queue(self.prefetch)
+        stop = _th.Event()
+        th = _th.Thread(target=self._fetch, args=(name, keys, q, stop))
+        th.daemon = True
+        th.start()
+        try:
+            while True:
+                item = q.get()
+                if item is None: return
+                if isinstance(item, Exception): raise item
+                rows = codec.loads(item)["rows"]
+                if not rows: continue
+                times = _parse_times(np, [r["key"][1] for r in rows])
+                values = np.array([r["value"] for r in rows], dtype=np.float64)
+                yield times, values
+        finally:
+            stop.set()
+
+    def read(self, names, start, end):
+        """
+        Read the values of variables in [start, end) into preallocated arrays
+
+        :param names: variable names
+        :param start: start time, UNIX time, datetime (UTC) or ISO 8601 string
+        :param end: end time (exclusive)
+        :type names: list
+        :returns: dict -- { name : (times, values) } float64 arrays of UNIX
+                  times and values
+        """
+        import numpy as np
+        out = {}
+        for name in names:
+            n = self.count(name, start, end)
+            times, values = np.empty(n), np.empty(n)
+            i = 0
+            for t, v in self.iter_batches(name, start, end, n):
+                if i + len(t) > len(times):
+                    # Documents added since counting
+                    extra = i + len(t) - len(times)
+                    times = np.concatenate((times, np.empty(extra)))
+                    values = np.concatenate((values, np.empty(extra)))
+                times[i:i+len(t)] = t
+                values[i:i+len(v)] = v
+                i += len(t)
+            out[name] = (times[:i], values[:i])
+        return out
@@ -1,19 +1,45 @@
+import collections
+import json
+import os
 from cloudant.resource import Resource
-from .exception import PynEDMNoFile
+from . import metrics
+from .exception import PynEDMNoFile, PynEDMException
 import traceback
 
-__all__ = [ "AttachmentFile" ]
+__all__ = [ "AttachmentFile", "RangeDownloader" ]
+
+_download_bytes = metrics.counter("pynedm_download_bytes_total",
+  "Bytes of attachments downloaded")
 
 class AttachmentFile(Resource):
     """
     Provides a file-like object for handling document attachments without
     downloading them.
 
+    Data is fetched in aligned blocks of block_size bytes which are kept in an
+    LRU cache of at most cache_size bytes.  Missing blocks that are adjacent
+    are fetched with a single Range request and, when reads are sequential,
+    read_ahead further blocks are fetched with them.  Reads larger than the
+    cache bypass it.
+
     Returned by :func:`pynedm.utils.ProcessObject.open_file`
+
+    :param block_size: size of cached blocks in bytes (0 disables the cache)
+    :param cache_size: maximum number of cached bytes
+    :param read_ahead: blocks fetched in advance for sequential reads
+    :type block_size: int
+    :type cache_size: int
+    :type read_ahead: int
     """
-    def __init__(self,req):
+    def __init__(self,req, block_size=64*1024, cache_size=4*1024*1024, read_ahead=4):
         self.req = req
         self.curr_pos = 0
+        self.block_size = block_size
+        self.cache_size = cache_size
+        self.read_ahead = read_ahead
+        self._blocks = collections.OrderedDict()
+        self._last_end = 0
+        self._stats = dict(hits=0, misses=0, requests=0, bytes_fetched=0)
         try:
             self.head_info = self.req.head()
             self.head_info.raise_for_status()
@@ -53,23 +79,90 @@ class AttachmentFile(Resource):
 
         :param numbytes: number of bytes to read (< 0 reads remaining bytes)
         :type numbytes: int
+        :returns: str -- data, None at the end of the file
         """
         if numbytes < 0:
             numbytes = self.total_length
-        to = self.curr_pos + numbytes - 1
-        if to >= self.total_length:
-            to = self.total_length-1
-        if self.curr_pos >= to:
+        end = min(self.curr_pos + numbytes, self.total_length)
+        if self.curr_pos >= end:
             return None
+        start = self.curr_pos
+        if self.block_size <= 0 or end - start > self.cache_size:
+            data = self._fetch(start, end)
+        else:
+            data = self._read_cached(start, end)
+        self._last_end = end
+        self.seek(end)
+        return data
+
+    def stats(self):
+        """
+        :returns: dict -- block cache hits/misses, number of HTTP requests,
+                  bytes fetched and bytes currently cached
+        """
+        s = dict(self._stats)
+        s["cached_bytes"] = sum(len(b) for b in self._blocks.values())
+        return s
+
+    def _fetch(self, start, end):
+        """
+        GET bytes [start, end) of the attachment
+        """
         try:
             t = self.req.get(headers={
-              "Range" : "bytes={}-{}".format(self.curr_pos, to)
+              "Range" : "bytes={}-{}".format(start, end-1)
             })
             t.raise_for_status()
-            self.seek(to+1)
-            return t.content
         except Exception as e:
             raise PynEDMNoFile(str(e))
+        content = t.content
+        if t.status_code != 206:
+            # Server ignored the range and sent the whole file
+            content = content[start:end]
+        self._stats["requests"] += 1
+        self._stats["bytes_fetched"] += len(content)
+        _download_bytes.inc(len(content))
+        return content
+
+    def _read_cached(self, start, end):
+        bs = self.block_size
+        first, last = start // bs, (end - 1) // bs
+        blocks = {}
+        missing = []
+        for i in range(first, last+1):
+            if i in self._blocks:
+                self._blocks[i] = blocks[i] = self._blocks.pop(i)
+                self._stats["hits"] += 1
+            else:
+                missing.append(i)
+                self._stats["misses"] += 1
+        if missing:
+            # Group adjacent blocks into runs, each fetched with one request
+            runs = [[missing[0], missing[0]]]
+            for i in missing[1:]:
+                if i == runs[-1][1] + 1: runs[-1][1] = i
+                else: runs.append([i, i])
+            if start == self._last_end and runs[-1][1] == last:
+                nblocks = (self.total_length + bs - 1) // bs
+                max_blocks = max(self.cache_size // bs, last - first + 1)
+                ahead = min(self.read_ahead, nblocks - 1 - last, max_blocks - (last - first + 1))
+                while ahead > 0 and runs[-1][1] + 1 not in self._blocks:
+                    runs[-1][1] += 1
+                    ahead -= 1
+            for a, b in runs:
+                data = self._fetch(a*bs, min((b+1)*bs, self.total_length))
+                for i in range(a, b+1):
+                    blocks[i] = self._blocks[i] = data[(i-a)*bs:(i-a+1)*bs]
+            self._evict()
+        data = b"".join(blocks[i] for i in range(first, last+1))
+        offset = first*bs
+        return data[start-offset:end-offset]
+
+    def _evict(self):
+        cached = len(self._blocks) * self.block_size
+        while cached > self.cache_size and self._blocks:
+            self._blocks.popitem(last=False)
+            cached -= self.block_size
 
     def __enter__(self):
         """
@@ -93,3 +186,149 @@ class AttachmentFile(Resource):
             ri = self.read(chunk_size)
             if ri is None: break
             yield ri
+
+class RangeDownloader(object):
+    """
+    Downloads an attachment as ranges of range_size bytes, fetched in
+    parallel by a pool of workers if workers > 1.  A single stream is usually
+    as fast, parallel requests only help when the throughput of single
+    connections is limited (e.g. by latency).
+
+    Returned by :func:`pynedm.utils.ProcessObject.download_file` and used by
+    :func:`pynedm.utils.ProcessObject.download_to_file`
+
+    :param req: attachment resource
+    :param workers: number of concurrent requests
+    :param range_size: size of each range in bytes
+    :param retries: number of retries per range
+    :type workers: int
+    :type range_size: int
+    :type retries: int
+    """
+    def __init__(self, req, workers=1, range_size=8*1024*1024, retries=3):
+        self.req = req
+        self.workers = workers
+        self.range_size = range_size
+        self.retries = retries
+        try:
+            head_info = self.req.head()
+            head_info.raise_for_status()
+            self.total_length = int(head_info.headers['content-length'])
+            self.etag = head_info.headers.get('etag')
+        except Exception as e:
+            raise PynEDMNoFile(str(e))
+        self.ranges = [(a, min(a + range_size, self.total_length))
+                         for a in range(0, self.total_length, range_size)]
+
+    def _get(self, start, end, stream=False):
+        for i in range(self.retries + 1):
+            try:
+                r = self.req.get(stream=stream, headers={
+                  "Range" : "bytes={}-{}".format(start, end-1)
+                })
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise PynEDMException("Range requests not supported")
+                return r
+            except PynEDMException:
+                raise
+            except Exception as e:
+                if i == self.retries:
+                    raise PynEDMNoFile(str(e))
+
+    def _fetch(self, start, end):
+        content = self._get(start, end).content
+        _download_bytes.inc(len(content))
+        return content
+
+    def _fetch_to_file(self, filename, start, end):
+        r = self._get(start, end, stream=True)
+        with open(filename, "r+b") as o:
+            o.seek(start)
+            for chunk in r.iter_content(chunk_size=1024*1024):
+                _download_bytes.inc(len(chunk))
+                o.write(chunk)
+        return end - start
+
+    def iterate(self, chunk_size=100*1024):
+        """
+        Yields the total size, then the data in order in chunks of at most
+        chunk_size bytes.  At most 2*workers ranges are held in memory.
+        """
+        from .executor import CommandExecutor
+        yield self.total_length
+        ex = CommandExecutor(self.workers)
+        window = 2*self.workers
+        pending = collections.deque(ex.submit("range", self._fetch, a, b)
+                                      for a, b in self.ranges[:window])
+        try:
+            while pending:
+                data = pending.popleft().result()
+                if window < len(self.ranges):
+                    a, b = self.ranges[window]
+                    pending.append(ex.submit("range", self._fetch, a, b))
+                    window += 1
+                for i in range(0, len(data), chunk_size):
+                    yield data[i:i+chunk_size]
+        finally:
+            ex.shutdown(wait=False)
+
+    def to_file(self, filename, callback=None, resume=True):
+        """
+        Download into filename, writing each range at its offset in the
+        (preallocated) file.  Completed ranges are recorded in
+        filename + ".progress" so that an interrupted download continues where
+        it stopped when resume is True.
+
+        :param filename: output file
+        :param callback: progress callback, func(size_downloaded, total_size)
+        :param resume: continue a previous partial download
+        :type filename: str
+        :type callback: func(size_downloaded, total_size)
+        :type resume: bool
+        :raises: :class:`pynedm.exception.PynEDMNoFile` if ranges could not be downloaded
+        """
+        from .executor import CommandExecutor
+        state_file = filename + ".progress"
+        state = dict(size=self.total_length, etag=self.etag,
+                     range_size=self.range_size, done=[])
+        resumed = False
+        if resume and os.path.exists(state_file) and os.path.exists(filename):
+            with open(state_file) as f:
+                old = json.load(f)
+            if all(old.get(k) == state[k] for k in ("size", "etag", "range_size")):
+                state = old
+                resumed = True
+        if not resumed:
+            # Also drops the content of an older, possibly longer file
+            with open(filename, "wb") as o:
+                o.truncate(self.total_length)
+
+        def _save():
+            with open(state_file + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.rename(state_file + ".tmp", state_file)
+
+        done = set(state["done"])
+        total = sum(b - a for a, b in self.ranges if a in done)
+        if callback: callback(total, self.total_length)
+        ex = CommandExecutor(self.workers)
+        futs = [(a, ex.submit("range", self._fetch_to_file, filename, a, b))
+                  for a, b in self.ranges if a not in done]
+        errors = []
+        try:
+            for a, f in futs:
+                try:
+                    total += f.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                state["done"].append(a)
+                _save()
+                if callback: callback(total, self.total_length)
+        finally:
+            ex.shutdown()
+        if errors:
+            raise PynEDMNoFile("{} range(s) failed, rerun to resume: {}".format(len(errors), errors[0]))
+        if os.path.exists(state_file):
+            os.remove(state_file)
@@ -0,0 +1,75 @@
+import threading as _th
+from .exception import PynEDMException
+from .log import exception
+
+__all__ = [ "Future" ]
+
+class Future(object):
+    """
+    Minimal thread-safe placeholder for a result that will be delivered later
+    by a background thread (e.g. a batched write or a queued command).
+    """
+    def __init__(self):
+        self._event = _th.Event()
+        self._lock = _th.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """
+        :returns: bool -- whether the result is available
+        """
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for and return the result, re-raising any stored exception.
+
+        :param timeout: time in seconds to wait (None waits forever)
+        :type timeout: float
+        :raises: :class:`pynedm.exception.PynEDMException` on timeout
+        """
+        if not self._event.wait(timeout):
+            raise PynEDMException("Timeout waiting for result")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the result and return the stored exception (or None)
+        """
+        if not self._event.wait(timeout):
+            raise PynEDMException("Timeout waiting for result")
+        return self._exception
+
+    def add_done_callback(self, func):
+        """
+        Call func(future) once the result is available.  If it is already
+        available, func is called immediately in the calling thread.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc):
+        self._finish(None, exc)
+
+    def _finish(self, result, exc):
+        with self._lock:
+            if self._event.is_set(): return
+            self._result = result
+            self._exception = exc
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                exception("Exception in done callback")
@@ -1,130 +1,314 @@
 # Reset any stop listening flags
+import calendar as _cal
 import time as _ti
 import requests as _req
-import httplib as _http
-from .utils import should_stop, log, exception
+try:
+    import httplib as _http
+except ImportError:
+    import http.client as _http
+import random as _random
+import socket as _socket
+import threading as _th
+from . import codec, metrics
+from .cancel import _accepts_token
+from .checkpoint import FeedCheckpoint
+from .exception import PynEDMException
+from .utils import log, exception
 import traceback
 
+_command_delay = metrics.histogram("pynedm_command_delay_seconds",
+  "Time from insertion of a command document (server timestamp) to the start of its execution")
+_command_seconds = metrics.histogram("pynedm_command_seconds",
+  "Execution time of commands")
+_commands = metrics.counter("pynedm_commands_total", "Commands executed by result")
+_reconnects = metrics.counter("pynedm_feed_reconnects_total",
+  "Reconnections of changes feeds after errors")
+_response_failures = metrics.counter("pynedm_command_response_failures_total",
+  "Responses of commands that could not be written")
+
+# Attempts to write the response of a command after the first one
+_response_retries = 5
+
+def _age(timestamp):
+    """
+    Seconds since timestamp (ISO 8601, UTC), None if it can't be parsed
+    """
+    try:
+        t = _cal.timegm(_ti.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S"))
+        frac = timestamp[19:].rstrip("Z")
+        return _ti.time() - t - (float(frac) if frac else 0.)
+    except Exception:
+        return None
+
 class ShouldStop(Exception):
     """
     Raised when the loop should be stopped
     """
     pass
 
-def _watch_changes_feed(adb, fd, verbose):
+def _command_selector(keys=None):
+    """
+    Mango selector matching unanswered commands (with keys, if given)
+    """
+    sel = { "type" : "command", "response" : { "$exists" : False } }
+    sel["execute"] = { "$exists" : True } if keys is None else { "$in" : list(keys) }
+    return sel
+
+def _post_selector(adb, params, selector, **kw):
+    """
+    Request the changes feed filtered by a Mango selector (CouchDB >= 2.0)
+    """
+    params = dict(params, filter="_selector")
+    return adb.post("_changes", params=params, data=codec.dumps(dict(selector=selector)),
+                    headers={"Content-Type" : "application/json"}, **kw)
+
+def _iter_changes(adb, params, token, selector=None):
+    """
+    Iterate over a continuous changes feed, yielding None for heartbeats.
+    When token is cancelled, the connection is shut down so that a blocked
+    read returns immediately.  With selector, the feed is filtered by a
+    Mango selector instead of params["filter"].
+    """
+    if selector is None:
+        r = adb.get("_changes", params=params, stream=True)
+    else:
+        r = _post_selector(adb, params, selector, stream=True)
+    r.raise_for_status()
+
+    def _shutdown():
+        # Reach the socket of the urllib3 connection, closing the response
+        # alone does not wake up a read blocked in another thread
+        sock = getattr(getattr(r.raw, "_connection", None), "sock", None)
+        try:
+            if sock is not None: sock.shutdown(_socket.SHUT_RDWR)
+        except Exception:
+            pass
+        r.close()
+
+    token.add_callback(_shutdown)
+    try:
+        for line in r.iter_lines():
+            if token.cancelled(): raise ShouldStop()
+            if not line:
+                yield None
+                continue
+            yield codec.loads(line)
+    except ShouldStop:
+        raise
+    except Exception:
+        if token.cancelled(): raise ShouldStop()
+        raise
+    finally:
+        token.remove_callback(_shutdown)
+        r.close()
+
+def _get_response(msg, retVal=None, ok = False):
+    """
+     _get_response returns a dictionary with a msg and a timestamp for
+     insertion into the db, encoded with :mod:`pynedm.codec` (e.g. NumPy
+     arrays in retVal become lists)
+    """
+    ad = { "response" : {
+       "content" : msg,
+       "timestamp" : _ti.strftime("%a, %d %b %Y %H:%M:%S +0000", _ti.gmtime()),
+       "return" : retVal
+      }
+    }
+    if ok: ad["response"]["ok"] = True
+    return ad
+
+def _backoff(attempt, base=0.5, maximum=30.):
+    """
+    Delay (s) before reconnection attempt, exponential with random jitter
+    """
+    return min(maximum, base * 2**attempt) * _random.uniform(0.5, 1.)
+
+def _watch_changes_feed(adb, fd, verbose, executor, token, checkpoint=None,
+                        feed_mode="filter", cache=None, account=None):
     """
     _watch_changes_feed is a hidden function that performs all the work
-    watching the change feed, it makes use of the filter function:
+    watching the change feed.  How the feed selects commands depends on
+    feed_mode:
+
+    "filter"
+      the feed uses the filter function::
+
+        execute_commands/execute_commands
 
-    execute_commands/execute_commands
+      to ensure that it only reacts on a particular set of command keys.
+    "selector"
+      the feed uses a Mango selector, evaluated by CouchDB without the
+      JavaScript query server (CouchDB >= 2.0)
+    "shared"
+      all listeners of the process on the same database and account share
+      one feed (see :class:`pynedm.router.FeedRouter`), which routes
+      commands by key
 
-    to ensure that it only reacts on a particular set of command keys.
+    Commands are run by executor (a :class:`pynedm.executor.CommandExecutor`),
+    which is shut down when the feed stops.  The feed stops as soon as token
+    (a :class:`pynedm.cancel.CancelToken`) is cancelled, commands accepting a
+    cancel_token argument are passed the token.
+
+    The feed resumes from the sequence of checkpoint (a
+    :class:`pynedm.checkpoint.FeedCheckpoint`, in memory if None) whenever it
+    reconnects, so that commands inserted in between are not missed.
+    Reconnections are delayed with exponential backoff.
+
+    Results of commands are taken from cache (a
+    :class:`pynedm.cache.ResultCache`) when it caches them.
    
     Documentation of that filter function is available `here <http://nedm-tum.github.io/nEDM-Interface/tutorial-couchdb_filter.html>`_:
     """
 
-    import threading as _th
+    def _fire_single_thread(des, fd, label, args, docid, timestamp):
+        upd = "_update/insert_with_timestamp/" + docid
+        delay = _age(timestamp) if timestamp else None
+        if delay is not None: _command_delay.observe(max(delay, 0))
+        start = _ti.time()
+        try:
+            kw = dict(cancel_token=token) if _accepts_token(fd[label]) else {}
+            if cache is not None:
+                retVal = cache.call(label, fd[label], *args, **kw)
+            else:
+                retVal = fd[label](*args, **kw)
+            resp = codec.dumpb(_get_response("'%s' success" % label, retVal, True))
+            _commands.inc(command=label, result="ok")
+        except:
+            resp = codec.dumpb(_get_response("Exception:\n{}".format(traceback.format_exc())))
+            _commands.inc(command=label, result="exception")
+        _command_seconds.observe(_ti.time() - start, command=label)
+        attempt = 0
+        while True:
+            try:
+                des.put(upd, data=resp).raise_for_status()
+                break
+            except Exception:
+                if token.cancelled():
+                    # Left pending, so the command is delivered again after
+                    # a restart
+                    exception("Response of command {} not written".format(docid))
+                    return
+                if attempt >= _response_retries:
+                    # A pending command would hold back the checkpoint forever
+                    exception("Giving up writing the response of command {}".format(docid))
+                    _response_failures.inc(command=label)
+                    break
+                token.wait(_backoff(attempt))
+                attempt += 1
+        checkpoint.finished(docid)
 
-    def _get_response(msg, retVal=None, ok = False):
-        """
-         _get_response returns a dictionary with a msg and a timestamp for
-         insertion into the db
-        """
-        ad = { "response" : {
-           "content" : msg,
-           "timestamp" : _ti.strftime("%a, %d %b %Y %H:%M:%S +0000", _ti.gmtime()),
-           "return" : retVal
-          }
-        }
-        if ok: ad["response"]["ok"] = True
-        return ad
+    handle_lock = _th.Lock()
+    def _handle(line):
+        if "id" not in line:
+            if "last_seq" in line: checkpoint.advance(line["last_seq"])
+            return
+        with handle_lock:
+            try:
+                doc = line["doc"]
+                if "response" in doc or checkpoint.seen(line["id"]):
+                    # Already executed, seen again after a resume
+                    checkpoint.advance(line["seq"])
+                    return
 
+                label = doc["execute"]
+                args = doc.get("arguments", [])
+                if verbose: log("    command (%s) received" % label)
 
-    def _fire_single_thread(des, fd, label, args):
-        try:
-            retVal = fd[label](*args)
-            des.put(upd, params=_get_response("'%s' success" % label, retVal, True))
-        except:
-            des.put(upd, params=_get_response("Exception:\n{}".format(traceback.format_exc())))
-
-    def _heartbeat_thread(thedb):
-        import uuid as _uuid
-        anode = _uuid.getnode()
-        des = thedb.design("nedm_default")
-        adoc = { "type" : "heartbeat" }
-        now = _ti.time()
-        while not should_stop():
-            if _ti.time() - now >= 10:
-                now = _ti.time()
-                try:
-                    des.post("_update/insert_with_timestamp/heartbeat_" + str(anode), params=adoc)
-                except:
-                    exception("Heartbeat exception")
-            _ti.sleep(0.1)
-
-    all_threads = []
+                if type(args) != type([]):
+                    raise Exception("'arguments' field must be a list")
+
+                checkpoint.started(line["id"], line["seq"])
+                executor.submit(label, _fire_single_thread, des, fd, label, args, line["id"],
+                                doc.get("timestamp"))
+            except:
+                exception("Unexpected exception while listening")
+                if not checkpoint.seen(line["id"]): checkpoint.advance(line["seq"])
+        if verbose: log("Waiting for next command...")
 
     des = adb.design("nedm_default")
-    # Start Heartbeat thread
-    heartbeat = _th.Thread(target=_heartbeat_thread, args=(adb,))
-    heartbeat.start()
-    all_threads.append(heartbeat)
+    if checkpoint is None: checkpoint = FeedCheckpoint()
     ####
 
-    connection_error = 0
     if verbose: log("Waiting for command...")
+    if feed_mode == "shared":
+        _watch_shared_feed(adb, fd, token, checkpoint, _handle, account)
+    else:
+        _watch_own_feed(adb, fd, token, checkpoint, _handle, feed_mode)
+
+    token.cancel()
+    checkpoint.save()
+    executor.shutdown()
+
+def _watch_own_feed(adb, fd, token, checkpoint, handle, feed_mode):
+    """
+    Run a changes feed for this listener only, passing each change to handle
+    """
+    if feed_mode == "selector":
+        params = dict(feed='continuous', heartbeat=2000, include_docs=True)
+        selector = _command_selector(fd.keys())
+    elif feed_mode == "filter":
+        params = dict(feed='continuous',
+                      heartbeat=2000,
+                      include_docs=True,
+                      only_commands=list(fd.keys()),
+                      filter="execute_commands/execute_commands")
+        selector = None
+    else:
+        raise PynEDMException("Unknown feed_mode ({})".format(feed_mode))
+
+    connection_error = 0
     while 1:
         try:
             # Get changes feed and begin thread
-            if should_stop(): raise ShouldStop()
-            changes = adb.changes(params=dict(feed='continuous',
-                                              heartbeat=2000,
-                                              since='now',
-                                              include_docs=True,
-                                              only_commands=fd.keys(),
-                                              filter="execute_commands/execute_commands"),
-                                emit_heartbeats=True
-                               )
+            if token.cancelled(): raise ShouldStop()
+            if checkpoint.seq is None:
+                checkpoint.advance(adb.get().json()["update_seq"])
+            changes = _iter_changes(adb, dict(params, since=checkpoint.seq),
+                                    token, selector)
             for line in changes:
-                if line is None and should_stop(): raise ShouldStop()
                 if connection_error != 0:
                     log("Connection reset after {} tries".format(connection_error))
                 connection_error = 0
                 if line is None: continue
-                try:
-                    doc = line["doc"]
-
-                    upd = "_update/insert_with_timestamp/" + line["id"]
-
-                    label = doc["execute"]
-                    args = doc.get("arguments", [])
-                    if verbose: log("    command (%s) received" % label)
-
-                    if type(args) != type([]):
-                        raise Exception("'arguments' field must be a list")
-
-                    new_th = _th.Thread(target=_fire_single_thread, args=(des, fd, label, args))
-                    new_th.start()
-                    all_threads.append(new_th)
-                except:
-                    exception("Unexpected exception while listening")
-                if verbose: log("Waiting for next command...")
+                handle(line)
         except (_req.exceptions.ChunkedEncodingError, _http.IncompleteRead):
             # Sometimes the changes feeds "stop" listening, so we can try restarting the feed
             log("Ignoring exception {}".format(traceback.format_exc()))
-            pass
+            _reconnects.inc(feed="listen")
+            token.wait(_backoff(connection_error))
+            connection_error += 1
         except ShouldStop:
             break
         except:
             # all other errors?
             log("Seen unexpected error in changes feed: {}".format(traceback.format_exc()))
+            _reconnects.inc(feed="listen")
+            token.wait(_backoff(connection_error))
             connection_error += 1
-            _ti.sleep(1)
-
-    if not should_stop():
-        stop_listening()
-
-    for th in all_threads:
-        while th.isAlive(): th.join(0.1)
-
 
+def _watch_shared_feed(adb, fd, token, checkpoint, handle, account=None):
+    """
+    Receive changes for the keys of fd from the feed shared by the process
+    for account (see :func:`pynedm.router.get_router`).
+    If checkpoint has a sequence, the commands since then are first fetched
+    in a single request (commands also received by the shared feed are
+    de-duplicated by checkpoint).
+    """
+    from .router import get_router
+    route = get_router(adb, account).subscribe(fd.keys(), handle)
+    try:
+        attempt = 0
+        while checkpoint.seq is not None and not token.cancelled():
+            try:
+                r = _post_selector(adb, dict(since=checkpoint.seq, include_docs=True),
+                                   _command_selector(fd.keys()))
+                r.raise_for_status()
+                for line in r.json()["results"]: handle(line)
+                break
+            except Exception:
+                log("Error fetching missed commands: {}".format(traceback.format_exc()))
+                token.wait(_backoff(attempt))
+                attempt += 1
+        token.wait()
+    finally:
+        route.close()
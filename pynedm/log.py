@@ -1,10 +1,14 @@
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from threading import Thread
+import collections
 import logging
 import json
+import re
+import time
 from autobahn.twisted.websocket import (WebSocketServerFactory,
-                                        listenWS,
                                         WebSocketServerProtocol)
+from . import codec, metrics
 
 __all__ = [
   "debug", "log", "error", "exception", "listening_addresses",
@@ -12,6 +16,9 @@ __all__ = [
   "use_broadcaster"
 ]
 
+_log_dropped = metrics.counter("pynedm_log_dropped_total",
+  "Log records dropped before broadcasting, by the handler queue or slow clients")
+
 def debug(*args):
     """
     Alias for logging.debug
@@ -36,57 +43,307 @@ def exception(*args):
     """
     _logger.exception(*args)
 
+def _level(level):
+    """
+    Convert level name (e.g. "INFO") or number to the level number
+    """
+    if isinstance(level, int): return level
+    levelno = logging.getLevelName(str(level).upper())
+    if not isinstance(levelno, int):
+        raise ValueError("Unknown level {}".format(level))
+    return levelno
+
+class _Subscription(object):
+    """
+    Selection of records a client wants to receive:
+
+    :param level: minimum level (name or number)
+    :param name: prefix of the logger name
+    :param regex: regular expression searched in the message
+    :param max_rate: maximum number of messages per second
+    :param batch: send frames holding lists of messages instead of one
+                  frame per message
+    """
+    def __init__(self, level="INFO", name=None, regex=None, max_rate=None, batch=False):
+        self.levelno = _level(level)
+        self.name = name
+        self.regex = re.compile(regex) if regex else None
+        self.max_rate = max_rate
+        self.batch = bool(batch)
+        self._tokens = max_rate
+        self._last = time.time()
+
+    def matches(self, rec):
+        levelno, name, msg = rec
+        if levelno < self.levelno: return False
+        if self.name and not name.startswith(self.name): return False
+        if self.regex and not self.regex.search(msg["msg"]): return False
+        return True
+
+    def allow(self):
+        """
+        Token bucket check for max_rate
+        """
+        if not self.max_rate: return True
+        now = time.time()
+        self._tokens = min(self.max_rate, self._tokens + (now - self._last)*self.max_rate)
+        self._last = now
+        if self._tokens < 1: return False
+        self._tokens -= 1
+        return True
+
 class BroadcastLogProtocol(WebSocketServerProtocol):
     """
     Internal class to define broadcast log protocol
+
+    Clients receive records of level INFO and above unless they send a
+    subscription message, e.g.::
+
+        { "subscribe" : { "level" : "DEBUG", "name" : "pynedm",
+                          "regex" : "voltage", "max_rate" : 20,
+                          "batch" : true } }
+
+    where all fields are optional: level is the minimum level, name a prefix
+    of the logger name, regex is searched in the message and max_rate limits
+    the messages per second.  After subscribing (or shortly after connecting
+    without a subscription) the client receives the matching records of the
+    recent history.
+
+    Each frame holds one message, as a JSON object.  Clients subscribing with
+    batch receive the messages of each flush of the handler as one frame
+    holding a JSON list of messages instead.
+
+    Registers itself as a streaming producer with its transport: while the
+    transport's buffer is full (the client lags), frames are kept in a
+    bounded queue of at most max_queued messages.  When the queue overflows,
+    the oldest frames are dropped and the client is told how many messages
+    were lost once it catches up.
     """
+    max_queued = 1000
+    replay_delay = 0.5
+
     def onOpen(self):
+        self.paused = False
+        self.queued = collections.deque()
+        self.queued_msgs = 0
+        self.dropped = 0
+        self.subscription = _Subscription()
+        self.replayed = False
+        self.history = list(self.factory.recent)
+        try:
+            self.transport.registerProducer(self, True)
+        except Exception:
+            # Transport already has a producer, never pause
+            pass
         self.factory.register(self)
+        reactor.callLater(self.replay_delay, self._replay)
+
+    def onMessage(self, payload, isBinary):
+        try:
+            sub = json.loads(payload.decode("utf-8"))["subscribe"]
+            self.subscription = _Subscription(**sub)
+        except Exception as e:
+            for prepMsg, _ in self._frames([dict(level="ERROR",
+                                 msg="Invalid subscription ({})".format(e))]):
+                self.sendPreparedMessage(prepMsg)
+            return
+        self.factory.update_level()
+        self._replay()
 
     def connectionLost(self, reason):
         super(BroadcastLogProtocol, self).connectionLost(reason)
         self.factory.unregister(self)
 
+    def _replay(self):
+        """
+        Send the history (records before the connection was opened), followed
+        by the records held back until now.
+        """
+        if self.replayed: return
+        self.replayed = True
+        history, self.history = self.history, None
+        held, self.queued = self.queued, collections.deque()
+        self.queued_msgs = 0
+        msgs = [rec[2] for rec in history if self.subscription.matches(rec)]
+        for prepMsg, n in self._frames(msgs):
+            self.send(prepMsg, n)
+        for prepMsg, n in held:
+            self.send(prepMsg, n)
+
+    def _frames(self, msgs):
+        """
+        :returns: list -- (prepared frame, number of messages) pairs sending
+                  the message dicts msgs in the format of this client
+        """
+        if not msgs: return []
+        if self.subscription.batch:
+            return [(self.factory.prepareRecords(msgs), len(msgs))]
+        return [(self.factory.prepareRecord(msg), 1) for msg in msgs]
+
+    def wants(self, rec):
+        """
+        Whether the record should be sent to this client
+        """
+        if not self.subscription.matches(rec): return False
+        if self.subscription.allow(): return True
+        self.dropped += 1
+        _log_dropped.inc(where="rate_limit")
+        return False
+
+    def send(self, prepMsg, n=1):
+        """
+        Send a prepared frame holding n messages, or queue it while the client
+        lags or the history has not been sent
+        """
+        if not self.paused and self.replayed:
+            self._report_dropped()
+            self.sendPreparedMessage(prepMsg)
+            return
+        while self.queued and self.queued_msgs + n > self.max_queued:
+            _, lost = self.queued.popleft()
+            self.queued_msgs -= lost
+            self.dropped += lost
+            _log_dropped.inc(lost, where="client")
+        self.queued.append((prepMsg, n))
+        self.queued_msgs += n
+
+    def _report_dropped(self):
+        if self.dropped:
+            for prepMsg, _ in self._frames([dict(level="WARNING",
+                                 msg="{} log messages dropped".format(self.dropped))]):
+                self.sendPreparedMessage(prepMsg)
+            self.dropped = 0
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if not self.replayed: return
+        self._report_dropped()
+        while self.queued and not self.paused:
+            prepMsg, n = self.queued.popleft()
+            self.queued_msgs -= n
+            self.sendPreparedMessage(prepMsg)
+
+    def stopProducing(self):
+        self.queued.clear()
+        self.queued_msgs = 0
+
 class BroadcastLogFactory(WebSocketServerFactory):
     """
-    Factory for broadcast logger
+    Factory for broadcast logger, keeps the last replay_size records for
+    clients that connect later.
     """
     def __init__(self, *args, **kw):
+        replay_size = kw.pop("replay_size", 200)
         super(BroadcastLogFactory, self).__init__(*args, **kw)
         self.clients = []
+        self.recent = collections.deque(maxlen=replay_size)
+        self.replay_level = logging.INFO
+        self.min_level = self.replay_level
 
     def register(self, client):
         if client not in self.clients:
             self.clients.append(client)
+        self.update_level()
 
     def unregister(self, client):
         if client in self.clients:
             self.clients.remove(client)
+        self.update_level()
+
+    def update_level(self):
+        """
+        Lowest level any client (or the replay buffer) is interested in
+        """
+        levels = [c.subscription.levelno for c in self.clients]
+        if self.recent.maxlen: levels.append(self.replay_level)
+        self.min_level = min(levels) if levels else logging.CRITICAL + 1
+
+    def prepareRecord(self, msg):
+        """
+        Prepare one frame holding the message dict msg
+        """
+        return self.prepareMessage(codec.dumpb(msg))
+
+    def prepareRecords(self, msgs):
+        """
+        Prepare one frame holding the list of message dicts msgs (for clients
+        subscribed with batch)
+        """
+        return self.prepareMessage(codec.dumpb(msgs))
 
-    def broadcast(self, msg):
-        prepMsg = self.prepareMessage(json.dumps(msg))
+    def broadcast(self, recs):
+        """
+        Send records, tuples (levelno, logger name, message dict), to the
+        clients subscribed to them: one frame per record, or one frame per
+        client for clients subscribed with batch.  Each frame is serialized
+        once, clients wanting the same records share the frames.
+        """
+        for rec in recs:
+            if rec[0] >= self.replay_level:
+                self.recent.append(rec)
+        singles = {}
+        batches = {}
         for c in self.clients:
-            c.sendPreparedMessage(prepMsg)
+            selected = tuple(i for i, rec in enumerate(recs) if c.wants(rec))
+            if not selected: continue
+            if c.subscription.batch:
+                if selected not in batches:
+                    batches[selected] = self.prepareRecords([recs[i][2] for i in selected])
+                c.send(batches[selected], len(selected))
+                continue
+            for i in selected:
+                if i not in singles: singles[i] = self.prepareRecord(recs[i][2])
+                c.send(singles[i])
 
 
 class BroadcastLogHandler(logging.Handler):
     """
     Listens on 0.0.0.0 (all interfaces) and sends log messages to connected
     clients.  Clients must connect via WebSocket and receive logging
-    information in JSON format, e.g.::
+    information in JSON format, one message per frame, e.g.::
 
-        { 'level' : 'INFO', 'msg' : 'A sent message' }
+        { 'level' : 'INFO', 'msg' : 'A sent message', 'name' : 'pynedm.log' }
 
+    or, for clients subscribed with batch, lists of messages per frame.
+
+    Clients can select which records they receive, see
+    :class:`BroadcastLogProtocol`.
 
     This is used in live logging of Raspberry Pis, for example in the
     nEDM-Interface.
+
+    emit only appends the formatted record to a queue, the reactor thread
+    sends the queued records every interval seconds.  At most max_pending
+    records are queued, older records are dropped (and a message reporting the
+    number of dropped records is sent instead).  Records below the level of
+    every subscription are not even formatted.
+
+    :param interval: time (s) between sending queued records
+    :param max_pending: maximum number of queued records
+    :param replay_size: number of recent records sent to new clients
+    :type interval: float
+    :type max_pending: int
+    :type replay_size: int
     """
-    def __init__(self):
+    def __init__(self, interval=0.1, max_pending=1000, replay_size=200):
         logging.Handler.__init__(self)
-        factory = BroadcastLogFactory("ws://0.0.0.0:0")
+        # Current autobahn rejects port 0 in the URL, listen on a free port
+        # directly
+        factory = BroadcastLogFactory("ws://0.0.0.0", replay_size=replay_size)
         factory.protocol = BroadcastLogProtocol
-        self.port = listenWS(factory).getHost()
+        self.port = reactor.listenTCP(0, factory).getHost()
         self.factory = factory
+        self._pending = collections.deque(maxlen=max_pending)
+        self._dropped = 0
+        metrics.gauge("pynedm_log_pending", "Log records waiting to be broadcast"
+          ).set_function(lambda: len(self._pending))
+        metrics.gauge("pynedm_log_clients", "Connected log clients"
+          ).set_function(lambda: len(self.factory.clients))
+        self._loop = LoopingCall(self._flush)
+        reactor.callWhenRunning(self._loop.start, interval, False)
 
         # Start the reactor thread, setting daemon to True
         # (daemon = True) allows the program to normally end, which allows the
@@ -99,14 +356,34 @@ class BroadcastLogHandler(logging.Handler):
     def getPort(self):
         return self.port
 
-    def _sendRecord(self, msg):
-        reactor.callFromThread(self.factory.broadcast, msg)
+    def _flush(self):
+        """
+        Called in the reactor thread, sends queued records
+        """
+        # emit holds the handler lock (see logging.Handler.handle)
+        with self.lock:
+            dropped, self._dropped = self._dropped, 0
+            recs = [self._pending.popleft() for _ in range(len(self._pending))]
+        if dropped:
+            recs.insert(0, (logging.WARNING, _logger.name, dict(level="WARNING",
+              msg="{} log messages dropped".format(dropped), name=_logger.name)))
+        if recs:
+            self.factory.broadcast(recs)
+
+    def _sendRecord(self, rec):
+        if len(self._pending) == self._pending.maxlen:
+            self._dropped += 1
+            _log_dropped.inc(where="handler")
+        self._pending.append(rec)
 
     def emit(self, record):
-        self._sendRecord(dict(level=record.levelname, msg=self.format(record)))
+        if record.levelno < self.factory.min_level: return
+        self._sendRecord((record.levelno, record.name,
+          dict(level=record.levelname, msg=self.format(record), name=record.name)))
 
     def close(self):
         logging.Handler.close(self)
+        reactor.callFromThread(self._flush)
         reactor.callFromThread(reactor.stop)
         self._th.join()
 
@@ -146,5 +423,5 @@ def listening_addresses():
       for x in map(netifaces.ifaddresses, netifaces.interfaces())
       if netifaces.AF_INET in x]
     obj.remove("127.0.0.1")
-    return map(lambda x: "ws://{}:{}".format(x,port), obj)
+    return ["ws://{}:{}".format(x,port) for x in obj]
 
@@ -0,0 +1,285 @@
+import bisect
+import threading as _th
+import time as _ti
+
+__all__ = [ "Registry", "registry", "counter", "gauge", "histogram",
+            "render", "snapshot", "serve", "publish" ]
+
+_default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1., 2.5, 5., 10., 30., 60.)
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items: return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\")
+                 .replace('"', '\\"').replace("\n", "\\n")) for k, v in items) + "}"
+
+def _format_value(v):
+    if v == float("inf"): return "+Inf"
+    return repr(float(v))
+
+class _Metric(object):
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = _th.Lock()
+        self._values = {}
+
+    def _header(self):
+        return [ "# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} {}".format(self.name, self.kind) ]
+
+class Counter(_Metric):
+    """
+    Monotonically increasing count, values are kept per set of labels
+    """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        k = _key(labels)
+        with self._lock:
+            self._values[k] = self._values.get(k, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return self._header() + [ "{}{} {}".format(self.name, _format_labels(k), _format_value(v))
+                                  for k, v in values ]
+
+    def snapshot(self):
+        with self._lock:
+            return dict((_format_labels(k) or "", v) for k, v in self._values.items())
+
+class Gauge(Counter):
+    """
+    Value that goes up and down, or is computed by a function when read
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help):
+        Counter.__init__(self, name, help)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, func, **labels):
+        """
+        Read the value from func() when the metrics are collected
+        """
+        with self._lock:
+            self._functions[_key(labels)] = func
+
+    def _collect(self):
+        with self._lock:
+            funcs = list(self._functions.items())
+        for k, func in funcs:
+            try:
+                v = func()
+            except Exception:
+                continue
+            with self._lock:
+                self._values[k] = v
+
+    def render(self):
+        self._collect()
+        return Counter.render(self)
+
+    def snapshot(self):
+        self._collect()
+        return Counter.snapshot(self)
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (e.g. latencies in s) in cumulative
+    buckets
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=_default_buckets):
+        _Metric.__init__(self, name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        k = _key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(k)
+            if v is None:
+                v = self._values[k] = [ [0] * (len(self.buckets) + 1), 0, 0. ]
+            v[0][i] += 1
+            v[1] += 1
+            v[2] += value
+
+    def time(self, **labels):
+        """
+        Context manager observing the time (s) spent in its block
+        """
+        return _Timer(self, labels)
+
+    def _items(self):
+        with self._lock:
+            return [ (k, (list(v[0]), v[1], v[2])) for k, v in self._values.items() ]
+
+    def render(self):
+        out = self._header()
+        for k, (counts, count, total) in self._items():
+            cum = 0
+            for b, c in zip(self.buckets + (float("inf"),), counts):
+                cum += c
+                out.append("{}_bucket{} {}".format(self.name,
+                  _format_labels(k, [("le", _format_value(b))]), cum))
+            out.append("{}_count{} {}".format(self.name, _format_labels(k), count))
+            out.append("{}_sum{} {}".format(self.name, _format_labels(k), _format_value(total)))
+        return out
+
+    def _quantile(self, counts, count, q):
+        rank, cum = q * count, 0
+        for b, c in zip(self.buckets + (float("inf"),), counts):
+            cum += c
+            if cum >= rank: return b if b != float("inf") else self.buckets[-1]
+        return self.buckets[-1]
+
+    def snapshot(self):
+        out = {}
+        for k, (counts, count, total) in self._items():
+            out[_format_labels(k) or ""] = dict(count=count, sum=total,
+              mean=total/count if count else None,
+              p50=self._quantile(counts, count, 0.5),
+              p90=self._quantile(counts, count, 0.9),
+              p99=self._quantile(counts, count, 0.99))
+        return out
+
+class _Timer(object):
+    def __init__(self, hist, labels):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = _ti.time()
+        return self
+
+    def __exit__(self, *args):
+        self.hist.observe(_ti.time() - self.start, **self.labels)
+
+class Registry(object):
+    """
+    Collection of metrics, metrics are created on first use of their name
+    """
+    def __init__(self):
+        self._lock = _th.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, help, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, help, *args)
+            return self._metrics[name]
+
+    def counter(self, name, help=""):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=""):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help="", buckets=_default_buckets):
+        return self._get(Histogram, name, help, buckets)
+
+    def _sorted(self):
+        with self._lock:
+            return [ self._metrics[k] for k in sorted(self._metrics) ]
+
+    def render(self):
+        """
+        :returns: str -- all metrics in the Prometheus text format
+        """
+        lines = []
+        for m in self._sorted(): lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        :returns: dict -- current values by metric name and labels,
+                  histograms are summarized (count, sum, mean, quantiles)
+        """
+        return dict((m.name, m.snapshot()) for m in self._sorted())
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+render = registry.render
+snapshot = registry.snapshot
+
+def serve(port=9464, address="", reg=None):
+    """
+    Serve the metrics in the Prometheus text format at
+    http://address:port/metrics from a background thread
+
+    :param port: TCP port
+    :param address: listening address ("" for all interfaces)
+    :returns: the HTTP server, call shutdown() to stop it
+    """
+    try:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    except ImportError:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+    reg = reg or registry
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = reg.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((address, port), _Handler)
+    th = _th.Thread(target=server.serve_forever)
+    th.daemon = True
+    th.start()
+    return server
+
+def publish(process_object, interval=60., db=None, reg=None):
+    """
+    Write a summary document of the metrics every interval seconds::
+
+          { "type" : "metrics", "host" : <uuid.getnode()>, "metrics" : { ... } }
+
+    The document is written by the shared worker pool (see
+    :func:`pynedm.scheduler.get_worker`), not the scheduler thread.  A
+    document is skipped while the previous one is still being written.
+
+    :param process_object: :class:`pynedm.utils.ProcessObject` used to write
+    :param interval: time (s) between documents
+    :param db: database name, default is the database of process_object
+    :returns: :class:`pynedm.scheduler.ScheduledTask`, cancel() stops publishing
+    """
+    import uuid as _uuid
+    from .scheduler import get_scheduler, get_worker
+    reg = reg or registry
+    pending = [None]
+    def _publish():
+        if pending[0] is not None and not pending[0].done(): return
+        adoc = dict(type="metrics", host=_uuid.getnode(), metrics=reg.snapshot())
+        pending[0] = get_worker().submit("metrics", process_object.write_document_to_db,
+                                         adoc, db=db)
+    return get_scheduler().call_every(interval, _publish)
@@ -0,0 +1,331 @@
+import multiprocessing as _mp
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading as _th
+import traceback
+from . import metrics
+from .exception import PynEDMException
+from .log import log
+
+__all__ = [ "ProcessPool" ]
+
+_tasks = metrics.counter("pynedm_process_tasks_total",
+  "Tasks run in worker processes by result (ok, exception, timeout or died)")
+
+class _SharedArray(object):
+    """
+    Reference to an array in a file of the shared memory directory, passed
+    between processes instead of the data
+    """
+    def __init__(self, path, dtype, shape):
+        self.path = path
+        self.dtype = dtype
+        self.shape = shape
+
+    def load(self):
+        """
+        Map the array and remove its file (the mapping stays valid)
+        """
+        import numpy as np
+        arr = np.memmap(self.path, dtype=self.dtype, mode="r+", shape=self.shape)
+        os.unlink(self.path)
+        return arr
+
+def _share(v, directory, min_size, paths):
+    """
+    Replace NumPy arrays of at least min_size bytes in v (nested in lists,
+    tuples and dicts) by :class:`_SharedArray`, the paths of the files written
+    are appended to paths
+    """
+    np = sys.modules.get("numpy")
+    if np is None: return v
+
+    def _conv(x):
+        if isinstance(x, np.ndarray) and x.dtype.kind in "biufc" and \
+           x.nbytes >= max(min_size, 1):
+            fd, path = tempfile.mkstemp(dir=directory)
+            os.close(fd)
+            paths.append(path)
+            mm = np.memmap(path, dtype=x.dtype, mode="w+", shape=x.shape)
+            mm[...] = x
+            del mm
+            return _SharedArray(path, x.dtype.str, x.shape)
+        if isinstance(x, dict):
+            return dict((k, _conv(y)) for k, y in x.items())
+        if isinstance(x, (list, tuple)):
+            return type(x)(_conv(y) for y in x)
+        return x
+
+    return _conv(v)
+
+def _unshare(v):
+    """
+    Inverse of :func:`_share`
+    """
+    if isinstance(v, _SharedArray):
+        return v.load()
+    if isinstance(v, dict):
+        return dict((k, _unshare(y)) for k, y in v.items())
+    if isinstance(v, (list, tuple)):
+        return type(v)(_unshare(y) for y in v)
+    return v
+
+def _remove(paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+_fork_logged = False
+
+_guard_re = re.compile(r"""^if\s+__name__\s*==\s*['"]__main__['"]\s*:""", re.M)
+
+def _main_guarded():
+    """
+    Whether the main script may be imported by workers started with
+    forkserver or spawn: it guards its code with
+    if __name__ == "__main__":, or there is no script (interactive)
+    """
+    path = getattr(sys.modules.get("__main__"), "__file__", None)
+    if path is None: return True
+    try:
+        with open(path) as f:
+            return _guard_re.search(f.read()) is not None
+    except (IOError, OSError, UnicodeDecodeError):
+        return True
+
+def _context():
+    """
+    Multiprocessing context of the workers: forking a process that runs
+    other threads (e.g. the listener) can deadlock the child on locks held
+    by those threads, so the forkserver or spawn start methods are used
+    where available (python >= 3.4).  These import the main script in every
+    worker, which would start listening again unless the script is guarded
+    by if __name__ == "__main__":, otherwise workers are forked.
+    """
+    global _fork_logged
+    if not hasattr(_mp, "get_context"): return _mp
+    methods = _mp.get_all_start_methods()
+    if not _main_guarded() and "fork" in methods:
+        if not _fork_logged:
+            log("Main script has no 'if __name__ == \"__main__\":' guard, forking workers")
+            _fork_logged = True
+        return _mp.get_context("fork")
+    for method in ("forkserver", "spawn"):
+        if method in methods: return _mp.get_context(method)
+    return _mp
+
+def _worker_main(conn, directory, min_size):
+    """
+    Loop of a worker process: receive (func, args, kwargs), send ("ok",
+    result) or ("error", formatted traceback), until None is received
+    """
+    import signal
+    # Interrupts are handled by the parent, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, IOError):
+            break
+        if task is None: break
+        try:
+            func, args, kwargs = _unshare(task)
+            result = ("ok", _share(func(*args, **kwargs), directory, min_size, []))
+        except Exception:
+            result = ("error", traceback.format_exc())
+        try:
+            conn.send(result)
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+
+class _Worker(object):
+    def __init__(self, directory, min_size):
+        ctx = _context()
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child, directory, min_size))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.tasks = 0
+
+    def stop(self, kill=False):
+        try:
+            if kill:
+                self.process.terminate()
+            else:
+                self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.process.join()
+        self.conn.close()
+
+class ProcessPool(object):
+    """
+    Pool of worker processes running functions outside of the listening
+    process, so that CPU-bound functions (e.g. fits or FFTs) neither hold the
+    GIL of the listener nor are limited to one core.
+
+    Processes are started on demand up to processes and are replaced after
+    maxtasksperchild tasks, so that leaked memory is returned.  Processes are
+    started with forkserver or spawn if available (see :func:`_context`), so
+    functions must be defined at module level of an importable module (or of
+    the main script, which must then guard the code starting the listener
+    with if __name__ == "__main__":, otherwise workers are forked).  Functions and arguments are pickled.  NumPy arrays of
+    at least min_size bytes in the arguments and return value are passed
+    through files in /dev/shm (the temporary directory if it doesn't exist)
+    and arrive as :class:`numpy.memmap` instead of being pickled.  For
+    commands (see below) this applies to return values only, as their
+    arguments come from JSON documents; arrays in arguments are only passed
+    this way when calling :func:`call` directly.
+
+    Normally used via the "process" mode of :func:`pynedm.utils.listen`.
+
+    :param processes: maximum number of processes, default is the number of
+                      CPUs
+    :param maxtasksperchild: tasks run by a process before it is replaced,
+                             None to keep processes
+    :param min_size: minimum size (bytes) of arrays passed in shared memory
+    :type processes: int
+    :type maxtasksperchild: int
+    :type min_size: int
+    """
+    def __init__(self, processes=None, maxtasksperchild=100, min_size=64*1024):
+        if processes is None: processes = _mp.cpu_count()
+        if processes < 1:
+            raise PynEDMException("processes must be >= 1")
+        self.processes = processes
+        self.maxtasksperchild = maxtasksperchild
+        self.min_size = min_size
+        shm = "/dev/shm"
+        self._dir = tempfile.mkdtemp(prefix="pynedm-",
+                                     dir=shm if os.path.isdir(shm) else None)
+        self._cond = _th.Condition()
+        self._idle = []
+        self._busy = set()
+        self._workers = 0
+        self._closed = False
+        self._stats = dict(ok=0, exception=0, timeout=0, died=0, recycled=0)
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PynEDMException("Process pool has been closed")
+                if self._idle:
+                    worker = self._idle.pop()
+                    self._busy.add(worker)
+                    return worker
+                if self._workers < self.processes:
+                    self._workers += 1
+                    break
+                self._cond.wait()
+        try:
+            worker = _Worker(self._dir, self.min_size)
+        except:
+            self._release(None)
+            raise
+        with self._cond:
+            self._busy.add(worker)
+        return worker
+
+    def _release(self, worker, kill=False):
+        """
+        Return worker to the idle workers, or stop it if kill is set, the pool
+        is closed or it reached maxtasksperchild
+        """
+        with self._cond:
+            self._busy.discard(worker)
+            keep = worker is not None and not kill and not self._closed and \
+                   (self.maxtasksperchild is None or worker.tasks < self.maxtasksperchild)
+            if keep:
+                self._idle.append(worker)
+            else:
+                self._workers -= 1
+                if worker is not None and not kill and not self._closed:
+                    self._stats["recycled"] += 1
+            self._cond.notify()
+        if worker is not None and not keep: worker.stop(kill)
+
+    def _count(self, result):
+        with self._cond:
+            self._stats[result] += 1
+        _tasks.inc(result=result)
+
+    def call(self, func, args=(), kwargs=None, timeout=None):
+        """
+        Run func(*args, **kwargs) in a worker process and wait for the result
+
+        :param timeout: time (s) after which the process is killed, None to
+                        wait forever
+        :type timeout: float
+        :raises: :class:`pynedm.exception.PynEDMException` on timeout, if
+                 the function raised (with the traceback of the worker) or if
+                 the worker died
+        """
+        paths = []
+        try:
+            task = _share((func, tuple(args), kwargs or {}), self._dir, self.min_size, paths)
+            worker = self._acquire()
+            try:
+                worker.conn.send(task)
+            except Exception:
+                # Not picklable, nothing was sent
+                self._release(worker)
+                raise
+            worker.tasks += 1
+            if not worker.conn.poll(timeout):
+                self._release(worker, kill=True)
+                self._count("timeout")
+                raise PynEDMException("Timeout after {} s running {}".format(timeout,
+                  getattr(func, "__name__", func)))
+            try:
+                status, value = worker.conn.recv()
+            except (EOFError, IOError):
+                self._release(worker, kill=True)
+                self._count("died")
+                raise PynEDMException("Worker process exited (code {})".format(
+                  worker.process.exitcode))
+            self._release(worker)
+        finally:
+            _remove(paths)
+        if status == "error":
+            self._count("exception")
+            raise PynEDMException("Exception in worker process:\n" + value)
+        self._count("ok")
+        return _unshare(value)
+
+    def command(self, func, timeout=None):
+        """
+        :returns: function -- calls func(*args) with :func:`call`
+        """
+        def _run(*args):
+            return self.call(func, args, timeout=timeout)
+        return _run
+
+    def stats(self):
+        """
+        :returns: dict -- tasks by result, processes replaced after
+                  maxtasksperchild and running processes
+        """
+        with self._cond:
+            return dict(self._stats, workers=self._workers)
+
+    def close(self):
+        """
+        Stop the processes, tasks still running are killed
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._workers -= len(idle)
+            busy = list(self._busy)
+            self._cond.notify_all()
+        for worker in idle: worker.stop()
+        # The waiting callers see the processes exit
+        for worker in busy: worker.process.terminate()
+        shutil.rmtree(self._dir, ignore_errors=True)
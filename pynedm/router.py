@@ -0,0 +1,136 @@
+import threading as _th
+import traceback
+from .cancel import CancelToken
+from .listen import _iter_changes, _command_selector, _backoff, _reconnects, ShouldStop
+from .log import log, exception
+
+__all__ = [ "FeedRouter", "get_router" ]
+
+class _Route(object):
+    """
+    Subscription returned by :func:`FeedRouter.subscribe`
+    """
+    def __init__(self, router, keys, callback):
+        self.router = router
+        self.keys = list(keys)
+        self.callback = callback
+
+    def close(self):
+        """
+        Stop receiving changes
+        """
+        self.router._unsubscribe(self)
+
+class FeedRouter(object):
+    """
+    One continuous changes feed of a database, shared by all listeners of
+    the process.  The feed selects all unanswered commands with a Mango
+    selector (CouchDB >= 2.0) and each change is passed to the listeners
+    subscribed to its command key, looked up in a dictionary.  The server
+    thus runs one feed without a JavaScript filter, however many listeners
+    there are.
+
+    The feed runs in a background thread while there are subscriptions and
+    resumes from its last sequence after a connection loss.  Callbacks are
+    called in that thread and should return quickly.  When the last
+    subscription is closed, the feed stops and the router is dropped from
+    the routers of the process.
+
+    Normally obtained with :func:`get_router` and used by
+    :func:`pynedm.utils.listen` with feed_mode="shared".
+
+    :param db: database resource
+    :param account: identifies the credentials of db, see :func:`get_router`
+    """
+    def __init__(self, db, account=None):
+        self.db = db
+        self._key = (getattr(db, "uri", None) or id(db), account)
+        self._lock = _th.Lock()
+        self._routes = {}
+        self._token = None
+
+    def subscribe(self, keys, callback):
+        """
+        Pass changes of commands with one of keys to callback
+
+        :param keys: command keys
+        :param callback: func(change), change is a line of the changes feed
+                         including the document
+        :type keys: list
+        :returns: subscription, call its close() method to unsubscribe
+        """
+        route = _Route(self, keys, callback)
+        with _routers_lock, self._lock:
+            # Dropped after its last subscription was closed
+            _routers.setdefault(self._key, self)
+            for k in route.keys:
+                self._routes.setdefault(k, []).append(route)
+            if self._token is None:
+                seq = self.db.get().json()["update_seq"]
+                self._token = CancelToken()
+                th = _th.Thread(target=self._run, args=(self._token, seq))
+                th.daemon = True
+                th.start()
+        return route
+
+    def _unsubscribe(self, route):
+        with _routers_lock, self._lock:
+            for k in route.keys:
+                routes = self._routes.get(k, [])
+                if route in routes: routes.remove(route)
+                if not routes: self._routes.pop(k, None)
+            if self._routes: return
+            if _routers.get(self._key) is self: del _routers[self._key]
+            if self._token is None: return
+            token, self._token = self._token, None
+        token.cancel()
+
+    def _dispatch(self, line):
+        label = line.get("doc", {}).get("execute")
+        with self._lock:
+            routes = list(self._routes.get(label, ()))
+        for route in routes:
+            try:
+                route.callback(line)
+            except Exception:
+                exception("Exception routing command ({})".format(label))
+
+    def _run(self, token, seq):
+        errors = 0
+        params = dict(feed="continuous", heartbeat=2000, include_docs=True)
+        while not token.cancelled():
+            try:
+                for line in _iter_changes(self.db, dict(params, since=seq),
+                                          token, _command_selector()):
+                    errors = 0
+                    if line is None: continue
+                    if "id" not in line: continue
+                    self._dispatch(line)
+                    seq = line["seq"]
+            except ShouldStop:
+                break
+            except Exception:
+                log("Error in shared changes feed: {}".format(traceback.format_exc()))
+                _reconnects.inc(feed="shared")
+                token.wait(_backoff(errors))
+                errors += 1
+
+_routers = {}
+_routers_lock = _th.Lock()
+
+def get_router(db, account=None):
+    """
+    Routers are shared by the listeners of a database with the same account,
+    so that listeners logged in as different users don't receive commands
+    through each other's feed.
+
+    :param db: database resource
+    :param account: identifies the credentials used by db (e.g. the user name)
+    :returns: :class:`FeedRouter` -- the router of the process for database
+              db and account
+    """
+    key = (getattr(db, "uri", None) or id(db), account)
+    with _routers_lock:
+        if key not in _routers:
+            _routers[key] = FeedRouter(db, account)
+        return _routers[key]
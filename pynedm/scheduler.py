@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import threading as _th
+import time as _ti
+from .log import exception
+
+__all__ = [ "Scheduler", "get_scheduler", "get_worker" ]
+
+class ScheduledTask(object):
+    """
+    Handle returned by :func:`Scheduler.call_later` and
+    :func:`Scheduler.call_every`
+    """
+    def __init__(self, scheduler, when, interval, func, args, kwargs):
+        self.scheduler = scheduler
+        self.when = when
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Cancel the task, the scheduler thread is woken up immediately.
+        """
+        self.scheduler._cancel(self)
+
+class Scheduler(object):
+    """
+    Runs timed callbacks in a single thread, which sleeps until the next task
+    is due and is woken up whenever tasks are added or cancelled.  Callbacks
+    run in the scheduler thread and should return quickly, blocking work
+    (e.g. HTTP requests) is handed to the pool returned by :func:`get_worker`.
+
+    Normally the process-wide instance returned by :func:`get_scheduler` is
+    used.
+    """
+    def __init__(self):
+        self._cond = _th.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._thread = None
+
+    def call_later(self, delay, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) once after delay seconds
+
+        :returns: :class:`ScheduledTask`
+        """
+        return self._add(ScheduledTask(self, _ti.time() + delay, None, func, args, kwargs))
+
+    def call_every(self, interval, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) every interval seconds, the first call is
+        after one interval.  Calls missed while a callback was running are
+        skipped.
+
+        :returns: :class:`ScheduledTask`
+        """
+        return self._add(ScheduledTask(self, _ti.time() + interval, interval, func, args, kwargs))
+
+    def pending(self):
+        """
+        :returns: int -- number of scheduled tasks
+        """
+        with self._cond:
+            return len([t for _, _, t in self._heap if not t.cancelled])
+
+    def _add(self, task):
+        with self._cond:
+            heapq.heappush(self._heap, (task.when, next(self._counter), task))
+            if self._thread is None:
+                self._thread = _th.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return task
+
+    def _cancel(self, task):
+        with self._cond:
+            task.cancelled = True
+            self._heap = [x for x in self._heap if x[2] is not task]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def _next_task(self):
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                when, _, task = self._heap[0]
+                delay = when - _ti.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                if task.cancelled: continue
+                if task.interval is not None:
+                    now = _ti.time()
+                    while task.when <= now: task.when += task.interval
+                    heapq.heappush(self._heap, (task.when, next(self._counter), task))
+                return task
+
+    def _run(self):
+        while True:
+            task = self._next_task()
+            try:
+                task.func(*task.args, **task.kwargs)
+            except Exception:
+                exception("Exception in scheduled task")
+
+_scheduler = None
+_scheduler_lock = _th.Lock()
+
+def get_scheduler():
+    """
+    :returns: :class:`Scheduler` -- the scheduler shared by the whole process
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
+
+_worker = None
+
+def get_worker():
+    """
+    :returns: :class:`pynedm.executor.CommandExecutor` -- pool of threads
+              shared by the whole process, running the blocking work of
+              scheduled callbacks
+    """
+    global _worker
+    from .executor import CommandExecutor
+    with _scheduler_lock:
+        if _worker is None:
+            _worker = CommandExecutor(max_workers=4)
+        return _worker
@@ -0,0 +1,292 @@
+import sqlite3
+import threading as _th
+import uuid as _uuid
+import requests as _req
+from . import codec
+from .exception import PynEDMException
+from .log import log, exception
+
+__all__ = [ "WriteSpool" ]
+
+_sync_modes = dict(full="FULL", normal="NORMAL", off="OFF")
+
+def _should_spool(e):
+    """
+    Whether the failed write raising e should be spooled: the server could
+    not be reached, timed out or failed (5xx).  Other errors (e.g. a
+    rejected document) would fail again when replayed.
+    """
+    if isinstance(e, (_req.exceptions.ConnectionError, _req.exceptions.Timeout)):
+        return True
+    response = getattr(e, "response", None)
+    return isinstance(e, _req.exceptions.HTTPError) and response is not None \
+           and response.status_code >= 500
+
+def _with_id(adoc):
+    """
+    Return adoc with an "_id" (a copy if one is added).  Documents get their
+    id before the first attempt to write them, so that a document written by
+    a request whose response was lost is not written twice when replayed.
+    """
+    if "_id" in adoc: return adoc
+    adoc = dict(adoc)
+    adoc["_id"] = _uuid.uuid4().hex
+    return adoc
+
+class WriteSpool(object):
+    """
+    Durable local store (an SQLite database) for documents that could not be
+    written because the server was unreachable.  Spooled documents are
+    written again in bulk, with their original timestamps, once the server
+    is back: :func:`start` checks every retry_interval seconds using the
+    shared :class:`pynedm.scheduler.Scheduler` and replays in a background
+    thread.  Documents should have an "_id" (see :func:`_with_id`), a
+    conflict when replaying means the document was already written.
+
+    Documents may be spooled with attachments (the arrays offloaded by
+    :func:`pynedm.arrays.split_arrays`), which are uploaded after the
+    document is written.  If that fails, the document stays spooled and both
+    are written again later.
+
+    When the spool exceeds max_bytes, the oldest documents are dropped.
+
+    Normally used via :func:`pynedm.utils.ProcessObject.enable_spool`.
+
+    :param path: SQLite file
+    :param max_bytes: maximum size of the spooled documents (encoded JSON)
+    :param sync: "full" (fsync every write), "normal" (fsync at checkpoints,
+                 may lose the last writes on power loss) or "off"
+    :param batch_size: documents per bulk request when replaying
+    :param retry_interval: time (s) between attempts to replay
+    :type path: str
+    :type max_bytes: int
+    :type sync: str
+    :type batch_size: int
+    :type retry_interval: float
+    """
+    def __init__(self, path, max_bytes=1024**3, sync="normal", batch_size=500,
+                 retry_interval=5.):
+        if sync not in _sync_modes:
+            raise PynEDMException("sync must be one of {}".format(list(_sync_modes)))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self._lock = _th.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous={}".format(_sync_modes[sync]))
+        self._conn.execute("CREATE TABLE IF NOT EXISTS docs "
+                           "(id INTEGER PRIMARY KEY AUTOINCREMENT, db TEXT NOT NULL, doc BLOB NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS attachments "
+                           "(doc INTEGER NOT NULL, name TEXT NOT NULL, data BLOB NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS attachments_doc ON attachments (doc)")
+        self._conn.commit()
+        self._count, self._bytes = self._conn.execute(
+          "SELECT COUNT(*), COALESCE(SUM(LENGTH(doc)), 0) FROM docs").fetchone()
+        self._bytes += self._conn.execute(
+          "SELECT COALESCE(SUM(LENGTH(data)), 0) FROM attachments").fetchone()[0]
+        self._stats = dict(spooled=0, replayed=0, failed=0, dropped=0)
+        self._task = None
+        self._thread = None
+        self._replaying = False
+        self._closed = False
+
+    def extend(self, db_name, docs):
+        """
+        Add docs to be written to database db_name.  The documents should
+        carry their timestamp (see :func:`pynedm.writer._stamp`).
+        """
+        rows = [ (db_name, sqlite3.Binary(codec.dumpb(d))) for d in docs ]
+        with self._lock:
+            self._conn.executemany("INSERT INTO docs (db, doc) VALUES (?, ?)", rows)
+            self._added(len(rows), sum(len(r[1]) for r in rows))
+
+    def append(self, db_name, adoc, attachments=()):
+        """
+        Add one document, see :func:`extend`
+
+        :param attachments: (name, data) of attachments of the document,
+                            uploaded after it is written
+        :type attachments: list
+        """
+        data = sqlite3.Binary(codec.dumpb(adoc))
+        size = len(data)
+        with self._lock:
+            rowid = self._conn.execute("INSERT INTO docs (db, doc) VALUES (?, ?)",
+                                       (db_name, data)).lastrowid
+            for name, content in attachments:
+                content = sqlite3.Binary(content)
+                self._conn.execute("INSERT INTO attachments (doc, name, data) VALUES (?, ?, ?)",
+                                   (rowid, name, content))
+                size += len(content)
+            self._added(1, size)
+
+    def _added(self, n, size):
+        """
+        Count n rows of size bytes added (lock held) and commit
+        """
+        self._count += n
+        self._bytes += size
+        self._stats["spooled"] += n
+        if self._bytes > self.max_bytes: self._drop_oldest()
+        self._conn.commit()
+
+    def _delete(self, where, args):
+        """
+        Delete rows and their attachments (lock held, committed by the
+        caller), the counters are decreased by what was actually deleted
+
+        :returns: int -- number of deleted rows
+        """
+        size = self._conn.execute("SELECT COALESCE(SUM(LENGTH(doc)), 0) FROM docs WHERE "
+                                  + where, args).fetchone()[0]
+        docs = "SELECT id FROM docs WHERE " + where
+        size += self._conn.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM attachments "
+                                   "WHERE doc IN (" + docs + ")", args).fetchone()[0]
+        self._conn.execute("DELETE FROM attachments WHERE doc IN (" + docs + ")", args)
+        n = self._conn.execute("DELETE FROM docs WHERE " + where, args).rowcount
+        self._count -= n
+        self._bytes -= size
+        return n
+
+    def _drop_oldest(self):
+        excess = self._bytes - self.max_bytes
+        last = None
+        for rowid, size in self._conn.execute(
+          "SELECT id, LENGTH(doc) + (SELECT COALESCE(SUM(LENGTH(data)), 0) "
+          "FROM attachments WHERE doc = docs.id) FROM docs ORDER BY id"):
+            if excess <= 0: break
+            excess -= size
+            last = rowid
+        if last is None: return
+        dropped = self._delete("id <= ?", (last,))
+        self._stats["dropped"] += dropped
+        log("Write spool full, dropped {} oldest document(s)".format(dropped))
+
+    def stats(self):
+        """
+        :returns: dict -- documents spooled, replayed, failed (rejected by the
+                  server when replayed), dropped (spool full), pending, and
+                  bytes pending
+        """
+        with self._lock:
+            s = dict(self._stats)
+            s["pending"] = self._count
+            s["bytes"] = self._bytes
+        return s
+
+    def replay(self, get_db, upload=None):
+        """
+        Write the spooled documents, stops at the first bulk request that
+        fails to reach the server or when attachments fail to upload.
+
+        :param get_db: func(db_name) returning the database resource
+        :param upload: func(db_name, docid, attachments) uploading the
+                       (name, data) attachments of a written document,
+                       returns whether all were uploaded.  Required if
+                       documents were spooled with attachments.
+        :returns: bool -- whether the spool is empty
+        """
+        from .writer import _post_bulk
+        while True:
+            with self._lock:
+                if self._closed: return False
+                rows = self._conn.execute("SELECT id, db, doc FROM docs WHERE db = "
+                  "(SELECT db FROM docs ORDER BY id LIMIT 1) ORDER BY id LIMIT ?",
+                  (self.batch_size,)).fetchall()
+            if not rows: return True
+            db_name = rows[0][1]
+            docs = [ codec.loads(bytes(r[2])) for r in rows ]
+            try:
+                results = _post_bulk(get_db(db_name), docs)
+            except Exception as e:
+                log("Replaying spooled documents failed ({}), retrying later".format(e))
+                return False
+            # A conflict: written before, the response was lost
+            failed = [ (d, r) for d, r in zip(docs, results)
+                       if "error" in r and r["error"] != "conflict" ]
+            for d, r in failed:
+                log("Failed writing spooled doc ({}): {}".format(d, r))
+            if not self._upload_attachments(db_name, rows, docs, results, upload):
+                return False
+            with self._lock:
+                # Rows dropped meanwhile (spool full) are not counted twice
+                self._delete("db = ? AND id BETWEEN ? AND ?", (db_name, rows[0][0], rows[-1][0]))
+                self._conn.commit()
+                self._stats["replayed"] += len(rows) - len(failed)
+                self._stats["failed"] += len(failed)
+
+    def _upload_attachments(self, db_name, rows, docs, results, upload):
+        """
+        Upload the attachments of the written (or already written) documents
+        of a replayed batch
+
+        :returns: bool -- whether all were uploaded
+        """
+        written = dict((r[0], d["_id"]) for r, d, res in zip(rows, docs, results)
+                       if "error" not in res or res["error"] == "conflict")
+        with self._lock:
+            atts = self._conn.execute("SELECT doc, name, data FROM attachments WHERE doc "
+              "BETWEEN ? AND ? ORDER BY rowid", (rows[0][0], rows[-1][0])).fetchall()
+        by_doc = {}
+        for rowid, name, data in atts:
+            if rowid in written:
+                by_doc.setdefault(rowid, []).append((name, bytes(data)))
+        for rowid in sorted(by_doc):
+            docid = written[rowid]
+            try:
+                ok = upload is not None and upload(db_name, docid, by_doc[rowid])
+            except Exception as e:
+                log("Uploading spooled attachments of {} failed ({})".format(docid, e))
+                ok = False
+            if not ok:
+                log("Attachments of spooled doc {} not uploaded, retrying later".format(docid))
+                return False
+        return True
+
+    def start(self, get_db, upload=None):
+        """
+        Replay periodically (every retry_interval seconds)
+
+        :param get_db: func(db_name) returning the database resource
+        :param upload: uploads attachments, see :func:`replay`
+        """
+        from .scheduler import get_scheduler
+        if self._task is None:
+            self._task = get_scheduler().call_every(self.retry_interval, self._check,
+                                                    get_db, upload)
+
+    def _check(self, get_db, upload=None):
+        with self._lock:
+            if self._closed or self._replaying or self._count == 0: return
+            self._replaying = True
+            self._thread = _th.Thread(target=self._replay_thread, args=(get_db, upload))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _replay_thread(self, get_db, upload):
+        try:
+            self.replay(get_db, upload)
+        except Exception:
+            exception("Exception replaying spooled documents")
+        finally:
+            with self._lock:
+                self._replaying = False
+
+    def close(self):
+        """
+        Stop replaying and close the spool, pending documents are kept for
+        the next time it is opened.  Waits for a running replay to finish
+        its current batch.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        with self._lock:
+            self._closed = True
+            th = self._thread
+        if th is not None and th is not _th.current_thread():
+            th.join()
+        with self._lock:
+            self._conn.close()
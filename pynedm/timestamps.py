@@ -0,0 +1,16 @@
+import time as _ti
+
+__all__ = [ "iso_timestamp" ]
+
+def iso_timestamp(t=None):
+    """
+    ISO 8601 (UTC, ms precision) representation of UNIX time t, the format
+    of the timestamps set by nedm_default/_update/insert_with_timestamp
+
+    :param t: UNIX time, default is now
+    :type t: float
+    :returns: str -- e.g. "2016-05-04T12:00:00.000Z"
+    """
+    if t is None: t = _ti.time()
+    ms = int(round(t * 1000))
+    return _ti.strftime("%Y-%m-%dT%H:%M:%S", _ti.gmtime(ms // 1000)) + ".%03dZ" % (ms % 1000)
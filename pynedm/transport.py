@@ -0,0 +1,138 @@
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
+
+__all__ = [ "Transport" ]
+
+_idempotent = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+
+def _retry(retries, backoff_factor):
+    # The default of requests
+    if not retries: return 0
+    kw = dict(total=retries, connect=retries, read=retries, status=retries,
+              backoff_factor=backoff_factor, status_forcelist=(502, 503, 504),
+              raise_on_status=False)
+    try:
+        return Retry(allowed_methods=_idempotent, **kw)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=_idempotent, **kw)
+
+class _Adapter(HTTPAdapter):
+    """
+    HTTPAdapter applying a default timeout
+    """
+    def __init__(self, timeout, **kw):
+        self.timeout = timeout
+        HTTPAdapter.__init__(self, **kw)
+
+    def send(self, request, **kw):
+        if kw.get("timeout") is None: kw["timeout"] = self.timeout
+        return HTTPAdapter.send(self, request, **kw)
+
+class Transport(object):
+    """
+    Connection settings shared by all requests of a
+    :class:`pynedm.utils.ProcessObject`: the requests session of its account
+    and the curl handles of uploads.
+
+    Connections are kept alive and pooled, at most pool_maxsize per host.
+    Requests that fail to connect are retried, as are idempotent requests
+    (GET, HEAD, PUT, DELETE) failing while reading or with status 502, 503
+    or 504, waiting backoff_factor * 2**n seconds in between.
+
+    Uploads share DNS, TLS sessions and (with libcurl >= 7.57) connections
+    between curl handles.
+
+    :param pool_connections: number of hosts with pooled connections
+    :param pool_maxsize: connections kept per host
+    :param retries: retries per request
+    :param backoff_factor: base delay (s) between retries
+    :param connect_timeout: connect timeout (s), None to wait forever
+    :param read_timeout: timeout (s) waiting for data from the server,
+                         applies to requests without an explicit timeout.
+                         Must exceed the heartbeat of changes feeds (2 s).
+                         None to wait forever.
+    :param stall_timeout: time (s) after which uploads not transferring
+                          any data are aborted, None to wait forever
+    :param verify: verify TLS certificates (or path of a CA bundle)
+    :param keep_alive: enable TCP keep-alive probes for uploads
+    :type pool_connections: int
+    :type pool_maxsize: int
+    :type retries: int
+    :type backoff_factor: float
+    :type connect_timeout: float
+    :type read_timeout: float
+    :type stall_timeout: float
+    :type verify: bool or str
+    :type keep_alive: bool
+    """
+    def __init__(self, pool_connections=4, pool_maxsize=16, retries=3,
+                 backoff_factor=0.2, connect_timeout=5., read_timeout=60.,
+                 stall_timeout=None, verify=True, keep_alive=True):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.stall_timeout = stall_timeout
+        self.verify = verify
+        self.keep_alive = keep_alive
+        self._share = None
+
+    def mount(self, session):
+        """
+        Configure a :class:`requests.Session` to use these settings
+        """
+        adapter = _Adapter((self.connect_timeout, self.read_timeout),
+                           pool_connections=self.pool_connections,
+                           pool_maxsize=self.pool_maxsize,
+                           max_retries=_retry(self.retries, self.backoff_factor))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.verify = self.verify
+        return session
+
+    def _get_share(self):
+        import pycurl
+        if self._share is None:
+            self._share = pycurl.CurlShare()
+            for name in ("LOCK_DATA_DNS", "LOCK_DATA_SSL_SESSION", "LOCK_DATA_CONNECT"):
+                if hasattr(pycurl, name):
+                    self._share.setopt(pycurl.SH_SHARE, getattr(pycurl, name))
+        return self._share
+
+    def setup_multi(self, multi):
+        """
+        Configure a :class:`pycurl.CurlMulti`
+        """
+        import pycurl
+        if hasattr(pycurl, "M_MAX_HOST_CONNECTIONS"):
+            multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, self.pool_maxsize)
+        multi.setopt(pycurl.M_MAXCONNECTS, self.pool_maxsize * self.pool_connections)
+
+    def setup_curl(self, c):
+        """
+        Configure a :class:`pycurl.Curl` handle
+        """
+        import pycurl
+        share = self._get_share()
+        # The share survives reset() of the handle and can't be set twice
+        if getattr(c, "transport_share", None) is not share:
+            c.setopt(pycurl.SHARE, share)
+            c.transport_share = share
+        if self.connect_timeout is not None:
+            c.setopt(pycurl.CONNECTTIMEOUT_MS, int(self.connect_timeout * 1000))
+        if self.stall_timeout is not None:
+            c.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+            c.setopt(pycurl.LOW_SPEED_TIME, max(1, int(self.stall_timeout)))
+        if self.keep_alive and hasattr(pycurl, "TCP_KEEPALIVE"):
+            c.setopt(pycurl.TCP_KEEPALIVE, 1)
+        if self.verify is False:
+            c.setopt(pycurl.SSL_VERIFYPEER, 0)
+            c.setopt(pycurl.SSL_VERIFYHOST, 0)
+        elif self.verify is not True:
+            c.setopt(pycurl.CAINFO, self.verify)
@@ -0,0 +1,302 @@
+import io
+import json
+import mmap
+import threading as _th
+import time as _ti
+import pycurl
+from . import metrics
+from .log import log
+
+__all__ = [ "UploadEngine" ]
+
+_upload_bytes = metrics.counter("pynedm_upload_bytes_total",
+  "Bytes of attachments uploaded")
+_upload_retries = metrics.counter("pynedm_upload_retries_total",
+  "Failed upload attempts that were retried")
+
+class _MappedFile(object):
+    """
+    Read-only file-like view of a memory mapped file.  read returns slices of
+    a memoryview of the mapping, which pycurl copies from the page cache
+    straight into the buffer of libcurl, so the data isn't copied into bytes
+    objects.
+    """
+    def __init__(self, fp):
+        self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(self._map, "madvise"):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+        self._view = memoryview(self._map)
+        self._pos = 0
+
+    def seek(self, pos, whence=0):
+        if whence == 1: pos += self._pos
+        elif whence == 2: pos += len(self._view)
+        self._pos = max(0, min(pos, len(self._view)))
+
+    def tell(self):
+        return self._pos
+
+    def read(self, numbytes=-1):
+        end = len(self._view) if numbytes < 0 else min(self._pos + numbytes, len(self._view))
+        data = self._view[self._pos:end]
+        self._pos = end
+        return data
+
+    def close(self):
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # A slice is still referenced, the mapping is closed with it
+            pass
+
+def _open(name):
+    """
+    Open file name for uploading: memory mapped if possible (python 3, file
+    not empty), otherwise read in bytes objects
+    """
+    fp = open(name, "rb")
+    if not hasattr(memoryview, "cast"):
+        # Python 2: memoryview doesn't support mmap
+        return fp
+    try:
+        mapped = _MappedFile(fp)
+    except (ValueError, EnvironmentError):
+        # e.g. empty files can't be mapped
+        return fp
+    # The mapping stays valid
+    fp.close()
+    return mapped
+
+class _Upload(object):
+    """
+    State of one file being uploaded
+    """
+    def __init__(self, index, file_or_name, url):
+        self.index = index
+        self.url = url
+        self.fp = file_or_name
+        self.own_file = not hasattr(file_or_name, "read")
+        if self.own_file:
+            self.fp = _open(file_or_name)
+        self.fp.seek(0, 2)
+        self.total_size = self.fp.tell()
+        self.fp.seek(0)
+        self.sent = 0
+        self.attempts = 0
+        self.storage = None
+
+    def close(self):
+        if self.own_file: self.fp.close()
+
+def _cookie_header(session, url):
+    """
+    :returns: str -- Cookie header the requests session sends to url
+    """
+    import requests
+    return requests.cookies.get_cookie_header(session.cookies,
+                                              requests.Request("PUT", url)) or ""
+
+class UploadEngine(object):
+    """
+    Uploads files with PUT requests using a :class:`pycurl.CurlMulti` and a
+    pool of reused curl handles, so that several files are sent concurrently
+    and connections are kept alive between uploads.  Uploads may be called
+    from several threads at once, each call drives its own multi handle
+    (taken from a pool, keeping its connections).
+
+    An upload failing with a connection error or a server error (5xx) is
+    retried from the start: attachments can only be written as a whole.
+    Other responses (e.g. 409 conflict) are final.
+
+    Files given by name are memory mapped (python 3): libcurl asks for blocks
+    of buffer_size bytes through a Python read callback, which returns
+    slices of the mapping, so the data is copied from the page cache into
+    the buffer of libcurl without creating bytes objects.  Progress is taken
+    from libcurl's transfer info and reported at most every progress_interval
+    seconds.
+
+    Normally used via :func:`pynedm.utils.ProcessObject.upload_file` and
+    :func:`pynedm.utils.ProcessObject.upload_files`.
+
+    :param max_concurrent: maximum number of simultaneous uploads
+    :param retries: number of retries per file
+    :param buffer_size: upload buffer size requested from libcurl
+    :param progress_interval: minimum time (s) between progress callbacks
+    :param transport: connection settings applied to the curl handles
+    :type max_concurrent: int
+    :type retries: int
+    :type buffer_size: int
+    :type progress_interval: float
+    :type transport: :class:`pynedm.transport.Transport`
+    """
+    def __init__(self, max_concurrent=4, retries=3,
+                 buffer_size=1024*1024, progress_interval=0.1, transport=None):
+        self.max_concurrent = max_concurrent
+        self.retries = retries
+        self.buffer_size = buffer_size
+        self.progress_interval = progress_interval
+        self.transport = transport
+        self._multis = []
+        self._handles = []
+        self._lock = _th.Lock()
+
+    def close(self):
+        """
+        Release all idle curl handles
+        """
+        with self._lock:
+            for c in self._handles: c.close()
+            for m in self._multis: m.close()
+            self._handles = []
+            self._multis = []
+
+    def _get_multi(self):
+        with self._lock:
+            if self._multis: return self._multis.pop()
+        m = pycurl.CurlMulti()
+        if self.transport is not None: self.transport.setup_multi(m)
+        return m
+
+    def _get_handle(self):
+        with self._lock:
+            c = self._handles.pop() if self._handles else None
+        if c is None: return pycurl.Curl()
+        c.reset()
+        return c
+
+    def _release(self, multi, c):
+        """
+        Remove handle c from multi and return it to the pool
+        """
+        multi.remove_handle(c)
+        c.upload = None
+        with self._lock:
+            self._handles.append(c)
+
+    def _start(self, multi, up, cookies, progress):
+        c = self._get_handle()
+        up.attempts += 1
+        up.fp.seek(0)
+        up.sent = 0
+        up.storage = io.BytesIO()
+
+        def xferinfo(dltotal, dlnow, ultotal, ulnow):
+            up.sent = ulnow
+            progress()
+            return 0
+
+        c.setopt(pycurl.URL, up.url)
+        c.setopt(pycurl.UPLOAD, 1)
+        if self.transport is not None: self.transport.setup_curl(c)
+        c.setopt(pycurl.READFUNCTION, up.fp.read)
+        if hasattr(pycurl, "UPLOAD_BUFFERSIZE"):
+            c.setopt(pycurl.UPLOAD_BUFFERSIZE, self.buffer_size)
+        c.setopt(pycurl.NOPROGRESS, 0)
+        if hasattr(pycurl, "XFERINFOFUNCTION"):
+            c.setopt(pycurl.XFERINFOFUNCTION, xferinfo)
+        else:
+            c.setopt(pycurl.PROGRESSFUNCTION, xferinfo)
+        c.setopt(pycurl.INFILESIZE_LARGE, up.total_size)
+        c.setopt(pycurl.WRITEFUNCTION, up.storage.write)
+        c.setopt(pycurl.COOKIE, cookies(up.url))
+        c.upload = up
+        multi.add_handle(c)
+        return c
+
+    def upload(self, files, cookies="", callback=None, max_concurrent=None, retries=None,
+               session=None):
+        """
+        Upload files
+
+        :param files: list of (file_or_name, url) tuples
+        :param cookies: cookie header sent with every request
+        :param session: send the cookies this :class:`requests.Session` sends
+                        to each url instead, taken when each attempt starts
+        :param callback: progress callback, func(size_sent, total_size)
+                         summed over all files
+        :param max_concurrent: maximum number of simultaneous uploads,
+                               default is that of the engine
+        :param retries: number of retries per file, default is that of the
+                        engine
+        :type files: list
+        :type cookies: str
+        :type callback: func(size_sent, total_size)
+        :type max_concurrent: int
+        :type retries: int
+        :type session: :class:`requests.Session`
+        :returns: list of dict -- server response for each file, failed
+                  uploads give { "error" : True, "content" : reason }
+        """
+        if session is not None:
+            cookie_for = lambda url: _cookie_header(session, url)
+        else:
+            cookie_for = lambda url: cookies
+        multi = self._get_multi()
+        try:
+            return self._upload(multi, files, cookie_for, callback,
+              self.max_concurrent if max_concurrent is None else max_concurrent,
+              self.retries if retries is None else retries)
+        finally:
+            with self._lock:
+                self._multis.append(multi)
+
+    def _upload(self, multi, files, cookies, callback, max_concurrent, retries):
+        uploads = [_Upload(i, f, url) for i, (f, url) in enumerate(files)]
+        total_size = sum(up.total_size for up in uploads)
+        results = [None] * len(uploads)
+        todo = list(reversed(uploads))
+        active = []
+        last_progress = [0]
+
+        def progress(force=False):
+            if not callback: return
+            now = _ti.time()
+            if not force and now - last_progress[0] < self.progress_interval: return
+            last_progress[0] = now
+            callback(sum(up.sent for up in uploads), total_size)
+
+        def finish(c, errmsg):
+            active.remove(c)
+            up = c.upload
+            _upload_bytes.inc(up.sent)
+            status = c.getinfo(pycurl.RESPONSE_CODE)
+            content = up.storage.getvalue().decode("utf-8", "replace")
+            self._release(multi, c)
+            if errmsg is None and 200 <= status < 300:
+                up.sent = up.total_size
+                up.close()
+                try:
+                    results[up.index] = json.loads(content)
+                except ValueError:
+                    results[up.index] = { "error" : True, "content" : content }
+                return
+            reason = errmsg or "HTTP {}: {}".format(status, content)
+            if (errmsg is None and status < 500) or up.attempts > retries:
+                up.close()
+                results[up.index] = { "error" : True, "content" : reason }
+                return
+            _upload_retries.inc()
+            log("Upload of {} failed ({}), retrying".format(up.url, reason))
+            todo.append(up)
+
+        try:
+            while todo or active:
+                while todo and len(active) < max_concurrent:
+                    up = todo.pop()
+                    active.append(self._start(multi, up, cookies, progress))
+                while True:
+                    ret, _ = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM: break
+                while True:
+                    nq, ok, failed = multi.info_read()
+                    for c in ok: finish(c, None)
+                    for c, errno, errmsg in failed: finish(c, errmsg or str(errno))
+                    if nq == 0: break
+                if active: multi.select(1.0)
+            progress(True)
+        finally:
+            for c in list(active):
+                c.upload.close()
+                self._release(multi, c)
+        return results
@@ -2,13 +2,27 @@
 import logging
 import os
 import json
-from .fileutils import AttachmentFile
+import threading as _th
+import time
+import uuid as _uuid
+import weakref as _weakref
+from . import codec, metrics
+from .cancel import CancelToken, _accepts_token
+from .fileutils import AttachmentFile, RangeDownloader, _download_bytes
 from .exception import CommandCollision, PynEDMException, CommandError
 from .log import (debug, log, error, exception, listening_addresses)
 
 __all__ = ["ProcessObject", "stop_listening", "should_stop", "listen", "start_process" ]
 
+_write_seconds = metrics.histogram("pynedm_write_seconds",
+  "Duration of single document writes")
+_writes = metrics.counter("pynedm_writes_total",
+  "Documents passed to write_document_to_db by result")
+
 _should_stop = False
+# Tokens of all live ProcessObjects, cancelled by stop_listening()
+_tokens = _weakref.WeakSet()
+
 class ProcessObject(object):
     """
        Process object to listen for commands as well as interacting with the
@@ -19,20 +33,44 @@ class ProcessObject(object):
        :param password: password
        :param uri: address of server
        :param verbose: vebosity
+       :param heartbeat_interval: (optional) seconds between heartbeats while listening, default 10
+       :param array_attachment_size: (optional) NumPy arrays in documents of at
+                                     least this many bytes are stored as
+                                     binary attachments, default 64 kB (None
+                                     disables)
+       :param transport: (optional) connection settings (pooling, timeouts,
+                         retries, TLS) for all requests and uploads.  By
+                         default connections are pooled, but requests have
+                         no timeouts and are not retried.
+       :param cancel_token: (optional) token stopping this object, by default
+                            each object has its own, see :attr:`cancel_token`.
+                            Once cancelled, it is replaced by a new token
+                            when the object listens again.
        :type adb: str
        :type username: str
        :type password: str
        :type uri: str
        :type verbose: bool
+       :type heartbeat_interval: float
+       :type array_attachment_size: int
+       :type transport: :class:`pynedm.transport.Transport`
+       :type cancel_token: :class:`pynedm.cancel.CancelToken`
 
     """
 
     def __init__(self, uri=None, username=None, password=None, adb=None, verbose=False, **kw):
         import cloudant as _ca
+        from .transport import Transport
         self._currentInfo = {}
+        # Without a transport, keep the behavior of a plain session
+        self.transport = kw.get("transport", None) or \
+          Transport(retries=0, connect_timeout=None, read_timeout=None)
         acct = kw.get("acct", None)
+        if acct is not None and kw.get("transport", None) is not None:
+            self.transport.mount(acct._session)
         if acct is None:
             acct = _ca.Account(uri=uri)
+            self.transport.mount(acct._session)
             if username and password:
                 res = acct.login(username, password)
                 if res.status_code != 200:
@@ -40,21 +78,285 @@ class ProcessObject(object):
         self.isRunning = False
         self.verbose = verbose
         self.acct = acct
+        # Credentials of acct, listeners share a changes feed (feed_mode
+        # "shared") only with the same credentials
+        self._account = username if kw.get("acct", None) is None else id(acct)
         self.db = adb
+        self.executor = None
+        self.command_cache = None
+        self.process_pool = None
+        self.checkpoint = None
+        self.heartbeat_interval = kw.get("heartbeat_interval", 10)
+        self.array_attachment_size = kw.get("array_attachment_size", 64*1024)
+        self._heartbeat_task = None
+        self._heartbeat_post = None
+        self._last_write_latency = None
+        self._batch_kw = None
+        self._writers = {}
+        self._dispatchers = {}
+        self._upload_engine = None
+        self._aggregators = []
+        self.spool = None
+        self.deadband = None
+        self._batch_errors = []
+        self._writer_lock = _th.Lock()
+        self._finished = _th.Event()
+        self.cancel_token = kw.get("cancel_token", None) or CancelToken()
+        _tokens.add(self.cancel_token)
+
+    def enable_batch_writes(self, max_docs=500, max_age=1.0, max_queued=10000,
+                            overflow="block"):
+        """
+        Switch :func:`write_document_to_db` to batched mode: documents are
+        queued and written in bulk by a background thread (one per database),
+        see :class:`pynedm.writer.BufferedWriter` for the parameters.
+
+        In batched mode, :func:`write_document_to_db` returns immediately.
+        Failures of documents written with ignoreErrors=False are raised by
+        the next call to :func:`write_document_to_db`, :func:`flush` or
+        :func:`close`.  Call :func:`close` (or :func:`flush`) before exiting
+        to make sure all documents have been sent.
+
+        :param max_docs: maximum number of documents per bulk request
+        :param max_age: maximum time (s) a document waits in the queue
+        :param max_queued: maximum number of documents held in memory (per database)
+        :param overflow: "block", "drop_oldest" or "spool" (documents beyond
+                         max_queued go to the write spool, which must be
+                         enabled with :func:`enable_spool`)
+        :type max_docs: int
+        :type max_age: float
+        :type max_queued: int
+        :type overflow: str
+        """
+        self._batch_kw = dict(max_docs=max_docs, max_age=max_age,
+          max_queued=max_queued, overflow=overflow)
+
+    def enable_spool(self, path, max_bytes=1024**3, sync="normal", retry_interval=5.):
+        """
+        Keep documents that could not be written because the server was
+        unreachable (connection errors, timeouts and 5xx responses) in a
+        local spool (an SQLite file) and write them, with their original
+        timestamps, once the server is back.  This applies to direct and
+        batched writes; such writes return { "ok" : True, "spooled" : True }.
+        Documents are given an "_id" before they are first sent, so that a
+        write whose response was lost is not duplicated.  Arrays offloaded
+        as attachments (see :func:`write_document_to_db`) are spooled with
+        their document and uploaded when it is replayed.  Documents still
+        spooled at exit are written after the next call to enable_spool with
+        the same path.
+
+        See :class:`pynedm.spool.WriteSpool` for the parameters,
+        self.spool.stats() returns its counters.
+
+        :param path: spool file
+        :param max_bytes: maximum size of the spool, the oldest documents are dropped
+        :param sync: "full", "normal" or "off", how often the file is synced to disk
+        :param retry_interval: time (s) between attempts to write spooled documents
+        :type path: str
+        :type max_bytes: int
+        :type sync: str
+        :type retry_interval: float
+        """
+        from .spool import WriteSpool
+        self.spool = WriteSpool(path, max_bytes, sync, retry_interval=retry_interval)
+        self.spool.start(lambda db_name: self.acct[db_name], self._upload_spooled)
+
+    def _upload_spooled(self, db_name, docid, attachments):
+        """
+        Upload the (name, data) attachments of a replayed spooled document
+
+        :returns: bool -- whether all were uploaded
+        """
+        import io
+        failed = self._upload_arrays([(name, io.BytesIO(data)) for name, data in attachments],
+                                     docid, db_name)
+        if failed:
+            log("Error uploading arrays of spooled doc {}: {}".format(docid, failed))
+        return not failed
+
+    def enable_deadband(self, absolute=0., relative=0., max_silence=600., variables=None):
+        """
+        Filter the values of documents passed to :func:`write_document_to_db`:
+        values of the "value" field that did not change by more than a
+        threshold since the last one written are dropped, documents left
+        without values are not written (the write returns
+        { "ok" : True, "filtered" : True }).  Unchanged values are written
+        again after max_silence seconds.  Values count as written once the
+        document is written, queued or spooled.  Documents of aggregators
+        (see :func:`aggregator`) are not filtered.
+
+        See :class:`pynedm.deadband.DeadbandFilter` for the parameters,
+        self.deadband.reset() makes the next values be written.
+
+        :param absolute: absolute threshold
+        :param relative: threshold relative to the last written value
+        :param max_silence: maximum time (s) between writes of a variable
+        :param variables: thresholds for single variables,
+                          e.g. { "pressure" : { "relative" : 0.01 } }
+        :type absolute: float
+        :type relative: float
+        :type max_silence: float
+        :type variables: dict
+        """
+        from .deadband import DeadbandFilter
+        self.deadband = DeadbandFilter(absolute, relative, max_silence, variables)
+
+    def aggregator(self, window=10., raw_every=None, db=None, doc_type="data"):
+        """
+        Create a :class:`pynedm.aggregate.WindowAggregator`, which writes one
+        document with the statistics (min, max, mean, std, count) of the
+        samples of each window instead of one document per sample.  It is
+        flushed by :func:`close`.
+
+        Following code example::
 
-    def write_document_to_db(self, adoc, db=None, ignoreErrors=True):
+              o.enable_batch_writes()
+              agg = o.aggregator(window=10.)
+              while not o.should_stop():
+                  agg.add("temperature", read_temperature())
+              o.close()
+
+        :param window: length of the windows (s)
+        :param raw_every: also write every raw_every-th sample (as attachment)
+        :param db: database name
+        :param doc_type: "type" of the documents
+        :type window: float
+        :type raw_every: int
+        :type db: str
+        :type doc_type: str
+        :rtype: :class:`pynedm.aggregate.WindowAggregator`
+        """
+        from .aggregate import WindowAggregator
+        agg = WindowAggregator(self, window, raw_every, db, doc_type)
+        with self._writer_lock:
+            self._aggregators.append(agg)
+        return agg
+
+    def _get_writer(self, db_name):
+        from .writer import BufferedWriter
+        with self._writer_lock:
+            if db_name not in self._writers:
+                kw = self._batch_kw.copy()
+                if kw["overflow"] == "spool" and self.spool is None:
+                    raise PynEDMException("overflow='spool' requires enable_spool")
+                if self.spool is not None:
+                    kw["spool"] = lambda docs: self.spool.extend(db_name, docs)
+                self._writers[db_name] = BufferedWriter(self.acct[db_name], **kw)
+            return self._writers[db_name]
+
+    def _record_batch_error(self, fut):
+        if fut.exception() is not None:
+            with self._writer_lock:
+                self._batch_errors.append(fut.exception())
+
+    def _raise_batch_errors(self):
+        with self._writer_lock:
+            errs, self._batch_errors = self._batch_errors, []
+        if errs:
+            raise PynEDMException("{} batched write(s) failed, first error: {}".format(len(errs), errs[0]))
+
+    def flush(self):
+        """
+        Send all documents queued by batched writes and wait until done.
+
+        :raises: :class:`pynedm.exception.PynEDMException` if batched writes
+                 with ignoreErrors=False failed
+        """
+        with self._writer_lock:
+            writers = list(self._writers.values())
+        for w in writers:
+            w.flush()
+        self._raise_batch_errors()
+
+    def close(self):
+        """
+        Write the windows of aggregators, flush and stop the batched writers,
+        stop waiting for command responses and close the write spool.
+
+        :raises: :class:`pynedm.exception.PynEDMException` if batched writes
+                 with ignoreErrors=False failed
+        """
+        with self._writer_lock:
+            aggregators, self._aggregators = self._aggregators, []
+        for a in aggregators:
+            a.close()
+        with self._writer_lock:
+            writers, self._writers = list(self._writers.values()), {}
+            dispatchers, self._dispatchers = list(self._dispatchers.values()), {}
+        for d in dispatchers:
+            d.close()
+        for w in writers:
+            w.close()
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        self._raise_batch_errors()
+
+    def write_document_to_db(self, adoc, db=None, ignoreErrors=True, batch=None,
+                             attach_arrays=False, deadband=True):
         """
         Write a document to the database.
 
+        The document may contain NumPy arrays.  Arrays of at least
+        array_attachment_size bytes are uploaded as binary attachments of the
+        document after it is written and replaced in it by references (see
+        :func:`pynedm.arrays.split_arrays`), :func:`read_arrays` restores
+        them.  Such documents are always written directly, also when batched
+        writes are enabled.  The attachments are uploaded one after the
+        other, as each upload updates the document.  If one fails, the
+        document stays written: with ignoreErrors the response then has an
+        "error" and the names of the missing attachments in "failed_arrays".
+
         :param adoc: dictionary to be return to the DB.
         :param db: database name
         :param ignoreErrors: if True, do not reraise errors
+        :param batch: queue the write (see :func:`enable_batch_writes`),
+                      default is True if batched writes are enabled
+        :param attach_arrays: store all numeric arrays as attachments,
+                              regardless of array_attachment_size
+        :param deadband: apply the deadband filter, if enabled (see
+                         :func:`enable_deadband`)
         :type adoc: dict
         :type db: str
         :type ignoreErrors: bool
-        :returns: dict -- response from the server
+        :type batch: bool
+        :type attach_arrays: bool
+        :type deadband: bool
+        :returns: dict -- response from the server, { "ok" : True, "queued" : True }
+                  for batched writes, { "ok" : True, "filtered" : True } if
+                  dropped by the deadband filter (see :func:`enable_deadband`),
+                  {} if the document couldn't be written (with ignoreErrors)
         :raises: :class:`pynedm.exception.PynEDMException`
         """
+        dband = self.deadband if deadband else None
+        if dband is not None:
+            adoc = dband.filter(adoc, db if db is not None else self.db)
+            if adoc is None:
+                _writes.inc(result="filtered")
+                return { "ok" : True, "filtered" : True }
+        arrays = []
+        orig = adoc
+        min_size = 0 if attach_arrays else self.array_attachment_size
+        if min_size is not None:
+            from .arrays import split_arrays
+            adoc, arrays = split_arrays(adoc, min_size)
+        if batch is None:
+            batch = self._batch_kw is not None
+        if batch and not arrays:
+            if self._batch_kw is None:
+                raise PynEDMException("Batched writes not enabled")
+            db_name = db if db is not None else self.db
+            if db_name is None:
+                raise PynEDMException("Cannot write while not listening")
+            if not ignoreErrors:
+                self._raise_batch_errors()
+            fut = self._get_writer(db_name).write(adoc)
+            if not ignoreErrors:
+                fut.add_done_callback(self._record_batch_error)
+            if dband is not None: dband.record(orig, db_name)
+            _writes.inc(result="queued")
+            return { "ok" : True, "queued" : True }
+        db_name = db if db is not None else self.db
         try:
           if db is None:
             db = self.acct[self.db]
@@ -62,14 +364,61 @@ class ProcessObject(object):
             db = self.acct[db]
         except:
           raise PynEDMException("Cannot write while not listening")
+        upd = "_update/insert_with_timestamp"
+        if self.spool is not None and "_id" not in orig:
+          # Spooled with the same id, see enable_spool
+          docid = _uuid.uuid4().hex
+          upd += "/" + docid
+          orig = dict(orig, _id=docid)
         try:
-          return db.design("nedm_default").post("_update/insert_with_timestamp",params=adoc).json()
+          start = time.time()
+          r = db.design("nedm_default").post(upd, data=codec.dumpb(adoc))
+          if r.status_code >= 500: r.raise_for_status()
+          ret = r.json()
+          self._last_write_latency = time.time() - start
+          _write_seconds.observe(self._last_write_latency)
+          _writes.inc(result="ok" if "ok" in ret else "error")
         except Exception as e:
+          from .spool import _should_spool
+          if self.spool is not None and _should_spool(e):
+            from .writer import _stamp
+            # The document as written, its arrays are uploaded when replayed
+            self.spool.append(db_name, _stamp(dict(adoc, _id=orig["_id"])),
+                              [(name, r.read()) for name, r in arrays])
+            if dband is not None: dband.record(orig, db_name)
+            _writes.inc(result="spooled")
+            log("Server unreachable ({}), spooled doc".format(e))
+            return { "ok" : True, "spooled" : True }
+          _writes.inc(result="error")
           if ignoreErrors:
             log("Exception ({}) when posting doc({})".format(e,adoc))
             return {}
             pass
           else: raise
+        if dband is not None and "ok" in ret:
+          dband.record(orig, db_name)
+        if arrays and "id" in ret:
+          failed = self._upload_arrays(arrays, ret["id"], db_name)
+          if failed:
+            msg = "Error uploading arrays of {}: {}".format(ret["id"], failed)
+            if not ignoreErrors: raise PynEDMException(msg)
+            log(msg)
+            ret = dict(ret, error=msg, failed_arrays=list(failed))
+        return ret
+
+    def _upload_arrays(self, arrays, docid, db):
+        """
+        Upload the (attachment name, reader) pairs of arrays sequentially
+
+        :returns: dict -- error of each attachment that failed, by name
+        """
+        try:
+            res = self.upload_files([(r, name) for name, r in arrays], docid, db,
+                                    max_concurrent=1)
+        except Exception as e:
+            res = [{ "error" : True, "content" : str(e) }] * len(arrays)
+        return dict((name, r.get("content", r["error"]))
+                    for (name, _), r in zip(arrays, res) if "error" in r)
 
     def _attachment_path(self, docid, attachment_name, db=None):
         """
@@ -97,13 +446,15 @@ class ProcessObject(object):
         delete_url = self._attachment_path(docid, attachment_name, db)
         return self.acct.delete(delete_url).json()
 
-    def open_file(self, docid, attachment_name, db=None):
+    def open_file(self, docid, attachment_name, db=None, **kw):
         """
         open file for reading, allows reading ranges of data.
 
         :param docid: document id
         :param attachment_name: name of attachment
         :param db: name of database
+        :param kw: block cache settings (block_size, cache_size, read_ahead)
+                   passed to :class:`pynedm.fileutils.AttachmentFile`
         :type docid: str
         :type attachment_name: str
         :type db: str
@@ -117,18 +468,103 @@ class ProcessObject(object):
                _db = "nedm%2Fhg_laser"
                x = o.open_file(_doc, _fn, db=_db)
                y = x.read(4)
-               print len(y), y # should be equal
+               print(len(y), y) # should be equal
 
-               print x.read()
+               print(x.read())
                x.seek(1)
                for i in x.iterate(10):
-                   print i
+                   print(i)
         """
         download_url = self._attachment_path(docid, attachment_name, db)
-        return AttachmentFile(self.acct[download_url])
+        return AttachmentFile(self.acct[download_url], **kw)
+
+
+    def read_array(self, docid, ref, db=None, start=None, stop=None):
+        """
+        Read an array stored as attachment by :func:`write_document_to_db`.
+        Only the requested rows are downloaded, the data is not copied or
+        decoded.
+
+        :param docid: document id
+        :param ref: array reference, the "_ndarray" field replacing the array
+                    in the document
+        :param db: name of database
+        :param start: first row (along the first axis)
+        :param stop: end row (exclusive)
+        :type docid: str
+        :type ref: dict
+        :type db: str
+        :type start: int
+        :type stop: int
+        :rtype: :class:`numpy.ndarray`
+        """
+        from .arrays import read_array
+        return read_array(self.open_file(docid, ref["attachment"], db, block_size=0),
+                          ref, start, stop)
+
+    def read_arrays(self, adoc, db=None):
+        """
+        Return a copy of document adoc (as read from the database) with the
+        arrays stored as attachments restored.
+
+        :param adoc: document including its "_id"
+        :param db: name of database
+        :type adoc: dict
+        :type db: str
+        :returns: dict
+        """
+        from .arrays import join_arrays
+        return join_arrays(adoc, lambda ref: self.read_array(adoc["_id"], ref, db))
 
+    def read_data(self, variables, start, end, db=None, chunk_size=10000, prefetch=2):
+        """
+        Read the values of variables from data documents with timestamps in
+        [start, end), requesting chunks of about chunk_size values ahead
+        while the previous ones are decoded.  Requires the view installed by
+        :func:`pynedm.export.install_view`, see
+        :class:`pynedm.export.DataExporter`.
+
+        Following code example::
+
+              import time
+              o = ProcessObject(...)
+              data = o.read_data(["temperature"], time.time() - 7*86400, time.time())
+              times, values = data["temperature"]
+
+        :param variables: variable names (keys of the "value" field)
+        :param start: start time, UNIX time, datetime (UTC) or ISO 8601 string
+        :param end: end time (exclusive)
+        :param db: name of database
+        :param chunk_size: approximate number of values per request.  This is
+                           an estimate: the time range is split into equal
+                           intervals from the total number of values, so
+                           chunks of bursty data may be much larger.
+        :param prefetch: number of chunks requested ahead
+        :type variables: list
+        :type db: str
+        :type chunk_size: int
+        :type prefetch: int
+        :returns: dict -- { variable : (times, values) }, float64 NumPy arrays
+                  of UNIX times and values
+        """
+        from .export import DataExporter
+        db = self.acct[db if db is not None else self.db]
+        return DataExporter(db, chunk_size, prefetch).read(variables, start, end)
 
-    def download_file(self, docid, attachment_name, db=None, chunk_size=100*1024, headers=None):
+    def iter_data(self, variable, start, end, db=None, chunk_size=10000, prefetch=2):
+        """
+        Like :func:`read_data` for one variable, but yields the values chunk
+        by chunk, so that memory use does not depend on the length of the
+        time range.
+
+        :returns: generator yielding (times, values) -- float64 NumPy arrays
+        """
+        from .export import DataExporter
+        db = self.acct[db if db is not None else self.db]
+        return DataExporter(db, chunk_size, prefetch).iter_batches(variable, start, end)
+
+    def download_file(self, docid, attachment_name, db=None, chunk_size=100*1024, headers=None,
+                      workers=1, range_size=8*1024*1024):
         """
         download file associated with docid, yields the data in chunks first
         data yielded is the total expected size, the rest is the data from the
@@ -137,11 +573,15 @@ class ProcessObject(object):
         :param docid: document id
         :param db: database name
         :param chunk_size: size of chunks to yield
-        :param headers: HTTP headers forwarded to :mod:`requests`
+        :param headers: HTTP headers forwarded to :mod:`requests` (single connection only)
+        :param workers: if > 1, download ranges in parallel with this many connections
+        :param range_size: size of each range for parallel downloads
         :type docid: str
         :type db: str
         :type chunk_size: int
         :type headers: dict
+        :type workers: int
+        :type range_size: int
         :returns: dict -- response from the server
 
         Following code example::
@@ -149,7 +589,7 @@ class ProcessObject(object):
                 from clint.textui.progress import Bar as ProgressBar
                 total_size = None
                 x = process_object.download_file("docid", "attachment", "mydb")
-                bar = ProgressBar(expected_size=x.next(), filled_char='=')
+                bar = ProgressBar(expected_size=next(x), filled_char='=')
                 total = 0
                 with open("temp_file.out", "wb") as o:
                     for ch in x:
@@ -159,11 +599,47 @@ class ProcessObject(object):
                         o.flush()
         """
         download_url = self._attachment_path(docid, attachment_name, db)
+        if workers > 1:
+            for chunk in RangeDownloader(self.acct[download_url], workers,
+                                         range_size).iterate(chunk_size):
+                yield chunk
+            return
         if headers is None: headers = {}
         r = self.acct.get(download_url, stream=True, headers=headers)
         yield int(r.headers['content-length'])
         for chunk in r.iter_content(chunk_size=chunk_size):
-            if chunk: yield chunk
+            if chunk:
+                _download_bytes.inc(len(chunk))
+                yield chunk
+
+    def download_to_file(self, docid, attachment_name, filename, db=None, workers=1,
+                         range_size=8*1024*1024, callback=None, resume=True):
+        """
+        download file associated with docid to a local file, using range
+        requests (in parallel with workers > 1).  If interrupted, calling
+        again with the same arguments resumes the download.
+
+        :param docid: document id
+        :param attachment_name: name of attachment
+        :param filename: local output file
+        :param db: database name
+        :param workers: number of parallel connections
+        :param range_size: size of each range in bytes
+        :param callback: progress callback, func(size_downloaded, total_size)
+        :param resume: continue a previous partial download
+        :type docid: str
+        :type attachment_name: str
+        :type filename: str
+        :type db: str
+        :type workers: int
+        :type range_size: int
+        :type callback: func(size_downloaded, total_size)
+        :type resume: bool
+        :raises: :class:`pynedm.exception.PynEDMNoFile`
+        """
+        download_url = self._attachment_path(docid, attachment_name, db)
+        RangeDownloader(self.acct[download_url], workers, range_size).to_file(
+          filename, callback, resume)
 
     def upload_file(self, file_or_name, docid, db=None,attachment_name=None,callback=None):
         """
@@ -180,62 +656,59 @@ class ProcessObject(object):
         :type callback: func(size_read, total_size)
         :type attachment_name: str
         """
-        actual_file = file_or_name
-        if not hasattr(file_or_name, "read"):
-            # Assume it's a file-like object
-            if not attachment_name:
-                attachment_name = os.path.basename(file_or_name)
-            actual_file = open(file_or_name, "rb")
-        elif not attachment_name:
-            raise PynEDMException("Must include attachment name for file-like objects")
-
-        # Get file size
-        actual_file.seek(0, 2)
-        total_size = actual_file.tell()
-        actual_file.seek(0)
-
-        post_to_url = self._attachment_path(docid, attachment_name, db)
-
-        cookies = '; '.join(['='.join(x) for x in self.acct._session.cookies.items()])
-
-        import pycurl
-        from StringIO import StringIO
-
-
-
-        class FileReader:
-            def __init__(self, fp, callback = None):
-                self.fp = fp
-                self.total_read = 0
-                self.cbck = callback
-            def read_callback(self, size):
-                x = self.fp.read(size)
-                if x is not None:
-                    self.total_read += len(x)
-                    if self.cbck: self.cbck(self.total_read, total_size)
-                return x
-
-        c = pycurl.Curl()
-        storage = StringIO()
-        c.setopt(pycurl.URL, post_to_url)
-        c.setopt(pycurl.PUT, 1)
-        c.setopt(pycurl.READFUNCTION, FileReader(actual_file, callback).read_callback)
-        c.setopt(pycurl.INFILESIZE, total_size)
-        c.setopt(c.WRITEFUNCTION, storage.write)
-        c.setopt(c.COOKIE, cookies)
-
-        c.perform()
-        c.close()
-        content = storage.getvalue()
-        try:
-            return json.loads(content)
-        except:
-            return { "error" : True, "content" : content }
+        return self.upload_files([(file_or_name, attachment_name)], docid, db, callback)[0]
+
+    def upload_files(self, files, docid, db=None, callback=None, max_concurrent=4, retries=3):
+        """
+        Upload several files associated with a particular doc id concurrently.
+        Curl handles and connections are reused between uploads, failed
+        uploads are retried (see :class:`pynedm.upload.UploadEngine`).
+
+        :param files: list of file names, file-like objects or
+                      (file_or_name, attachment_name) tuples
+        :param docid: id of document
+        :param db: name of database
+        :param callback: upload callback for the total of all files,
+                         should be of form: func(size_read, total_size)
+        :param max_concurrent: maximum number of simultaneous uploads
+        :param retries: number of retries per file
+        :type files: list
+        :type docid: str
+        :type db: str
+        :type callback: func(size_read, total_size)
+        :type max_concurrent: int
+        :type retries: int
+        :returns: list of dict -- server response for each file
+        """
+        jobs = []
+        for f in files:
+            file_or_name, attachment_name = f if type(f) == tuple else (f, None)
+            if not hasattr(file_or_name, "read"):
+                if not attachment_name:
+                    attachment_name = os.path.basename(file_or_name)
+            elif not attachment_name:
+                raise PynEDMException("Must include attachment name for file-like objects")
+            jobs.append((file_or_name, self._attachment_path(docid, attachment_name, db)))
+
+        return self._get_upload_engine().upload(jobs, callback=callback,
+                                                max_concurrent=max_concurrent,
+                                                retries=retries,
+                                                session=self.acct._session)
+
+    def _get_upload_engine(self):
+        from .upload import UploadEngine
+        with self._writer_lock:
+            if self._upload_engine is None:
+                self._upload_engine = UploadEngine(transport=self.transport)
+            return self._upload_engine
 
     def send_command(self, cmd_name, *args, **kwargs):
         """
         Send command, raises exception if timeout or if an exception occurs in
-        remotely-called function.
+        remotely-called function.  Responses for all commands sent to a
+        database are received through one shared changes feed (see
+        :class:`pynedm.dispatch.ResponseDispatcher`), so this may be called
+        from many threads in parallel.
 
         :param cmd_name: Name of command
         :param args: arguments to command
@@ -251,22 +724,22 @@ class ProcessObject(object):
 
                 o = ProcessObject(...)
                 # Gives by IP
-                print o.send_command("temp-control.1.nedm1_d.ip_get")
+                print(o.send_command("temp-control.1.nedm1_d.ip_get"))
 
                 # Choosing another database, timeout.
-                print o.send_command("getvoltage", 1, db="nedm%2Finternal_coils", timeout=4000)
+                print(o.send_command("getvoltage", 1, db="nedm%2Finternal_coils", timeout=4000))
 
                 try:
                   # Will raise error (not enough arguments)
-                  print o.send_command("getvoltage", db="nedm%2Finternal_coils", timeout=4000)
+                  print(o.send_command("getvoltage", db="nedm%2Finternal_coils", timeout=4000))
                 except:
                   traceback.print_exc()
 
                 try:
                   # Will raise timeout (command doesn't exist)
-                  print o.send_command("get_voltage",
+                  print(o.send_command("get_voltage",
                     db="nedm%2Finternal_coils",
-                    timeout=4000)
+                    timeout=4000))
                 except:
                   traceback.print_exc()
         """
@@ -274,30 +747,79 @@ class ProcessObject(object):
         timeout = kwargs.get("timeout", 10000)
         db = self.acct[db_name]
 
-        ret = self.write_document_to_db( {
-               "type" : "command",
-            "execute" : cmd_name,
-          "arguments" : args }, db_name, ignoreErrors=False)
+        docid = _uuid.uuid4().hex
+        fut = self._get_dispatcher(db_name).expect(docid, timeout/1000.)
+        try:
+            ret = db.design("nedm_default").post("_update/insert_with_timestamp/" + docid,
+              data=codec.dumpb({
+                   "type" : "command",
+                "execute" : cmd_name,
+              "arguments" : args })).json()
+        except Exception:
+            self._get_dispatcher(db_name).cancel(docid)
+            raise
 
         if "ok" not in ret:
+            self._get_dispatcher(db_name).cancel(docid)
             raise CommandError("Error saving document")
 
-        for l in db.changes(params=dict(
-              filter="_doc_ids",
-              timeout=timeout,
-              feed="continuous",
-              include_docs=True,
-              doc_ids=[ ret["id"] ]
-            )):
-            if 'doc' not in l: continue
-            if 'response' not in l['doc']: continue
-            resp = l['doc']['response']
-            exc = "Exception"
-            if resp["content"][:len(exc)] == exc:
-                raise CommandError(resp["content"])
-            return resp["return"]
+        try:
+            return fut.result(timeout/1000.)
+        except CommandError:
+            raise
+        except PynEDMException:
+            self._get_dispatcher(db_name).cancel(docid)
+            raise CommandError("Timeout")
+
+    def send_commands(self, commands, db=None, timeout=10000):
+        """
+        Send several commands with one bulk request.  The responses are
+        awaited via the same changes feed as :func:`send_command`.
 
-        raise CommandError("Timeout")
+        :param commands: list of (cmd_name, arguments) tuples, arguments is a
+                         list (or tuple) of arguments or a single argument
+        :param db: name of database
+        :param timeout: how much time to wait in ms, default 10000 (10 seconds)
+        :type commands: list
+        :type db: str
+        :type timeout: int
+        :returns: list of :class:`pynedm.future.Future` -- one per command,
+                  resolving to the return of the remotely-called function or
+                  raising :class:`pynedm.exception.CommandError`
+
+        Following code example::
+
+                o = ProcessObject(...)
+                futs = o.send_commands([ ("getvoltage", [i]) for i in range(50) ],
+                                       db="nedm%2Finternal_coils")
+                print([f.result() for f in futs])
+        """
+        from .writer import _post_bulk, _stamp
+        db_name = db if db is not None else self.db
+        dispatcher = self._get_dispatcher(db_name)
+        docs = [ _stamp({ "_id" : _uuid.uuid4().hex,
+                          "type" : "command",
+                          "execute" : cmd_name,
+                          "arguments" : list(args) if isinstance(args, (list, tuple)) else [args] })
+                 for cmd_name, args in commands ]
+        futs = [ dispatcher.expect(d["_id"], timeout/1000.) for d in docs ]
+        try:
+            results = _post_bulk(self.acct[db_name], docs)
+        except Exception:
+            for d in docs: dispatcher.cancel(d["_id"])
+            raise
+        for d, res in zip(docs, results):
+            if "error" in res:
+                dispatcher.cancel(d["_id"],
+                  CommandError("Error saving document ({})".format(res["error"])))
+        return futs
+
+    def _get_dispatcher(self, db_name):
+        from .dispatch import ResponseDispatcher
+        with self._writer_lock:
+            if db_name not in self._dispatchers:
+                self._dispatchers[db_name] = ResponseDispatcher(self.acct[db_name])
+            return self._dispatchers[db_name]
 
 
 
@@ -307,11 +829,8 @@ class ProcessObject(object):
         be stopped also by calling :func:`stop_listening`
         """
         if "thread" not in self._currentInfo: return
-        th = self._currentInfo["thread"]
-        while th.isAlive():
-          th.join(0.1)
-          if should_stop():
-            self.__remove_commands_doc()
+        # Timed waits keep the main thread responsive to signals
+        while not self._finished.wait(1.0): pass
         self.__remove_commands_doc()
 
     def __check_keys(self,docid):
@@ -334,24 +853,108 @@ You have tried to use command keys that are in use!
 """
             raise CommandCollision(conflict_str)
 
-    def run(self, func_dic_copy, docid):
+    def run(self, func_dic_copy, docid, max_workers=4, limits=None, checkpoint=None,
+            feed_mode="filter", cache_ttls=None, cache_size=256, process_commands=None,
+            processes=None, maxtasksperchild=100):
         if self.isRunning: return
         self.isRunning = True
+        if self.cancel_token.cancelled():
+            # Stopped before, tokens can't be reset
+            self.cancel_token = CancelToken()
+            _tokens.add(self.cancel_token)
         db = self.acct[self.db]
-        from .listen import _watch_changes_feed
-        import threading as _th
+        from .cache import ResultCache
+        from .checkpoint import FeedCheckpoint
+        from .executor import CommandExecutor
+        self.executor = CommandExecutor(max_workers, limits)
+        self.command_cache = ResultCache(cache_ttls, cache_size)
+        if process_commands:
+            from .procpool import ProcessPool
+            self.process_pool = ProcessPool(processes, maxtasksperchild)
+            func_dic_copy = func_dic_copy.copy()
+            for k, timeout in process_commands.items():
+                func_dic_copy[k] = self.process_pool.command(func_dic_copy[k], timeout)
+        self.checkpoint = FeedCheckpoint(checkpoint)
+        if self.checkpoint.seq is None:
+            # Start the feed from here, so that commands sent as soon as
+            # listen() returns are not missed
+            self.checkpoint.advance(db.get().json()["update_seq"])
         self._currentInfo = {
           "doc_name": docid,
-          "thread"  : _th.Thread(target=_watch_changes_feed, args=(db, func_dic_copy, self.verbose))
+          "thread"  : _th.Thread(target=self._listen_thread, args=(db, func_dic_copy, feed_mode))
         }
+        self._finished.clear()
         self.__check_keys(docid)
 
         self._currentInfo["thread"].daemon = True
         self._currentInfo["thread"].start()
 
+    def _listen_thread(self, db, func_dic_copy, feed_mode):
+        heartbeat = None
+        try:
+            from .listen import _watch_changes_feed
+            from .scheduler import get_scheduler
+            heartbeat = self._heartbeat_task = get_scheduler().call_every(
+              self.heartbeat_interval, self._heartbeat, db, [time.time(), 0])
+            _watch_changes_feed(db, func_dic_copy, self.verbose, self.executor,
+              self.cancel_token, self.checkpoint, feed_mode, self.command_cache,
+              self._account)
+        finally:
+            if heartbeat is not None: heartbeat.cancel()
+            if self.process_pool is not None: self.process_pool.close()
+            self.isRunning = False
+            self._finished.set()
+
+    def _heartbeat(self, db, last):
+        """
+        Post heartbeat document, called by the shared scheduler.  The document
+        carries the load of the listener: commands queued/running, commands
+        per second since the last heartbeat, and the latency (s) of the last
+        write.  The POST runs in the shared worker pool so that it doesn't
+        hold up the scheduler, a heartbeat is skipped while the previous one
+        is still being posted.
+
+        last is [time, commands submitted] of the previous heartbeat
+        """
+        if self._heartbeat_post is not None and not self._heartbeat_post.done():
+            return
+        now = time.time()
+        st = self.executor.stats()
+        load = dict(queued=st["queued"] + st["deferred"],
+                    running=st["running"],
+                    commands_per_s=(st["submitted"] - last[1])/(now - last[0]),
+                    mean_wait=st["mean_wait"],
+                    last_write_latency=self._last_write_latency)
+        last[:] = [now, st["submitted"]]
+        adoc = { "type" : "heartbeat", "load" : load }
+        from .scheduler import get_worker
+        self._heartbeat_post = get_worker().submit("heartbeat", self._post_heartbeat, db, adoc)
+
+    def _post_heartbeat(self, db, adoc):
+        try:
+            db.design("nedm_default").post("_update/insert_with_timestamp/heartbeat_" + str(_uuid.getnode()),
+              data=codec.dumpb(adoc), timeout=self.heartbeat_interval)
+        except:
+            exception("Heartbeat exception")
+
     def stop_listening(self):
+        """
+        Stop listening of this object only, other listeners in the process
+        continue.  Cancels :attr:`cancel_token`, which immediately closes the
+        changes feed and is seen by running commands that accept a
+        cancel_token.  Use :func:`wait` to wait until the listener has stopped.
+        """
+        self.cancel_token.cancel()
         self.__remove_commands_doc()
 
+    def should_stop(self):
+        """
+        Returns whether or not this object has been stopped.
+
+        :rtype: bool
+        """
+        return self.cancel_token.cancelled()
+
     def __remove_commands_doc(self):
         import requests as _req
         if not "doc_name" in self._currentInfo: return
@@ -371,31 +974,55 @@ You have tried to use command keys that are in use!
         del self._currentInfo["doc_name"]
 
     def __del__(self):
-        stop_listening(True)
+        if not hasattr(self, "cancel_token"): return
+        self.cancel_token.cancel()
         self.wait()
 
 def start_process(func, *args, **kwargs):
-    import Queue as _q
-    import threading as _th
+    """
+    Run func(*args, **kwargs) in a thread.  The returned thread has a result
+    queue receiving the return value, a cancel_token and a cancel() method.
+
+    Cancellation is cooperative: if func accepts a cancel_token argument, it
+    is passed the token and should return when the token is cancelled.  A
+    cancel_token passed in kwargs (e.g. the one given to a command) is used
+    as parent, so cancelling it also cancels the process.
+
+    :rtype: :class:`threading.Thread`
+    """
+    try:
+        import Queue as _q
+    except ImportError:
+        import queue as _q
     def wrap_f(q, *args, **kwargs):
         ret = func(*args, **kwargs)
         q.put(ret)
 
+    token = CancelToken(kwargs.pop("cancel_token", None))
+    if _accepts_token(func):
+        kwargs["cancel_token"] = token
     q = _q.Queue()
     t = _th.Thread(target=wrap_f, args=(q,)+args, kwargs=kwargs)
-    t.start()
     t.result = q
+    t.cancel_token = token
+    t.cancel = token.cancel
+    t.start()
     return t
 
 def stop_listening(stop=True):
     """
     Request the listening to stop.  Code blocked on :func:`ProcessObject.wait` will proceed.
+
+    This stops *all* listeners of the process, use
+    :func:`ProcessObject.stop_listening` to stop a single one.
     """
     global _should_stop
     if not type(stop) == type(True):
       raise PynEDMException("Expected bool, received (%s)" % type(stop))
     if stop and not _should_stop: debug("Stop Requested")
     _should_stop = stop
+    if stop:
+        for token in list(_tokens): token.cancel()
 
 def should_stop():
     """
@@ -407,8 +1034,8 @@ def should_stop():
 
 def listen(function_dict,database,username=None,
            password=None, uri="http://localhost:5984", verbose=False,
-           **kw
-           ):
+           max_workers=4, checkpoint=None, feed_mode="filter", transport=None,
+           cache_size=256, processes=None, maxtasksperchild=100):
     """
     Listen to database changes feed and execute commands when certain documents
     arrive.
@@ -419,12 +1046,34 @@ def listen(function_dict,database,username=None,
     :param password: password
     :param uri: address of server
     :param verbose: vebosity
+    :param max_workers: maximum number of commands executed concurrently
+    :param checkpoint: file to save the position in the changes feed, used to
+                       resume after a restart
+    :param transport: connection settings, see :class:`pynedm.transport.Transport`
+    :param cache_size: maximum number of results stored for commands with
+                       cache_ttl
+    :param processes: maximum number of processes running commands with mode
+                      "process", default is the number of CPUs
+    :param maxtasksperchild: commands run by such a process before it is
+                             replaced
+    :param feed_mode: how the changes feed selects commands: "filter"
+                      (JavaScript filter function), "selector" (Mango
+                      selector, CouchDB >= 2.0) or "shared" (one feed for all
+                      listeners of the process on database with the same
+                      username, routed locally)
     :type function_dict: dict
     :type database: str
     :type username: str
     :type password: str
     :type uri: str
     :type verbose: bool
+    :type max_workers: int
+    :type checkpoint: str
+    :type feed_mode: str
+    :type transport: :class:`pynedm.transport.Transport`
+    :type cache_size: int
+    :type processes: int
+    :type maxtasksperchild: int
     :rtype: :class:`ProcessObject`
 
     function_dict should look like the following::
@@ -443,8 +1092,54 @@ def listen(function_dict,database,username=None,
 
     where of course the names can be more creative and func1/2 should be
     actually references to functions.
+
+    A third element of the tuple can pass options for the command (the doc
+    string may then be None to use the pydoc help)::
+
+          adict = {
+             "func_name1" : (func1, None, { "max_concurrent" : 1 }),
+          }
+
+    max_concurrent limits how many calls of the command run at the same
+    time (1 serializes the command).  Commands are executed by a pool of at
+    most max_workers threads, see :class:`pynedm.executor.CommandExecutor`.
+
+    Commands without side effects (e.g. reading a voltage) can be cached::
+
+          adict = {
+             "get_voltage" : (get_voltage, None, { "cache_ttl" : 2. }),
+          }
+
+    The result of a call is then returned for calls with the same arguments
+    in the following cache_ttl seconds, and calls arriving while the command
+    is running with the same arguments wait for its result instead of running
+    it again, see :class:`pynedm.cache.ResultCache`.
+
+    CPU-bound commands (e.g. fits) can run in a pool of processes, so that
+    they don't hold up the listener::
+
+          adict = {
+             "fit" : (fit, None, { "mode" : "process", "timeout" : 60. }),
+          }
+
+    Such functions must be defined at module level, and the process running
+    them is killed after timeout seconds (default: no limit).  Large NumPy
+    arrays are passed through shared memory, see
+    :class:`pynedm.procpool.ProcessPool`.
+
+    Functions accepting a cancel_token argument are passed the
+    :class:`pynedm.cancel.CancelToken` of the returned object, which is
+    cancelled when it stops listening.
+
+    Commands are delivered at least once: the feed resumes where it stopped
+    after a connection loss and, with checkpoint, after a restart.  Commands
+    interrupted by a restart before their response was written are run again.
+    Writing a response is retried with backoff, a command whose response
+    can't be written is logged and counted as done.
     """
 
+    if feed_mode not in ("filter", "selector", "shared"):
+        raise PynEDMException("Unknown feed_mode ({})".format(feed_mode))
     stop_listening(False)
     # Handle interruption signals
     def _builtin_sighandler(sig, frame):
@@ -462,7 +1157,8 @@ def listen(function_dict,database,username=None,
     import uuid as _uuid
 
     # Get the database information
-    process_object = ProcessObject(uri, username, password, database)
+    process_object = ProcessObject(uri, username, password, database,
+                                   transport=transport)
 
     # build_dictionary
     document = { "uuid" : _uuid.getnode(),
@@ -472,6 +1168,9 @@ def listen(function_dict,database,username=None,
 
     # Copy function dictionary
     func_dic_copy = function_dict.copy()
+    limits = {}
+    cache_ttls = {}
+    process_commands = {}
     for k in function_dict:
         o = function_dict[k]
         exp_dic = {}
@@ -479,8 +1178,20 @@ def listen(function_dict,database,username=None,
             # If we just have a function, use the doc string
             exp_dic = dict(Info=_pyd.plain(_pyd.text.document(o, k)))
         else:
-            exp_dic = dict(Info=o[1])
+            if o[1] is None:
+                exp_dic = dict(Info=_pyd.plain(_pyd.text.document(o[0], k)))
+            else:
+                exp_dic = dict(Info=o[1])
             func_dic_copy[k] = o[0]
+            if len(o) > 2 and "max_concurrent" in o[2]:
+                limits[k] = o[2]["max_concurrent"]
+            if len(o) > 2 and "cache_ttl" in o[2]:
+                cache_ttls[k] = o[2]["cache_ttl"]
+            mode = o[2].get("mode", "thread") if len(o) > 2 else "thread"
+            if mode == "process":
+                process_commands[k] = o[2].get("timeout")
+            elif mode != "thread":
+                raise PynEDMException("Unknown mode ({}) of command {}".format(mode, k))
         document["keys"][k] = exp_dic
 
     if verbose:
@@ -490,5 +1201,7 @@ def listen(function_dict,database,username=None,
     if not "ok" in r:
         raise PynEDMException("Error seen: {}".format(r))
 
-    process_object.run(func_dic_copy, r["id"])
+    process_object.run(func_dic_copy, r["id"], max_workers, limits, checkpoint, feed_mode,
+                       cache_ttls, cache_size, process_commands, processes,
+                       maxtasksperchild)
     return process_object
@@ -0,0 +1,260 @@
+import collections
+import threading as _th
+import time as _ti
+from . import codec, metrics
+from .exception import PynEDMException
+from .future import Future
+from .log import log, exception
+from .timestamps import iso_timestamp
+
+__all__ = [ "BufferedWriter" ]
+
+_bulk_seconds = metrics.histogram("pynedm_bulk_write_seconds",
+  "Duration of bulk write requests")
+_bulk_docs = metrics.counter("pynedm_bulk_docs_total",
+  "Documents sent by bulk writes by result")
+
+_overflow_policies = ("block", "drop_oldest", "spool")
+
+def _stamp(adoc):
+    """
+    Return a copy of adoc with a timestamp, keeping an existing one.
+    """
+    adoc = dict(adoc)
+    if "timestamp" not in adoc:
+        adoc["timestamp"] = iso_timestamp()
+    return adoc
+
+def _post_bulk(db, docs):
+    """
+    Post docs to the _bulk_docs endpoint of db, returns the list of per-document
+    results (in the same order as docs).  The body is encoded by
+    :mod:`pynedm.codec`.
+    """
+    data, headers = codec.encode_body(dict(docs=docs))
+    r = db.post("_bulk_docs", data=data, headers=headers)
+    r.raise_for_status()
+    return codec.loads(r.content)
+
+class BufferedWriter(object):
+    """
+    Queues documents in memory and writes them to the database in bulk from a
+    background thread.  A batch is sent as soon as max_docs documents are
+    queued or the oldest queued document is older than max_age seconds.
+    Documents are timestamped on the client when they are queued.
+
+    Normally obtained via :func:`pynedm.utils.ProcessObject.enable_batch_writes`.
+
+    :param db: database resource
+    :param max_docs: maximum number of documents per bulk request
+    :param max_age: maximum time (s) a document waits in the queue
+    :param max_queued: maximum number of documents held in memory
+    :param overflow: what to do when max_queued is reached: "block" the caller,
+                     "drop_oldest" document or "spool" new documents
+    :param on_error: called as on_error(doc, error) for every failed document,
+                     default logs the failure
+    :param spool: called as spool(docs) with the documents of a bulk request
+                  that could not reach the server, which are then not
+                  failed (see :class:`pynedm.spool.WriteSpool`), and with
+                  the documents overflowing the queue for overflow="spool".
+                  Documents are given an "_id" when queued, so that a bulk
+                  request whose response was lost doesn't write them twice.
+    :type max_docs: int
+    :type max_age: float
+    :type max_queued: int
+    :type overflow: str
+    :type on_error: func(doc, error)
+    :type spool: func(docs)
+    """
+    def __init__(self, db, max_docs=500, max_age=1.0, max_queued=10000,
+                 overflow="block", on_error=None, spool=None):
+        if overflow not in _overflow_policies:
+            raise PynEDMException("overflow must be one of {}".format(_overflow_policies))
+        if overflow == "spool" and spool is None:
+            raise PynEDMException("spool must be given for overflow='spool'")
+        self.db = db
+        self.max_docs = max_docs
+        self.max_age = max_age
+        self.max_queued = max(max_queued, max_docs)
+        self.overflow = overflow
+        self.on_error = on_error
+        self.spool = spool
+        self._queue = collections.deque()
+        self._cond = _th.Condition()
+        self._flush_requested = 0
+        self._flush_done = 0
+        self._closed = False
+        self._stats = dict(written=0, failed=0, dropped=0, batches=0, spooled=0)
+        self._thread = _th.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, adoc):
+        """
+        Queue a document for writing.
+
+        :param adoc: document
+        :type adoc: dict
+        :returns: :class:`pynedm.future.Future` -- resolves to the server
+                  response for this document (e.g. { "ok" : True, "id" : ..., "rev" : ... })
+        :raises: :class:`pynedm.exception.PynEDMException` if the writer is closed
+        """
+        adoc = _stamp(adoc)
+        if self.spool is not None:
+            from .spool import _with_id
+            adoc = _with_id(adoc)
+        fut = Future()
+        dropped = None
+        with self._cond:
+            if self._closed:
+                raise PynEDMException("Writer closed")
+            full = len(self._queue) >= self.max_queued
+            if full and self.overflow == "block":
+                while len(self._queue) >= self.max_queued and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    raise PynEDMException("Writer closed")
+            elif full and self.overflow == "drop_oldest":
+                dropped = self._queue.popleft()
+                self._stats["dropped"] += 1
+            if not full or self.overflow != "spool":
+                self._queue.append((adoc, fut, _ti.time()))
+                # The first document starts the max_age timer of the thread
+                if len(self._queue) == 1 or len(self._queue) >= self.max_docs:
+                    self._cond.notify_all()
+        if dropped is not None:
+            self._fail(dropped[0], dropped[1], PynEDMException("Dropped, queue full"))
+        if full and self.overflow == "spool" and not self._spool([(adoc, fut, None)]):
+            self._fail(adoc, fut, PynEDMException("Queue full, spooling failed"))
+        return fut
+
+    def flush(self, timeout=None):
+        """
+        Send all queued documents and wait until this is done.
+
+        :param timeout: time to wait in seconds, None waits forever
+        :type timeout: float
+        :raises: :class:`pynedm.exception.PynEDMException` on timeout
+        """
+        with self._cond:
+            self._flush_requested += 1
+            gen = self._flush_requested
+            self._cond.notify_all()
+            end = None if timeout is None else _ti.time() + timeout
+            while self._flush_done < gen and self._thread.is_alive():
+                remaining = None if end is None else end - _ti.time()
+                if remaining is not None and remaining <= 0:
+                    raise PynEDMException("Timeout flushing writer")
+                self._cond.wait(remaining)
+
+    def close(self, timeout=None):
+        """
+        Flush and stop the background thread.  Further writes raise.
+        """
+        if self._closed: return
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def stats(self):
+        """
+        :returns: dict -- counters of written/failed/dropped/spooled
+                  documents, number of bulk requests and current queue length
+        """
+        with self._cond:
+            s = dict(self._stats)
+            s["queued"] = len(self._queue)
+        return s
+
+    def _fail(self, adoc, fut, err):
+        if self.on_error is not None:
+            try:
+                self.on_error(adoc, err)
+            except Exception:
+                exception("Exception in on_error callback")
+        else:
+            log("Failed writing doc ({}): {}".format(adoc, err))
+        fut.set_exception(err)
+
+    def _next_batch(self):
+        """
+        Waits (lock held) until a batch should be sent, returns (batch, flush_gen)
+        """
+        while True:
+            gen = self._flush_requested
+            if self._queue:
+                age = _ti.time() - self._queue[0][2]
+                if (len(self._queue) >= self.max_docs or age >= self.max_age
+                    or gen > self._flush_done or self._closed):
+                    n = min(self.max_docs, len(self._queue))
+                    batch = [self._queue.popleft() for _ in range(n)]
+                    self._cond.notify_all()
+                    return batch, gen
+                self._cond.wait(self.max_age - age)
+            elif gen > self._flush_done or self._closed:
+                return [], gen
+            else:
+                self._cond.wait()
+
+    def _send(self, batch):
+        docs = [d for d, _, _ in batch]
+        try:
+            with _bulk_seconds.time():
+                results = _post_bulk(self.db, docs)
+            with self._cond:
+                self._stats["batches"] += 1
+        except Exception as e:
+            from .spool import _should_spool
+            if self.spool is not None and _should_spool(e) and self._spool(batch):
+                _bulk_docs.inc(len(batch), result="spooled")
+                return
+            _bulk_docs.inc(len(batch), result="failed")
+            err = PynEDMException("Bulk write failed ({})".format(e))
+            for d, f, _ in batch:
+                self._fail(d, f, err)
+            with self._cond:
+                self._stats["failed"] += len(batch)
+            return
+        written = 0
+        for (d, f, _), res in zip(batch, results):
+            if "error" in res:
+                self._fail(d, f, PynEDMException("{}: {}".format(res["error"], res.get("reason"))))
+            else:
+                res = dict(res)
+                res["ok"] = True
+                f.set_result(res)
+                written += 1
+        _bulk_docs.inc(written, result="written")
+        _bulk_docs.inc(len(batch) - written, result="failed")
+        with self._cond:
+            self._stats["written"] += written
+            self._stats["failed"] += len(batch) - written
+
+    def _spool(self, batch):
+        """
+        Hand the documents of batch to the spool, returns True on success
+        """
+        try:
+            self.spool([d for d, _, _ in batch])
+        except Exception:
+            exception("Exception spooling documents")
+            return False
+        with self._cond:
+            self._stats["spooled"] += len(batch)
+        for _, f, _ in batch:
+            f.set_result({ "ok" : True, "spooled" : True })
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch, gen = self._next_batch()
+            if batch:
+                self._send(batch)
+                continue
+            with self._cond:
+                self._flush_done = max(self._flush_done, gen)
+                self._cond.notify_all()
+                if self._closed and not self._queue: break
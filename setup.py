@@ -14,6 +14,10 @@ setup(
     'netifaces',
     'twisted'
   ],
+  extras_require={
+    'aio' : ['aiohttp'],
+    'fast' : ['orjson']
+  },
   dependency_links=[
     "https://github.com/nEDM-TUM/cloudant-python/tarball/nedm-version#egg=cloudant-0.5.9-nedm"
   ]
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "benchmarks"))
+from fake_couch import FakeCouch
+
+DB = "test"
+
+# Coroutine syntax
+collect_ignore = [] if sys.version_info >= (3, 6) else ["test_aio.py"]
+
+@pytest.fixture
+def couch():
+    """
+    In-memory CouchDB stand-in, see benchmarks/fake_couch.py
+    """
+    with FakeCouch() as c:
+        yield c
+
+@pytest.fixture
+def po(couch):
+    """
+    ProcessObject connected to database DB of couch
+    """
+    import pynedm
+    o = pynedm.ProcessObject(uri=couch.uri, adb=DB)
+    yield o
+    o.close()
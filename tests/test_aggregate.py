@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from conftest import DB
+
+def _windows(couch):
+    with couch.db(DB).cond:
+        docs = [ d for d in couch.db(DB).docs.values() if "window" in d ]
+    return sorted(docs, key=lambda d: d["window"]["start"])
+
+def _base(window):
+    # Start of a window in the future, so that the scheduler doesn't expire it
+    t = time.time() + 3600
+    return t - t % window
+
+def test_window_documents(couch, po):
+    agg = po.aggregator(window=10.)
+    t = _base(10.)
+    agg.add("temp", 1., t + 1)
+    agg.add_many({ "temp" : 3., "p" : 5. }, t + 2)
+    agg.add("temp", float("nan"), t + 3)
+    assert _windows(couch) == []
+    # A sample of the next window writes the current one
+    agg.extend("temp", [10., 20.], t + 11)
+    docs = _windows(couch)
+    assert len(docs) == 1
+    doc = docs[0]
+    assert doc["type"] == "data"
+    assert doc["value"] == { "temp" : 2., "p" : 5. }
+    assert doc["stats"]["temp"] == dict(min=1., max=3., mean=2., std=1., count=2)
+    end = time.gmtime(t + 10)
+    assert doc["window"]["end"] == time.strftime("%Y-%m-%dT%H:%M:%S.000Z", end)
+    agg.close()
+    docs = _windows(couch)
+    assert len(docs) == 2 and docs[1]["value"] == { "temp" : 15. }
+    assert agg.stats() == dict(samples=5, windows=2)
+
+def test_expired_window_is_written(couch, po):
+    agg = po.aggregator(window=0.2)
+    agg.add("temp", 4.)
+    deadline = time.time() + 5
+    while not _windows(couch) and time.time() < deadline:
+        time.sleep(0.05)
+    assert _windows(couch)[0]["value"] == { "temp" : 4. }
+    agg.close()
+
+def test_raw_samples(couch, po):
+    np = pytest.importorskip("numpy")
+    agg = po.aggregator(window=10., raw_every=2)
+    t = _base(10.)
+    agg.extend("temp", np.arange(6.), t + 1)
+    agg.close()
+    doc = _windows(couch)[0]
+    raw = po.read_arrays(doc)["raw"]["temp"]
+    assert raw.tolist() == [ [t + 1, 0.], [t + 1, 2.], [t + 1, 4.] ]
+
+def test_invalid_arguments(po):
+    from pynedm.exception import PynEDMException
+    with pytest.raises(PynEDMException):
+        po.aggregator(window=0)
+    with pytest.raises(PynEDMException):
+        po.aggregator(raw_every=0)
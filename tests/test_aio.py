@@ -0,0 +1,126 @@
+import asyncio
+import io
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+from pynedm.aio import AsyncProcessObject
+
+from conftest import DB
+
+async def _add(a, b):
+    return a + b
+
+def _mul(a, b):
+    return a * b
+
+def _fail():
+    raise ValueError("bad")
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+def test_listen_and_send_command(couch):
+    from pynedm.exception import CommandError
+    async def main():
+        async with AsyncProcessObject(uri=couch.uri, adb=DB) as po:
+            await po.listen({ "add" : _add, "mul" : (_mul, "multiply"), "fail" : _fail })
+            async with AsyncProcessObject(uri=couch.uri, adb=DB) as client:
+                results = await asyncio.gather(client.send_command("add", 1, 2),
+                                               client.send_command("mul", 3, 4))
+                with pytest.raises(CommandError):
+                    await client.send_command("fail")
+            po.stop_listening()
+            await po.wait()
+            return results
+    assert _run(main()) == [3, 12]
+    # The commands document is removed when listening ends
+    assert not [d for d in couch.db(DB).docs.values() if d.get("type") == "export_commands"]
+
+def test_write_and_files(couch):
+    async def main():
+        async with AsyncProcessObject(uri=couch.uri, adb=DB) as po:
+            r = await po.write_document_to_db({ "type" : "data", "value" : { "x" : 1 } })
+            data = bytes(bytearray(range(256))) * 40
+            up = await po.upload_file(io.BytesIO(data), r["id"], attachment_name="f.bin",
+                                      chunk_size=1000)
+            f = await po.open_file(r["id"], "f.bin")
+            f.seek(100)
+            part = await f.read(50)
+            chunks = []
+            async for ch in po.download_file(r["id"], "f.bin", chunk_size=4096):
+                chunks.append(ch)
+            await po.delete_file(r["id"], "f.bin")
+            return r, up, data, part, chunks
+    r, up, data, part, chunks = _run(main())
+    assert r["ok"] and up["ok"]
+    assert part == data[100:150]
+    assert chunks[0] == len(data) and b"".join(chunks[1:]) == data
+    assert couch.db(DB).docs[r["id"]]["value"] == { "x" : 1 }
+
+def _has_token(cancel_token=None):
+    return cancel_token is not None and not cancel_token.cancelled()
+
+def _response(couch, docid, timeout=5):
+    import time
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with couch.db(DB).cond:
+            resp = couch.db(DB).docs.get(docid, {}).get("response")
+        if resp is not None: return resp
+        time.sleep(0.02)
+
+def test_feed_survives_bad_changes(couch):
+    async def main():
+        async with AsyncProcessObject(uri=couch.uri, adb=DB) as po:
+            await po.listen({ "add" : _add, "token" : _has_token })
+            running = set()
+            # Malformed change, handled without stopping the feed
+            await po._handle({ "id" : "x", "seq" : 1 }, {}, running)
+            async with AsyncProcessObject(uri=couch.uri, adb=DB) as client:
+                bad = await client.write_document_to_db({ "type" : "command",
+                  "execute" : "add", "arguments" : 1 })
+                # The response PUT fails once and is retried
+                couch.fail_next(500, method="PUT")
+                results = [ await client.send_command("add", 1, 2),
+                            await client.send_command("token") ]
+            po.stop_listening()
+            await po.wait()
+            return bad["id"], results
+    bad, results = _run(main())
+    assert results == [3, True]
+    assert "must be a list" in _response(couch, bad)["content"]
+
+def test_resume_from_checkpoint(couch, tmpdir):
+    path = str(tmpdir.join("checkpoint"))
+    async def main():
+        async with AsyncProcessObject(uri=couch.uri, adb=DB) as po:
+            await po.listen({ "add" : _add }, checkpoint=path)
+            po.stop_listening()
+            await po.wait()
+            # Inserted while not listening
+            r = await po.write_document_to_db({ "type" : "command",
+              "execute" : "add", "arguments" : [2, 3] })
+            await po.listen({ "add" : _add }, checkpoint=path)
+            resp = await asyncio.get_event_loop().run_in_executor(None, _response, couch, r["id"])
+            po.stop_listening()
+            await po.wait()
+            return resp
+    assert _run(main())["return"] == 5
+
+def test_stopped_by_stop_listening(couch):
+    from pynedm.utils import stop_listening
+    async def main():
+        async with AsyncProcessObject(uri=couch.uri, adb=DB) as po:
+            await po.listen({ "add" : _add })
+            stop_listening()
+            await asyncio.wait_for(po.wait(), 5)
+            return po.cancel_token.cancelled()
+    try:
+        assert _run(main())
+    finally:
+        stop_listening(False)
@@ -0,0 +1,56 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pycurl")
+
+from pynedm.arrays import ArrayReader, join_arrays, split_arrays
+from pynedm.exception import PynEDMException
+
+from conftest import DB
+
+def test_split_and_join_arrays():
+    wf = np.arange(1000, dtype=">i4")
+    doc, arrays = split_arrays({ "value" : { "wf" : wf, "small" : np.arange(3) } }, 1000)
+    assert doc["value"]["wf"] == { "_ndarray" : dict(dtype="<i4", shape=[1000],
+                                                     attachment="value.wf") }
+    assert [name for name, _ in arrays] == ["value.wf"]
+    data = arrays[0][1].read()
+    out = join_arrays(doc, lambda ref: np.frombuffer(bytes(data), dtype=ref["dtype"]))
+    assert (out["value"]["wf"] == wf).all()
+    assert (out["value"]["small"] == np.arange(3)).all()
+
+def test_array_reader_returns_views():
+    arr = np.arange(100, dtype="<f8")
+    r = ArrayReader(arr)
+    r.seek(8)
+    chunk = r.read(16)
+    assert bytes(chunk) == arr[1:3].tobytes()
+    if hasattr(memoryview, "cast"):
+        assert isinstance(chunk, memoryview)
+    r.seek(-8, 2)
+    assert bytes(r.read()) == arr[-1:].tobytes()
+    assert len(r.read(10)) == 0
+
+def test_arrays_written_as_attachments(couch, po):
+    a = np.arange(20000, dtype="<f8").reshape(10000, 2)
+    b = np.arange(40000, dtype="<i2")
+    r = po.write_document_to_db({ "type" : "data", "value" : { "a" : a, "b" : b, "c" : 1 } })
+    assert r.get("ok") and "error" not in r
+    with couch.db(DB).cond:
+        doc = dict(couch.db(DB).docs[r["id"]])
+    # One revision for the document and one for each upload
+    assert doc["_rev"].startswith("3-")
+    out = po.read_arrays(doc)
+    assert (out["value"]["a"] == a).all() and (out["value"]["b"] == b).all()
+    part = po.read_array(r["id"], doc["value"]["a"]["_ndarray"], start=100, stop=110)
+    assert (part == a[100:110]).all()
+
+def test_failed_array_upload_reported(couch, po):
+    a = np.zeros(20000)
+    couch.fail_next(500, count=100, method="PUT", path="_attachments")
+    r = po.write_document_to_db({ "type" : "data", "value" : { "a" : a } })
+    # The document was written, its array is missing
+    assert r["id"] in couch.db(DB).docs
+    assert r["failed_arrays"] == ["value.a"] and "HTTP 500" in r["error"]
+    with pytest.raises(PynEDMException):
+        po.write_document_to_db({ "type" : "data", "value" : { "a" : a } }, ignoreErrors=False)
@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+
+from pynedm.cache import ResultCache
+from pynedm.exception import PynEDMException
+
+from conftest import DB
+
+def test_hits_and_eviction():
+    cache = ResultCache({ "f" : 60. }, max_entries=2)
+    calls = []
+    def f(x):
+        calls.append(x)
+        return x * 2
+    assert [ cache.call("f", f, x) for x in (1, 1, 2, 3, 1) ] == [2, 2, 4, 6, 2]
+    # 1 was evicted by 3
+    assert calls == [1, 2, 3, 1]
+    assert cache.stats() == dict(hit=1, miss=4, coalesced=0, entries=2)
+    # Not cached
+    cache.call("g", f, 1)
+    assert calls[-1] == 1 and cache.stats()["entries"] == 2
+
+def test_concurrent_calls_are_coalesced():
+    cache = ResultCache({ "f" : 60. })
+    started, release = threading.Event(), threading.Event()
+    def f():
+        started.set()
+        release.wait(5)
+        return "done"
+    results = []
+    owner = threading.Thread(target=lambda: results.append(cache.call("f", f)))
+    owner.start()
+    started.wait(5)
+    waiter = threading.Thread(target=lambda: results.append(cache.call("f", f)))
+    waiter.start()
+    release.set()
+    owner.join(5)
+    waiter.join(5)
+    assert results == ["done", "done"]
+    assert cache.stats()["coalesced"] == 1
+
+def test_exceptions_are_not_stored():
+    cache = ResultCache({ "f" : 60. })
+    def fail():
+        raise ValueError("no")
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            cache.call("f", fail)
+    assert cache.stats()["miss"] == 0 and cache.stats()["entries"] == 0
+
+def test_interrupted_call_is_cleaned_up():
+    cache = ResultCache({ "f" : 60. })
+    def interrupt():
+        raise KeyboardInterrupt()
+    with pytest.raises(KeyboardInterrupt):
+        cache.call("f", interrupt)
+    # Not left running, the next call executes
+    assert cache.call("f", lambda: 1) == 1
+
+def test_listen_options(couch, po):
+    from pynedm.utils import listen
+    o = listen({ "get" : (lambda: 5, None, { "cache_ttl" : 60. }) }, DB,
+                      uri=couch.uri, cache_size=3)
+    try:
+        assert o.command_cache.max_entries == 3
+        assert po.send_command("get") == 5
+        assert po.send_command("get") == 5
+        assert o.command_cache.stats()["hit"] == 1
+    finally:
+        o.stop_listening()
+        o.wait()
+        o.close()
+    with pytest.raises(TypeError):
+        listen({}, DB, uri=couch.uri, cache_sise=3)
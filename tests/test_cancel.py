@@ -0,0 +1,51 @@
+import time
+
+import pynedm
+from pynedm.cancel import CancelToken
+
+from conftest import DB
+
+def test_cancel_token_callbacks_and_parent():
+    parent = CancelToken()
+    child = CancelToken(parent)
+    calls = []
+    child.add_callback(lambda: calls.append("child"))
+    assert not child.wait(0.01)
+    parent.cancel()
+    assert child.cancelled() and child.wait(0)
+    assert calls == ["child"]
+    # Registered after cancellation: called immediately
+    child.add_callback(lambda: calls.append("late"))
+    assert calls == ["child", "late"]
+
+def test_start_process_cancel():
+    def work(cancel_token=None):
+        n = 0
+        while not cancel_token.wait(0.01): n += 1
+        return n
+    job = pynedm.start_process(work)
+    time.sleep(0.05)
+    job.cancel()
+    assert job.result.get(timeout=5) > 0
+
+def _listen(couch, o):
+    with couch.db(DB).cond:
+        couch.db(DB).save({ "_id" : "commands", "type" : "export_commands" })
+    o.run({ "echo" : lambda *args: list(args) }, "commands")
+
+def test_listen_again_after_stop(couch, po):
+    o = pynedm.ProcessObject(uri=couch.uri, adb=DB)
+    _listen(couch, o)
+    assert po.send_command("echo", 1) == [1]
+    first = o.cancel_token
+    o.stop_listening()
+    o.wait()
+    assert first.cancelled()
+    _listen(couch, o)
+    try:
+        assert not o.should_stop()
+        assert po.send_command("echo", 2) == [2]
+    finally:
+        o.stop_listening()
+        o.wait()
+        o.close()
@@ -0,0 +1,71 @@
+import importlib
+import time
+
+import pytest
+
+from pynedm.checkpoint import FeedCheckpoint
+
+from conftest import DB
+
+def test_checkpoint_held_back_by_pending_commands():
+    cp = FeedCheckpoint()
+    cp.advance(10)
+    cp.started("a", 11)
+    cp.started("b", 12)
+    cp.advance(13)
+    assert cp.seq == 10 and cp.seen("a")
+    cp.finished("b")
+    assert cp.seq == 10
+    cp.finished("a")
+    assert cp.seq == 13 and cp.seen("a") and cp.seen("b")
+
+def test_checkpoint_saved_and_loaded(tmpdir):
+    path = str(tmpdir.join("cp.json"))
+    cp = FeedCheckpoint(path, max_ids=2)
+    cp.advance(1)
+    for i, docid in enumerate("abc"):
+        cp.started(docid, i + 2)
+        cp.finished(docid)
+    cp.started("d", 5)
+    cp.save()
+    cp = FeedCheckpoint(path)
+    # Resumes before the unfinished command
+    assert cp.seq == 4
+    assert not cp.seen("a") and cp.seen("b") and cp.seen("c") and not cp.seen("d")
+
+@pytest.fixture
+def listener(couch, monkeypatch):
+    from pynedm.utils import listen
+    monkeypatch.setattr(importlib.import_module("pynedm.listen"), "_backoff",
+                        lambda attempt: 0.01)
+    l = listen({ "echo" : lambda *args: list(args) }, DB, uri=couch.uri)
+    yield l
+    l.stop_listening()
+    l.wait()
+
+def _command(couch, docid):
+    with couch.db(DB).cond:
+        couch.db(DB).save({ "_id" : docid, "type" : "command", "execute" : "echo",
+                            "arguments" : [docid] })
+
+def _wait_finished(listener, docid):
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if listener.checkpoint.seen(docid) and not listener.checkpoint._pending: return
+        time.sleep(0.01)
+    raise AssertionError("{} not finished".format(docid))
+
+def test_response_write_retried(couch, listener):
+    couch.fail_next(503, count=2, method="PUT", path="insert_with_timestamp/")
+    _command(couch, "cmd1")
+    _wait_finished(listener, "cmd1")
+    with couch.db(DB).cond:
+        assert couch.db(DB).docs["cmd1"]["response"]["return"] == ["cmd1"]
+
+def test_response_write_failure_releases_checkpoint(couch, listener):
+    couch.fail_next(503, count=100, method="PUT", path="insert_with_timestamp/")
+    _command(couch, "cmd2")
+    _wait_finished(listener, "cmd2")
+    with couch.db(DB).cond:
+        assert "response" not in couch.db(DB).docs["cmd2"]
+    assert listener.checkpoint.seq >= couch.db(DB).seq
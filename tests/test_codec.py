@@ -0,0 +1,68 @@
+import datetime
+import json
+import zlib
+
+import pytest
+
+from pynedm import codec
+
+from conftest import DB
+
+def _backends():
+    names = []
+    for name in ("orjson", "ujson", "json"):
+        try:
+            codec._backends[name]()
+            names.append(name)
+        except (ImportError, TypeError):
+            pass
+    return names
+
+@pytest.fixture(params=_backends())
+def backend(request):
+    old = codec.backend
+    codec.configure(backend=request.param)
+    yield request.param
+    codec.configure(backend=old)
+
+def test_codec_types(backend):
+    obj = { "big" : 2**70, "neg" : -2**65, "when" : datetime.datetime(2020, 1, 2, 3, 4, 5),
+            "s" : "a/b", "l" : [1, 2.5, None, True] }
+    expected = dict(obj, when="2020-01-02T03:04:05")
+    assert json.loads(codec.dumps(obj)) == expected
+    assert json.loads(codec.dumpb(obj).decode("utf-8")) == expected
+    assert codec.loads(codec.dumpb(obj)) == expected
+    with pytest.raises(TypeError):
+        codec.dumpb(object())
+
+def test_codec_numpy(backend):
+    np = pytest.importorskip("numpy")
+    obj = dict(a=np.arange(3, dtype=np.int16), f=np.float32(0.5))
+    assert codec.plain(obj) == dict(a=[0, 1, 2], f=0.5)
+
+def test_encode_body_compression():
+    old = codec.compress, codec.compress_min_size
+    try:
+        codec.configure(compress=True, compress_min_size=100)
+        data, headers = codec.encode_body(dict(docs=[]))
+        assert "Content-Encoding" not in headers
+        big = dict(docs=[dict(i=i) for i in range(100)])
+        data, headers = codec.encode_body(big)
+        assert headers["Content-Encoding"] == "gzip"
+        assert json.loads(zlib.decompress(data, 16 + zlib.MAX_WBITS).decode("utf-8")) == big
+    finally:
+        codec.configure(compress=old[0], compress_min_size=old[1])
+
+def test_documents_and_responses_encoded_by_codec(couch, po):
+    np = pytest.importorskip("numpy")
+    from pynedm.utils import listen
+    r = po.write_document_to_db(dict(type="data", value={ "v" : np.float64(1.5),
+                                                          "big" : 2**70 }))
+    with couch.db(DB).cond:
+        assert couch.db(DB).docs[r["id"]]["value"] == { "v" : 1.5, "big" : 2**70 }
+    l = listen({ "arr" : lambda: np.arange(3) }, DB, uri=couch.uri)
+    try:
+        assert po.send_command("arr") == [0, 1, 2]
+    finally:
+        l.stop_listening()
+        l.wait()
@@ -0,0 +1,60 @@
+import time
+
+from conftest import DB
+
+from pynedm.deadband import DeadbandFilter
+
+def _data(couch):
+    with couch.db(DB).cond:
+        return [ d["value"] for d in couch.db(DB).docs.values() if d.get("type") == "data" ]
+
+def test_filter_thresholds():
+    f = DeadbandFilter(absolute=0.5, variables={ "p" : { "relative" : 0.1 } })
+    doc = { "type" : "data", "value" : { "t" : 1., "p" : 100., "s" : "open" } }
+    assert f.filter(doc) is doc
+    f.record(doc)
+    assert f.filter({ "value" : { "t" : 1.4, "p" : 109., "s" : "open" } }) is None
+    assert f.filter({ "value" : { "t" : 1.6, "p" : 111., "s" : "shut" } })["value"] == \
+      { "t" : 1.6, "p" : 111., "s" : "shut" }
+    # Values are kept per database
+    assert f.filter({ "value" : { "t" : 1. } }, db="other") is not None
+    f.reset("t")
+    assert f.filter({ "value" : { "t" : 1. } })["value"] == { "t" : 1. }
+
+def test_filter_keeps_unrecorded_values():
+    f = DeadbandFilter(absolute=1.)
+    f.filter({ "value" : { "t" : 1. } })
+    # Not recorded: filtered again against nothing
+    assert f.filter({ "value" : { "t" : 1.1 } }) is not None
+
+def test_max_silence():
+    f = DeadbandFilter(absolute=1., max_silence=0.05)
+    f.record({ "value" : { "t" : 1. } })
+    assert f.filter({ "value" : { "t" : 1. } }) is None
+    time.sleep(0.1)
+    assert f.filter({ "value" : { "t" : 1. } }) is not None
+
+def test_write_document(couch, po):
+    po.enable_deadband(absolute=0.5)
+    assert po.write_document_to_db({ "type" : "data", "value" : { "t" : 1. } })["ok"]
+    assert po.write_document_to_db({ "type" : "data", "value" : { "t" : 1.2 } })["filtered"]
+    assert "filtered" not in po.write_document_to_db(
+      { "type" : "data", "value" : { "t" : 1.2 } }, deadband=False)
+    assert _data(couch) == [ { "t" : 1. }, { "t" : 1.2 } ]
+
+def test_failed_write_is_not_recorded(couch, po):
+    po.enable_deadband(absolute=0.5)
+    couch.fail_next(400, method="POST")
+    assert "ok" not in po.write_document_to_db({ "type" : "data", "value" : { "t" : 1. } })
+    assert po.write_document_to_db({ "type" : "data", "value" : { "t" : 1. } })["ok"]
+    assert _data(couch) == [ { "t" : 1. } ]
+
+def test_aggregator_is_not_filtered(couch, po):
+    po.enable_deadband(absolute=10.)
+    agg = po.aggregator(window=10.)
+    t = time.time() + 3600
+    t -= t % 10.
+    agg.add("t", 1., t)
+    agg.add("t", 2., t + 10)
+    agg.close()
+    assert sorted(v["t"] for v in _data(couch)) == [ 1., 2. ]
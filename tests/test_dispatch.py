@@ -0,0 +1,74 @@
+import threading
+
+import pytest
+
+from pynedm.exception import CommandError
+
+from conftest import DB
+
+@pytest.fixture
+def listener(couch):
+    from pynedm.utils import listen
+    def fail():
+        raise ValueError("bad")
+    l = listen({ "echo" : lambda *args: list(args), "fail" : fail }, DB, uri=couch.uri)
+    yield l
+    l.stop_listening()
+    l.wait()
+
+def test_send_command_returns_result(listener, po):
+    assert po.send_command("echo", 1, "a") == [1, "a"]
+    with pytest.raises(CommandError):
+        po.send_command("fail")
+
+def test_send_command_timeout(po):
+    with pytest.raises(CommandError):
+        po.send_command("not_listening", timeout=500)
+
+def test_send_commands_wraps_single_arguments(listener, po):
+    futs = po.send_commands([ ("echo", "abc"), ("echo", [1, 2]), ("echo", (3,)) ])
+    assert [f.result(10) for f in futs] == [["abc"], [1, 2], [3]]
+
+def test_parallel_send_command(listener, po):
+    results = {}
+    def send(i):
+        results[i] = po.send_command("echo", i)
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(10)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert results == dict((i, [i]) for i in range(10))
+
+def test_response_feed_only_receives_awaited_documents(listener, po, couch):
+    dispatcher = po._get_dispatcher(DB)
+    seen = []
+    handle = dispatcher._handle
+    def _handle(line):
+        seen.append(line["id"])
+        handle(line)
+    dispatcher._handle = _handle
+    stop = threading.Event()
+    def write_data():
+        while not stop.is_set():
+            po.write_document_to_db({ "type" : "data", "value" : { "x" : 1 } })
+    th = threading.Thread(target=write_data)
+    th.start()
+    try:
+        for i in range(5):
+            assert po.send_command("echo", i) == [i]
+    finally:
+        stop.set()
+        th.join()
+    docs = couch.db(DB).docs
+    assert seen and all(docs[i]["type"] == "command" for i in seen)
+
+def test_response_feed_stays_open(listener, po, monkeypatch):
+    import pynedm.dispatch
+    opened = []
+    iter_changes = pynedm.dispatch._iter_changes
+    def _iter_changes(*args):
+        opened.append(args)
+        return iter_changes(*args)
+    monkeypatch.setattr(pynedm.dispatch, "_iter_changes", _iter_changes)
+    for i in range(5):
+        assert po.send_command("echo", i) == [i]
+    assert len(opened) == 1
@@ -0,0 +1,90 @@
+import threading
+import time
+
+import pytest
+
+from pynedm.exception import PynEDMException
+from pynedm.executor import CommandExecutor
+
+from conftest import DB
+
+def _tracker():
+    lock = threading.Lock()
+    state = dict(running=0, peak=0)
+    def task(t):
+        with lock:
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+        time.sleep(t)
+        with lock:
+            state["running"] -= 1
+        return t
+    return task, state
+
+def test_executor_runs_at_most_max_workers_tasks():
+    task, state = _tracker()
+    ex = CommandExecutor(max_workers=3)
+    futs = [ex.submit("k{}".format(i), task, 0.05) for i in range(10)]
+    assert [f.result(5) for f in futs] == [0.05] * 10
+    assert state["peak"] == 3
+    s = ex.stats()
+    assert s["workers"] == 3 and s["completed"] == 10 and s["running"] == 0
+    ex.shutdown()
+
+def test_executor_limits_serialize_a_key():
+    task, state = _tracker()
+    ex = CommandExecutor(max_workers=4, limits={ "serial" : 1 })
+    futs = [ex.submit("serial", task, 0.02) for i in range(5)]
+    # Tasks of other keys are not held up by the deferred ones
+    other = ex.submit("other", lambda: "done")
+    assert other.result(1) == "done"
+    for f in futs: f.result(5)
+    assert state["peak"] == 1
+    ex.shutdown()
+
+def test_executor_passes_exceptions():
+    ex = CommandExecutor()
+    def fail():
+        raise ValueError("bad")
+    fut = ex.submit("x", fail)
+    with pytest.raises(ValueError):
+        fut.result(5)
+    assert ex.stats()["failed"] == 1
+    ex.shutdown()
+
+def test_executor_rejects_tasks_after_shutdown():
+    ex = CommandExecutor()
+    fut = ex.submit("x", time.sleep, 0.05)
+    ex.shutdown()
+    assert fut.done()
+    with pytest.raises(PynEDMException):
+        ex.submit("x", time.sleep, 0)
+
+def test_listen_runs_commands_concurrently(couch, po):
+    from pynedm.utils import listen
+    barrier = threading.Barrier(3) if hasattr(threading, "Barrier") else None
+    def wait_all():
+        if barrier is not None: barrier.wait(5)
+        return True
+    l = listen({ "wait_all" : wait_all }, DB, uri=couch.uri, max_workers=3)
+    try:
+        futs = po.send_commands([ ("wait_all", []) ] * 3)
+        assert [f.result(10) for f in futs] == [True] * 3
+    finally:
+        l.stop_listening()
+        l.wait()
+
+def test_wait_returns_if_listener_setup_fails(couch, po, monkeypatch):
+    import pynedm.scheduler
+    def _fail():
+        raise RuntimeError("no scheduler")
+    monkeypatch.setattr(pynedm.scheduler, "get_scheduler", _fail)
+    with couch.db(DB).cond:
+        couch.db(DB).save({ "_id" : "commands", "type" : "export_commands" })
+    po.run({ "noop" : lambda: None }, "commands")
+    waiter = threading.Thread(target=po.wait)
+    waiter.daemon = True
+    waiter.start()
+    waiter.join(5)
+    assert not waiter.is_alive()
+    assert not po.isRunning
@@ -0,0 +1,37 @@
+import datetime
+
+import pytest
+
+from conftest import DB
+
+from pynedm.timestamps import iso_timestamp
+
+def test_iso_timestamp():
+    assert iso_timestamp(0) == "1970-01-01T00:00:00.000Z"
+    assert iso_timestamp(1462363200.9996) == "2016-05-04T12:00:01.000Z"
+    assert iso_timestamp().endswith("Z")
+
+def test_key_time():
+    from pynedm.export import _key_time, _unix_time
+    t = 1462363200.25
+    assert _key_time(t) == "2016-05-04T12:00:00.250Z"
+    assert _key_time(datetime.datetime(2016, 5, 4, 12, 0, 0, 250000)) == _key_time(t)
+    assert _key_time("2016-05-04T12:00:00.250Z") == _key_time(t)
+    assert _unix_time(_key_time(t)) == t
+
+def test_read_data_in_chunks(couch, po):
+    np = pytest.importorskip("numpy")
+    from pynedm.export import install_view
+    from pynedm.writer import _post_bulk
+    db = po.acct[DB]
+    install_view(db)
+    t0 = 1.4e9
+    _post_bulk(db, [ { "type" : "data", "timestamp" : iso_timestamp(t0 + i),
+                       "value" : { "x" : float(i), "s" : "text" } } for i in range(100) ])
+    times, values = po.read_data(["x"], t0 + 10, t0 + 90, chunk_size=7)["x"]
+    assert values.tolist() == [ float(i) for i in range(10, 90) ]
+    assert np.allclose(times, t0 + values)
+    chunks = list(po.iter_data("x", t0, t0 + 100, chunk_size=30))
+    assert len(chunks) > 1
+    assert sum(len(c[1]) for c in chunks) == 100
+    assert po.read_data(["s"], t0, t0 + 100)["s"][1].size == 0
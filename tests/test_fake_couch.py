@@ -0,0 +1,46 @@
+import socket
+
+import pytest
+
+from fake_couch import FakeCouch
+
+def test_stop_joins_threads():
+    with FakeCouch() as couch:
+        threads = list(couch._threads)
+        address = couch.server.server_address
+    assert threads and not any(th.is_alive() for th in threads)
+    with pytest.raises(socket.error):
+        socket.create_connection(address, timeout=1).close()
+
+def test_documents_and_changes(couch):
+    import requests
+    from conftest import DB
+    url = "/".join([couch.uri, DB])
+    r = requests.post(url + "/_bulk_docs", json={ "docs" : [ { "_id" : "a", "v" : 1 } ] })
+    assert r.json()[0]["ok"]
+    assert requests.get(url + "/a").json()["v"] == 1
+    changes = requests.get(url + "/_changes").json()["results"]
+    assert [ c["id"] for c in changes ] == ["a"]
+    # Conflicting write
+    r = requests.post(url + "/_bulk_docs", json={ "docs" : [ { "_id" : "a", "v" : 2 } ] })
+    assert r.json()[0]["error"] == "conflict"
+
+def test_fail_next(couch):
+    import requests
+    from conftest import DB
+    couch.fail_next(503, method="GET")
+    url = "/".join([couch.uri, DB, "_changes"])
+    assert requests.get(url).status_code == 503
+    assert requests.get(url).status_code == 200
+
+def test_update_handler_reads_json_body(couch):
+    import requests
+    from conftest import DB
+    url = "/".join([couch.uri, DB, "_design/nedm_default/_update/insert_with_timestamp"])
+    r = requests.post(url + "/b", params={ "q" : "1" }, json={ "type" : "data", "v" : [1, 2] })
+    assert r.json()["ok"]
+    doc = couch.db(DB).docs["b"]
+    assert doc["v"] == [1, 2] and "timestamp" in doc
+    # Query parameters are not fields of the document
+    assert "q" not in doc
+    assert requests.post(url, params={ "type" : "data" }).status_code == 400
@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+from pynedm.exception import PynEDMNoFile
+
+from conftest import DB
+
+_data = bytes(bytearray(i % 251 for i in range(300000)))
+
+@pytest.fixture
+def attachment(couch):
+    with couch.db(DB).cond:
+        couch.db(DB).attachments[("doc", "file.bin")] = (_data, 1)
+    return "doc", "file.bin"
+
+def test_attachment_file_reads(po, attachment):
+    f = po.open_file(*attachment, block_size=1000, cache_size=10000, read_ahead=2)
+    assert f.total_length == len(_data)
+    assert f.read(10) == _data[:10]
+    f.seek(12345)
+    assert f.read(5000) == _data[12345:17345]
+    f.seek(-3, 1)
+    assert f.tell() == 17342
+    f.seek(100, 2)
+    assert f.read() == _data[-100:]
+    assert f.read(1) is None
+    assert b"".join(f.iterate(999)) == b""
+    f.seek(0)
+    assert b"".join(f.iterate(70001)) == _data
+
+def test_attachment_file_cache(po, attachment):
+    f = po.open_file(*attachment, block_size=1000, cache_size=10000, read_ahead=2)
+    f.read(100)
+    requests = f.stats()["requests"]
+    # Served from the same block
+    f.seek(500)
+    assert f.read(100) == _data[500:600]
+    assert f.stats()["requests"] == requests
+    # Sequential reads fetch read_ahead blocks with the missing one
+    f.seek(1000)
+    f.read(1000)
+    f.seek(2000)
+    f.read(1000)
+    f.seek(3000)
+    f.read(1000)
+    s = f.stats()
+    assert s["requests"] == requests + 1
+    assert s["cached_bytes"] <= 10000
+    # Reads larger than the cache bypass it
+    f.seek(0)
+    assert f.read(50000) == _data[:50000]
+    assert f.stats()["cached_bytes"] <= 10000
+
+def test_attachment_file_without_cache(po, attachment):
+    f = po.open_file(*attachment, block_size=0)
+    f.seek(7)
+    assert f.read(3) == _data[7:10]
+    assert f.stats()["cached_bytes"] == 0
+
+def test_missing_attachment(po):
+    with pytest.raises(PynEDMNoFile):
+        po.open_file("doc", "missing")
+
+def test_download_file_parallel(po, attachment):
+    it = po.download_file(*attachment, chunk_size=7000, workers=3, range_size=20000)
+    assert next(it) == len(_data)
+    assert b"".join(it) == _data
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_download_to_file(po, attachment, tmpdir, workers):
+    path = str(tmpdir.join("out.bin"))
+    progress = []
+    po.download_to_file(*attachment, filename=path, workers=workers, range_size=50000,
+                        callback=lambda n, total: progress.append(n))
+    with open(path, "rb") as f:
+        assert f.read() == _data
+    assert progress[-1] == len(_data)
+    assert not os.path.exists(path + ".progress")
+
+def test_download_to_file_resumes(po, attachment, tmpdir):
+    import json
+    path = str(tmpdir.join("out.bin"))
+    from pynedm.fileutils import RangeDownloader
+    d = RangeDownloader(po.acct[po._attachment_path(*attachment)], range_size=100000)
+    # Interrupted after the first range: only that one is in the file
+    with open(path, "wb") as f:
+        f.write(_data[:100000] + b"\0" * (len(_data) - 100000))
+    with open(path + ".progress", "w") as f:
+        json.dump(dict(size=len(_data), etag=d.etag, range_size=100000, done=[0]), f)
+    fetched = []
+    fetch = d._fetch_to_file
+    d._fetch_to_file = lambda fn, a, b: fetched.append(a) or fetch(fn, a, b)
+    d.to_file(path)
+    assert fetched == [100000, 200000]
+    with open(path, "rb") as f:
+        assert f.read() == _data
+
+def test_download_to_file_discards_stale_state(po, attachment, tmpdir):
+    import json
+    path = str(tmpdir.join("out.bin"))
+    # Longer file of an earlier version with a progress file that doesn't match
+    with open(path, "wb") as f:
+        f.write(b"x" * (len(_data) + 5000))
+    with open(path + ".progress", "w") as f:
+        json.dump(dict(size=len(_data) + 5000, etag="old", range_size=100000,
+                       done=[0, 100000, 200000, 300000]), f)
+    po.download_to_file(*attachment, filename=path, range_size=100000)
+    with open(path, "rb") as f:
+        assert f.read() == _data
@@ -0,0 +1,127 @@
+import json
+import logging
+
+import pytest
+
+pytest.importorskip("autobahn")
+
+from pynedm.log import BroadcastLogFactory, BroadcastLogHandler, BroadcastLogProtocol, _Subscription
+
+def _rec(i, level=logging.INFO, name="pynedm.test"):
+    return (level, name, dict(level=logging.getLevelName(level), msg="msg {}".format(i), name=name))
+
+def _client(factory, batch=False):
+    c = BroadcastLogProtocol()
+    c.factory = factory
+    c.frames = []
+    c.sendPreparedMessage = lambda m: c.frames.append(json.loads(m.payload.decode("utf-8")))
+    c.onOpen()
+    c.subscription = _Subscription(batch=batch)
+    c._replay()
+    return c
+
+@pytest.fixture
+def factory():
+    return BroadcastLogFactory("ws://127.0.0.1", replay_size=10)
+
+def test_broadcast_one_frame_per_message(factory):
+    a, b = _client(factory), _client(factory)
+    prepared = []
+    orig = factory.prepareRecord
+    factory.prepareRecord = lambda msg: prepared.append(msg) or orig(msg)
+    factory.broadcast([_rec(i) for i in range(3)])
+    assert a.frames == b.frames == [_rec(i)[2] for i in range(3)]
+    # Serialized once for both clients
+    assert len(prepared) == 3
+
+def test_broadcast_batch_one_frame_per_client(factory):
+    a, b = _client(factory, batch=True), _client(factory, batch=True)
+    c = _client(factory)
+    prepared = []
+    orig = factory.prepareRecords
+    factory.prepareRecords = lambda msgs: prepared.append(msgs) or orig(msgs)
+    factory.broadcast([_rec(i) for i in range(3)])
+    assert a.frames == b.frames == [[_rec(i)[2] for i in range(3)]]
+    assert c.frames == [_rec(i)[2] for i in range(3)]
+    # Serialized once for both clients
+    assert len(prepared) == 1
+
+def test_lagging_client_drops_oldest(factory):
+    c = _client(factory, batch=True)
+    c.max_queued = 5
+    c.pauseProducing()
+    for i in range(4):
+        factory.broadcast([_rec(2*i), _rec(2*i + 1)])
+    assert c.frames == [] and c.queued_msgs == 4
+    c.resumeProducing()
+    assert c.frames[0][0]["msg"] == "4 log messages dropped"
+    assert [m["msg"] for f in c.frames[1:] for m in f] == ["msg {}".format(i) for i in range(4, 8)]
+
+def test_history_replayed(factory):
+    factory.broadcast([_rec(i) for i in range(12)])
+    c = _client(factory)
+    assert [m["msg"] for m in c.frames] == ["msg {}".format(i) for i in range(2, 12)]
+
+def test_history_replayed_in_one_frame(factory):
+    factory.broadcast([_rec(i) for i in range(12)])
+    c = _client(factory, batch=True)
+    assert [[m["msg"] for m in f] for f in c.frames] == [["msg {}".format(i) for i in range(2, 12)]]
+
+def _subscribe(c, **sub):
+    c.onMessage(json.dumps(dict(subscribe=sub)).encode("utf-8"), False)
+
+def test_subscription_filters(factory):
+    c = _client(factory)
+    _subscribe(c, level="DEBUG", name="pynedm.hv", regex="volt", batch=True)
+    assert factory.min_level == logging.DEBUG
+    factory.broadcast([_rec("volt", logging.DEBUG, "pynedm.hv.supply"),
+                       _rec("volt", logging.DEBUG, "pynedm.temp"),
+                       _rec("current", logging.INFO, "pynedm.hv")])
+    assert [[m["name"] for m in f] for f in c.frames] == [["pynedm.hv.supply"]]
+    factory.unregister(c)
+    assert factory.min_level == logging.INFO
+
+def test_subscription_max_rate(factory):
+    c = _client(factory)
+    _subscribe(c, max_rate=3)
+    factory.broadcast([_rec(i) for i in range(10)])
+    assert c.frames[0]["msg"] == "7 log messages dropped"
+    assert [m["msg"] for m in c.frames[1:]] == ["msg 0", "msg 1", "msg 2"]
+
+def test_subscription_replays_history(factory):
+    factory.broadcast([_rec(1, logging.WARNING), _rec(2), _rec(3, logging.ERROR)])
+    c = BroadcastLogProtocol()
+    c.factory = factory
+    c.frames = []
+    c.sendPreparedMessage = lambda m: c.frames.append(json.loads(m.payload.decode("utf-8")))
+    c.onOpen()
+    # Held back until the history is sent
+    factory.broadcast([_rec(4, logging.ERROR)])
+    assert c.frames == []
+    _subscribe(c, level="WARNING", batch=True)
+    # The held record was sent before subscribing with batch
+    assert [m["msg"] for m in c.frames[0]] == ["msg 1", "msg 3"]
+    assert c.frames[1]["msg"] == "msg 4"
+
+def test_invalid_subscription(factory):
+    c = _client(factory)
+    _subscribe(c, level="LOUD")
+    assert c.frames[0]["level"] == "ERROR"
+    assert "Invalid subscription" in c.frames[0]["msg"]
+
+def test_handler_batches_and_counts_dropped():
+    from twisted.internet import reactor
+    from twisted.internet.threads import blockingCallFromThread
+    handler = BroadcastLogHandler(interval=3600, max_pending=10, replay_size=100)
+    logger = logging.getLogger("pynedm.test_log")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    try:
+        for i in range(15): logger.info("record %d", i)
+        blockingCallFromThread(reactor, handler._flush)
+        msgs = [rec[2]["msg"] for rec in handler.factory.recent]
+        assert msgs == ["5 log messages dropped"] + ["record {}".format(i) for i in range(5, 15)]
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
@@ -0,0 +1,94 @@
+import time
+
+from pynedm.metrics import Registry, serve
+
+def test_counter_and_gauge():
+    reg = Registry()
+    c = reg.counter("c_total", "Count")
+    c.inc(result="ok")
+    c.inc(2, result="ok")
+    c.inc(result="error")
+    assert c.value(result="ok") == 3
+    assert reg.counter("c_total") is c
+    g = reg.gauge("g", "Gauge")
+    g.set(5)
+    g.dec(2)
+    g.set_function(lambda: 7, name="f")
+    assert reg.snapshot()["g"] == { "" : 3, '{name="f"}' : 7 }
+    text = reg.render()
+    assert "# TYPE c_total counter" in text
+    assert 'c_total{result="ok"} 3.0' in text
+
+def test_histogram():
+    reg = Registry()
+    h = reg.histogram("h_seconds", "Latency", buckets=(0.1, 1.))
+    for v in (0.05, 0.5, 0.5, 5.):
+        h.observe(v, op="x")
+    lines = reg.render().splitlines()
+    assert 'h_seconds_bucket{op="x",le="0.1"} 1' in lines
+    assert 'h_seconds_bucket{op="x",le="1.0"} 3' in lines
+    assert 'h_seconds_bucket{op="x",le="+Inf"} 4' in lines
+    assert 'h_seconds_count{op="x"} 4' in lines
+    s = reg.snapshot()["h_seconds"]['{op="x"}']
+    assert s["count"] == 4 and s["p50"] == 1. and s["mean"] == 6.05 / 4
+    with h.time(op="y"): pass
+    assert reg.snapshot()["h_seconds"]['{op="y"}']["count"] == 1
+
+def test_label_escaping():
+    reg = Registry()
+    reg.counter("e_total").inc(name='a"b\\c\nd')
+    assert 'e_total{name="a\\"b\\\\c\\nd"} 1.0' in reg.render()
+
+def test_serve():
+    import requests
+    reg = Registry()
+    reg.counter("served_total").inc()
+    server = serve(0, "127.0.0.1", reg=reg)
+    try:
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+        r = requests.get(url + "/metrics")
+        assert r.status_code == 200 and "served_total 1.0" in r.text
+        assert requests.get(url + "/other").status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_publish(couch, po):
+    from conftest import DB
+    from pynedm.metrics import publish
+    reg = Registry()
+    reg.counter("published_total").inc()
+    task = publish(po, interval=0.05, reg=reg)
+    try:
+        deadline = time.time() + 5
+        docs = []
+        while not docs and time.time() < deadline:
+            time.sleep(0.05)
+            with couch.db(DB).cond:
+                docs = [ d for d in couch.db(DB).docs.values() if d.get("type") == "metrics" ]
+    finally:
+        task.cancel()
+    assert docs and docs[0]["metrics"]["published_total"] == { "" : 1 }
+
+def test_publish_does_not_block_scheduler():
+    import threading
+    from pynedm.metrics import publish
+    from pynedm.scheduler import get_scheduler
+    release = threading.Event()
+    writes, ticks = [], []
+
+    class _Writer(object):
+        def write_document_to_db(self, adoc, db=None):
+            writes.append(adoc)
+            release.wait(5)
+
+    task = publish(_Writer(), interval=0.02, reg=Registry())
+    ticker = get_scheduler().call_every(0.02, lambda: ticks.append(1))
+    try:
+        time.sleep(0.3)
+        # Other tasks keep running, one write at a time
+        assert len(ticks) >= 5 and len(writes) == 1
+    finally:
+        task.cancel()
+        ticker.cancel()
+        release.set()
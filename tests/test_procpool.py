@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+
+import pytest
+
+from pynedm.exception import PynEDMException
+from pynedm.procpool import ProcessPool, _context
+
+# Run in the worker processes, defined at module level to be pickled by name
+
+def _pid(x):
+    return os.getpid(), x
+
+def _double(a):
+    return a * 2
+
+def _fail():
+    raise ValueError("failed in worker")
+
+def _sleep(t):
+    time.sleep(t)
+
+@pytest.fixture
+def pool():
+    p = ProcessPool(processes=2, maxtasksperchild=2, min_size=1024)
+    yield p
+    p.close()
+
+def test_call_and_recycle(pool):
+    pids = [ pool.call(_pid, (i,)) for i in range(4) ]
+    assert [ x for _, x in pids ] == list(range(4))
+    assert all(pid != os.getpid() for pid, _ in pids)
+    # Replaced after maxtasksperchild tasks
+    assert len(set(pid for pid, _ in pids)) == 2
+    assert pool.stats()["ok"] == 4 and pool.stats()["recycled"] == 2
+
+def test_exception_and_timeout(pool):
+    with pytest.raises(PynEDMException) as e:
+        pool.call(_fail)
+    assert "ValueError: failed in worker" in str(e.value)
+    with pytest.raises(PynEDMException):
+        pool.call(_sleep, (10,), timeout=0.2)
+    assert pool.call(_pid, (1,))[1] == 1
+    st = pool.stats()
+    assert st["exception"] == 1 and st["timeout"] == 1
+
+def test_shared_arrays(pool):
+    np = pytest.importorskip("numpy")
+    a = np.arange(10000.)
+    r = pool.call(_double, (a,))
+    assert isinstance(r, np.memmap)
+    assert np.array_equal(r, a * 2)
+    # Files are removed once mapped
+    assert os.listdir(pool._dir) == []
+
+def test_no_fork_from_threads():
+    ctx = _context()
+    if hasattr(ctx, "get_start_method"):
+        assert ctx.get_start_method() in ("forkserver", "spawn")
+    # Workers start while other threads hold locks
+    lock = threading.Lock()
+    lock.acquire()
+    th = threading.Thread(target=lock.acquire)
+    th.start()
+    p = ProcessPool(processes=1)
+    try:
+        assert p.call(_pid, (1,), timeout=30)[1] == 1
+    finally:
+        p.close()
+        lock.release()
+        th.join()
+
+def test_process_command(couch, po):
+    from conftest import DB
+    from pynedm.utils import listen
+    o = listen({ "double" : (_double, None, { "mode" : "process", "timeout" : 30. }) },
+               DB, uri=couch.uri, processes=1)
+    try:
+        assert po.send_command("double", 3) == 6
+        assert o.process_pool.stats()["ok"] == 1
+    finally:
+        o.stop_listening()
+        o.wait()
+        o.close()
+
+_script = """
+import sys
+from pynedm.procpool import ProcessPool, _context
+
+def square(x):
+    return x * x
+
+{guard}
+    with open(sys.argv[1], "a") as f: f.write("run\\n")
+    p = ProcessPool(processes=1)
+    try:
+        print(p.call(square, (7,), timeout=60))
+        ctx = _context()
+        print(ctx.get_start_method() if hasattr(ctx, "get_start_method") else "fork")
+    finally:
+        p.close()
+"""
+
+@pytest.mark.parametrize("guard", ['if __name__ == "__main__":', "if True:"])
+def test_main_script(tmpdir, guard):
+    import subprocess
+    import sys
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = tmpdir.join("script.py")
+    script.write(_script.format(guard=guard))
+    runs = tmpdir.join("runs")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([root] + [p for p in [env.get("PYTHONPATH")] if p])
+    out = subprocess.check_output([sys.executable, str(script), str(runs)], env=env,
+                                  cwd=str(tmpdir)).decode().split()
+    assert out[0] == "49"
+    # Workers don't run the script again
+    assert runs.read().split() == ["run"]
+    if guard.startswith("if __name__"):
+        assert out[1] in ("forkserver", "spawn", "fork")
+    else:
+        assert out[1] == "fork"
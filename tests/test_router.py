@@ -0,0 +1,48 @@
+import threading
+
+from pynedm import router
+
+from conftest import DB
+
+def test_routers_keyed_by_account(po):
+    r = router.get_router(po.acct[DB], "alice")
+    assert router.get_router(po.acct[DB], "alice") is r
+    assert router.get_router(po.acct[DB], "bob") is not r
+    assert router.get_router(po.acct[DB]) is not r
+    router._routers.clear()
+
+def test_router_dropped_with_last_subscription(po):
+    db = po.acct[DB]
+    r = router.get_router(db)
+    a = r.subscribe(["x"], lambda line: None)
+    b = r.subscribe(["x", "y"], lambda line: None)
+    token = r._token
+    a.close()
+    assert router.get_router(db) is r and not token.cancelled()
+    b.close()
+    assert token.cancelled()
+    assert not router._routers
+    # A closed router can subscribe again
+    c = r.subscribe(["z"], lambda line: None)
+    assert router.get_router(db) is r
+    c.close()
+
+def test_shared_feed_routes_commands(couch, po):
+    from pynedm.utils import listen
+    l1 = listen({ "one" : lambda: 1 }, DB, uri=couch.uri, feed_mode="shared")
+    l2 = listen({ "two" : lambda: 2 }, DB, uri=couch.uri, feed_mode="shared")
+    try:
+        results = {}
+        def send(cmd):
+            results[cmd] = po.send_command(cmd)
+        threads = [threading.Thread(target=send, args=(c,)) for c in ("one", "two")]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert results == { "one" : 1, "two" : 2 }
+        # Same (anonymous) account: one feed
+        assert len(router._routers) == 1
+    finally:
+        for l in (l1, l2):
+            l.stop_listening()
+            l.wait()
+    assert not router._routers
@@ -0,0 +1,90 @@
+import json
+import threading
+import time
+
+from pynedm.executor import CommandExecutor
+from pynedm.scheduler import Scheduler
+
+from conftest import DB
+
+def test_scheduler_call_later_and_every():
+    s = Scheduler()
+    calls = []
+    s.call_later(0.05, calls.append, "once")
+    task = s.call_every(0.02, calls.append, "every")
+    time.sleep(0.2)
+    task.cancel()
+    n = calls.count("every")
+    time.sleep(0.1)
+    assert calls.count("once") == 1
+    assert n >= 3 and calls.count("every") == n
+    assert s.pending() == 0
+
+def test_scheduler_wakes_for_earlier_task():
+    s = Scheduler()
+    done = threading.Event()
+    s.call_later(60, done.set)
+    start = time.time()
+    s.call_later(0.05, done.set)
+    assert done.wait(2)
+    assert time.time() - start < 1
+
+class _BlockingDesign(object):
+    def __init__(self):
+        self.release = threading.Event()
+        self.posts = []
+
+    def design(self, name):
+        return self
+
+    def post(self, path, data, timeout):
+        self.posts.append(json.loads(data))
+        self.release.wait(5)
+
+def test_heartbeat_post_does_not_block_scheduler(po):
+    po.executor = CommandExecutor()
+    db = _BlockingDesign()
+    last = [time.time() - 1, 0]
+    start = time.time()
+    po._heartbeat(db, last)
+    # Skipped while the previous post is running
+    po._heartbeat(db, last)
+    assert time.time() - start < 1
+    db.release.set()
+    po._heartbeat_post.result(5)
+    assert len(db.posts) == 1
+    assert db.posts[0]["load"]["queued"] == 0
+    po.executor.shutdown()
+
+def test_heartbeats_share_worker_threads(po):
+    po.executor = CommandExecutor()
+    db = _BlockingDesign()
+    db.release.set()
+    before = threading.active_count()
+    last = [time.time() - 1, 0]
+    for i in range(20):
+        po._heartbeat(db, last)
+        po._heartbeat_post.result(5)
+    assert len(db.posts) == 20
+    # Posted by the shared pool, not a new thread per heartbeat
+    assert threading.active_count() <= before + 1
+    po.executor.shutdown()
+
+def test_heartbeat_documents_posted(couch):
+    import pynedm
+    po = pynedm.ProcessObject(uri=couch.uri, adb=DB, heartbeat_interval=0.05)
+    with couch.db(DB).cond:
+        couch.db(DB).save({ "_id" : "commands", "type" : "export_commands" })
+    po.run({ "noop" : lambda: None }, "commands")
+    try:
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            with couch.db(DB).cond:
+                docs = [d for d in couch.db(DB).docs.values() if d.get("type") == "heartbeat"]
+            if docs: break
+            time.sleep(0.02)
+        assert docs and "commands_per_s" in docs[0]["load"]
+    finally:
+        po.stop_listening()
+        po.wait()
+        po.close()
@@ -0,0 +1,158 @@
+import threading
+import time
+
+import pytest
+
+import pynedm
+from pynedm.spool import WriteSpool
+from pynedm.writer import BufferedWriter
+
+from conftest import DB
+
+def _actual(spool):
+    return spool._conn.execute(
+      "SELECT COUNT(*), COALESCE(SUM(LENGTH(doc)), 0) FROM docs").fetchone()
+
+@pytest.fixture
+def spool(tmpdir):
+    s = WriteSpool(str(tmpdir.join("spool.db")), retry_interval=3600)
+    yield s
+    s.close()
+
+def test_spool_replays_in_bulk(couch, po, spool):
+    spool.extend(DB, [{ "_id" : "d{}".format(i), "type" : "data", "timestamp" : "t" }
+                      for i in range(5)])
+    assert spool.stats()["pending"] == 5
+    assert spool.replay(lambda name: po.acct[name])
+    s = spool.stats()
+    assert (s["pending"], s["bytes"], s["replayed"], s["failed"]) == (0, 0, 5, 0)
+    assert sorted(couch.db(DB).docs) == ["d{}".format(i) for i in range(5)]
+
+def test_spool_conflict_means_written(couch, po, spool):
+    with couch.db(DB).cond:
+        couch.db(DB).save({ "_id" : "written" })
+    spool.append(DB, { "_id" : "written", "type" : "data" })
+    assert spool.replay(lambda name: po.acct[name])
+    assert spool.stats()["replayed"] == 1 and spool.stats()["failed"] == 0
+
+def test_spool_counters_with_drops_during_replay(couch, po, tmpdir):
+    spool = WriteSpool(str(tmpdir.join("s.db")), max_bytes=2000, batch_size=5,
+                       retry_interval=3600)
+    doc = { "type" : "data", "value" : "x" * 100 }
+    spool.extend(DB, [dict(doc, _id="a{}".format(i)) for i in range(10)])
+
+    class _DB(object):
+        # New documents overflowing the spool while a batch is replayed
+        def post(self, *args, **kw):
+            spool.extend(DB, [dict(doc, _id="b{}".format(i)) for i in range(10)])
+            return po.acct[DB].post(*args, **kw)
+
+    spool.replay(lambda name: _DB() if not couch.db(DB).docs else po.acct[name])
+    s = spool.stats()
+    assert s["dropped"] > 0
+    assert (s["pending"], s["bytes"]) == _actual(spool)
+    spool.close()
+
+def test_direct_writes_spooled_on_server_errors(couch, po, tmpdir):
+    po.enable_spool(str(tmpdir.join("spool.db")), retry_interval=3600)
+    couch.fail_next(503, method="POST", path="insert_with_timestamp")
+    assert po.write_document_to_db({ "type" : "data" }) == { "ok" : True, "spooled" : True }
+    couch.fail_next(400, method="POST", path="insert_with_timestamp")
+    r = po.write_document_to_db({ "type" : "data" })
+    assert "error" in r and po.spool.stats()["spooled"] == 1
+    r = po.write_document_to_db({ "type" : "data", "value" : 1 })
+    # Written with the id it would have been spooled with
+    assert r["id"] in couch.db(DB).docs
+    po.spool.replay(lambda name: po.acct[name])
+    assert len(couch.db(DB).docs) == 2
+
+def test_unreachable_server_spooled(couch, tmpdir):
+    po = pynedm.ProcessObject(uri="http://127.0.0.1:1", adb=DB)
+    po.enable_spool(str(tmpdir.join("spool.db")), retry_interval=3600)
+    po.enable_batch_writes(max_age=0.01)
+    futs = [po._get_writer(DB).write({ "type" : "data", "value" : i }) for i in range(3)]
+    assert all(f.result(10) == { "ok" : True, "spooled" : True } for f in futs)
+    po.flush()
+    live = pynedm.ProcessObject(uri=couch.uri, adb=DB)
+    assert po.spool.replay(lambda name: live.acct[name])
+    assert sorted(d["value"] for d in couch.db(DB).docs.values()) == [0, 1, 2]
+    po.close()
+    live.close()
+
+def test_writer_overflow_to_spool():
+    spooled = []
+    gate = threading.Event()
+
+    class _DB(object):
+        def post(self, *args, **kw):
+            gate.wait(5)
+            raise IOError("not spooled")
+
+    w = BufferedWriter(_DB(), max_docs=1, max_age=0., max_queued=1, overflow="spool",
+                       spool=spooled.extend)
+    futs = [w.write({ "n" : 0 })]
+    deadline = time.time() + 5
+    while w.stats()["queued"] and time.time() < deadline: time.sleep(0.01)
+    futs += [w.write({ "n" : i }) for i in range(1, 5)]
+    # One in the request, one queued, the rest spooled with an id
+    assert [f.result(1) for f in futs[2:]] == [{ "ok" : True, "spooled" : True }] * 3
+    assert [d["n"] for d in spooled] == [2, 3, 4] and all("_id" in d for d in spooled)
+    gate.set()
+    # Errors other than unreachable servers are not spooled
+    with pytest.raises(Exception):
+        futs[0].result(5)
+    w.close()
+
+def test_arrays_spooled_as_attachments(couch, po, tmpdir):
+    np = pytest.importorskip("numpy")
+    po.enable_spool(str(tmpdir.join("spool.db")), retry_interval=3600)
+    wave = np.arange(1000, dtype=np.float64)
+    couch.fail_next(503, method="POST", path="insert_with_timestamp")
+    r = po.write_document_to_db({ "type" : "data", "value" : { "wave" : wave } },
+                                attach_arrays=True)
+    assert r == { "ok" : True, "spooled" : True }
+    row = po.spool._conn.execute("SELECT doc FROM docs").fetchone()[0]
+    # Spooled as written, the array is not inline
+    assert b"_ndarray" in bytes(row)
+    assert po.spool.stats()["bytes"] > wave.nbytes
+    assert po.spool.replay(lambda name: po.acct[name], po._upload_spooled)
+    doc, = couch.db(DB).docs.values()
+    assert (doc["_id"], "value.wave") in couch.db(DB).attachments
+    assert np.array_equal(po.read_arrays(doc)["value"]["wave"], wave)
+    assert po.spool.stats()["bytes"] == 0
+
+def test_spool_kept_until_attachments_uploaded(couch, po, spool):
+    spool.append(DB, { "_id" : "a", "type" : "data" }, [("value.x", b"abc")])
+    assert not spool.replay(lambda name: po.acct[name], lambda db, docid, atts: False)
+    assert spool.stats()["pending"] == 1
+    uploaded = []
+    assert spool.replay(lambda name: po.acct[name],
+                        lambda db, docid, atts: uploaded.append((docid, atts)) or True)
+    # Written again (a conflict), then the attachments are uploaded
+    assert uploaded == [("a", [("value.x", b"abc")])]
+    assert spool.stats()["replayed"] == 1
+
+def test_close_waits_for_replay(couch, po, tmpdir):
+    path = str(tmpdir.join("spool.db"))
+    spool = WriteSpool(path, retry_interval=3600)
+    spool.append(DB, { "_id" : "a", "type" : "data" })
+    started, release = threading.Event(), threading.Event()
+
+    def get_db(name):
+        started.set()
+        release.wait(5)
+        return po.acct[name]
+
+    spool._check(get_db)
+    assert started.wait(5)
+    closer = threading.Thread(target=spool.close)
+    closer.start()
+    closer.join(0.2)
+    # Not closed while the replay uses the database
+    assert closer.is_alive()
+    release.set()
+    closer.join(5)
+    assert not closer.is_alive() and not spool._thread.is_alive()
+    spool = WriteSpool(path, retry_interval=3600)
+    assert spool.stats()["pending"] == 0 and "a" in couch.db(DB).docs
+    spool.close()
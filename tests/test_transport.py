@@ -0,0 +1,43 @@
+import pytest
+
+from conftest import DB
+
+def _get(o):
+    return o.acct._session.get("/".join([o.acct.uri, DB]))
+
+def test_default_does_not_retry_or_time_out(couch, po):
+    assert po.transport.retries == 0
+    assert po.transport.read_timeout is None
+    couch.fail_next(503, method="GET", path=DB)
+    assert _get(po).status_code == 503
+
+def test_retries_with_transport(couch):
+    import pynedm
+    from pynedm.transport import Transport
+    o = pynedm.ProcessObject(uri=couch.uri, adb=DB,
+                             transport=Transport(retries=2, backoff_factor=0))
+    try:
+        couch.fail_next(503, count=2, method="GET", path=DB)
+        assert _get(o).status_code == 200
+    finally:
+        o.close()
+
+class _Handle(object):
+    def __init__(self):
+        self.opts = {}
+
+    def setopt(self, opt, value):
+        self.opts[opt] = value
+
+def test_stall_timeout_is_separate_from_read_timeout():
+    pycurl = pytest.importorskip("pycurl")
+    from pynedm.transport import Transport
+    c = _Handle()
+    Transport(read_timeout=1.).setup_curl(c)
+    assert pycurl.LOW_SPEED_TIME not in c.opts
+    c = _Handle()
+    Transport(stall_timeout=30.).setup_curl(c)
+    assert c.opts[pycurl.LOW_SPEED_TIME] == 30
+    c = _Handle()
+    Transport(connect_timeout=None).setup_curl(c)
+    assert pycurl.CONNECTTIMEOUT_MS not in c.opts
@@ -0,0 +1,134 @@
+import io
+import threading
+
+import pytest
+
+pytest.importorskip("pycurl")
+
+from conftest import DB
+
+_data = bytes(bytearray(i % 253 for i in range(200000)))
+
+def _stored(couch, name, docid="doc"):
+    with couch.db(DB).cond:
+        return couch.db(DB).attachments.get((docid, name), (None, 0))[0]
+
+def test_upload_files(couch, po, tmpdir):
+    path = tmpdir.join("run1.dat")
+    path.write_binary(_data)
+    progress = []
+    results = po.upload_files([str(path), (io.BytesIO(b"abc"), "small.txt")], "doc",
+                              callback=lambda n, total: progress.append((n, total)))
+    assert all(r.get("ok") for r in results)
+    assert _stored(couch, "run1.dat") == _data
+    assert _stored(couch, "small.txt") == b"abc"
+    assert progress[-1] == (len(_data) + 3, len(_data) + 3)
+
+def test_upload_retries_server_errors(couch, po):
+    couch.fail_next(503, count=2, method="PUT")
+    r = po.upload_file(io.BytesIO(_data), "doc", attachment_name="retried.bin")
+    assert r.get("ok")
+    # The whole body is sent again
+    assert _stored(couch, "retried.bin") == _data
+
+def test_upload_gives_up_after_retries(couch, po):
+    couch.fail_next(500, count=3, method="PUT")
+    r = po.upload_files([(io.BytesIO(b"x"), "lost.bin")], "doc", retries=2)[0]
+    assert r["error"] and "HTTP 500" in r["content"]
+    assert _stored(couch, "lost.bin") is None
+
+def test_upload_client_errors_are_final(couch, po):
+    couch.fail_next(409, count=1, method="PUT")
+    r = po.upload_file(io.BytesIO(b"x"), "doc", attachment_name="conflict.bin")
+    assert r["error"] and "HTTP 409" in r["content"]
+    # Not retried
+    assert _stored(couch, "conflict.bin") is None
+
+def test_upload_settings_are_per_call(couch, po):
+    engine = po._get_upload_engine()
+    results = []
+
+    def _up(i, n):
+        results.append(po.upload_files([(io.BytesIO(_data), "f{}".format(i))], "doc",
+                                       max_concurrent=n, retries=n))
+    threads = [threading.Thread(target=_up, args=(i, i + 1)) for i in range(4)]
+    for th in threads: th.start()
+    for th in threads: th.join()
+    assert all(r[0].get("ok") for r in results)
+    assert (engine.max_concurrent, engine.retries) == (4, 3)
+    for i in range(4):
+        assert _stored(couch, "f{}".format(i)) == _data
+
+def test_upload_engine_reads_files_by_name(couch, tmpdir):
+    from pynedm.upload import UploadEngine
+    path = tmpdir.join("big.dat")
+    data = _data * 20
+    path.write_binary(data)
+    url = "{}/_attachments/{}/doc/big.dat".format(couch.uri, DB)
+    progress = []
+    engine = UploadEngine(buffer_size=64*1024, progress_interval=3600)
+    r = engine.upload([(str(path), url)], callback=lambda n, total: progress.append(n))[0]
+    assert r.get("ok")
+    assert _stored(couch, "big.dat") == data
+    # Rate limited: the first report and the final one
+    assert len(progress) <= 2
+    assert progress[-1] == len(data)
+
+def test_files_by_name_are_not_copied_into_bytes(couch, tmpdir, monkeypatch):
+    from pynedm import upload
+    if not hasattr(memoryview, "cast"):
+        pytest.skip("python 2 reads files into bytes")
+    returned = []
+    read = upload._MappedFile.read
+    def _read(self, numbytes=-1):
+        data = read(self, numbytes)
+        returned.append(type(data))
+        return data
+    monkeypatch.setattr(upload._MappedFile, "read", _read)
+    path = tmpdir.join("mapped.dat")
+    data = _data * 25
+    path.write_binary(data)
+    tmpdir.join("empty.dat").write_binary(b"")
+    url = "{}/_attachments/{}/doc/".format(couch.uri, DB)
+    engine = upload.UploadEngine(buffer_size=1024*1024)
+    res = engine.upload([(str(path), url + "mapped.dat"),
+                         (str(tmpdir.join("empty.dat")), url + "empty.dat")])
+    assert all(r.get("ok") for r in res)
+    assert _stored(couch, "mapped.dat") == data
+    assert _stored(couch, "empty.dat") == b""
+    # Every block libcurl read was a view of the mapping
+    assert returned and set(returned) == set([memoryview])
+
+def test_uploads_from_threads_run_concurrently(couch):
+    from pynedm.upload import UploadEngine
+    engine = UploadEngine(progress_interval=0)
+    url = "{}/_attachments/{}/doc/{}".format
+    started = [threading.Event(), threading.Event()]
+    overlapped = []
+    results = [None, None]
+
+    def _up(i):
+        def callback(n, total):
+            started[i].set()
+            # Waits inside the transfer until the other upload is running
+            overlapped.append(started[1 - i].wait(5))
+        results[i] = engine.upload([(io.BytesIO(_data), url(couch.uri, DB, "t{}".format(i)))],
+                                   callback=callback)[0]
+    threads = [threading.Thread(target=_up, args=(i,)) for i in range(2)]
+    for th in threads: th.start()
+    for th in threads: th.join(20)
+    assert all(r.get("ok") for r in results)
+    assert overlapped and all(overlapped)
+    for i in range(2):
+        assert _stored(couch, "t{}".format(i)) == _data
+    engine.close()
+
+def test_cookies_taken_from_session():
+    import requests
+    from pynedm.upload import _cookie_header
+    s = requests.Session()
+    s.cookies.set("AuthSession", "abc", domain="db.example.org", path="/")
+    s.cookies.set("other", "x", domain="other.example.org", path="/")
+    url = "http://db.example.org/_attachments/db/doc/f.bin"
+    assert _cookie_header(s, url) == "AuthSession=abc"
+    assert _cookie_header(requests.Session(), url) == ""
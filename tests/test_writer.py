@@ -0,0 +1,109 @@
+import threading
+
+import pytest
+
+from pynedm.exception import PynEDMException
+from pynedm.writer import BufferedWriter
+
+from conftest import DB
+
+class _Response(object):
+    def __init__(self, content, status_code=201):
+        self.content = content
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise PynEDMException("HTTP {}".format(self.status_code))
+
+class _BulkDB(object):
+    """
+    Database resource accepting _bulk_docs, optionally blocking or failing
+    """
+    def __init__(self):
+        from pynedm import codec
+        self.codec = codec
+        self.requests = []
+        self.fail = False
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def post(self, path, data=None, headers=None):
+        import gzip, io
+        self.gate.wait()
+        if self.fail: raise IOError("unreachable")
+        if (headers or {}).get("Content-Encoding") == "gzip":
+            data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+        docs = self.codec.loads(data)["docs"]
+        self.requests.append(docs)
+        return _Response(self.codec.dumpb([dict(id=str(i), rev="1-a") for i in range(len(docs))]))
+
+def test_batched_writes_are_sent_in_bulk(po, couch):
+    po.enable_batch_writes(max_docs=10, max_age=10.)
+    for i in range(25):
+        assert po.write_document_to_db({ "type" : "data", "value" : { "x" : i } }) == \
+               { "ok" : True, "queued" : True }
+    po.flush()
+    docs = couch.db(DB).docs.values()
+    assert sorted(d["value"]["x"] for d in docs) == list(range(25))
+    assert all("timestamp" in d for d in docs)
+
+def test_writer_sends_after_max_age():
+    db = _BulkDB()
+    w = BufferedWriter(db, max_docs=100, max_age=0.05)
+    fut = w.write({ "a" : 1 })
+    assert fut.result(5)["ok"]
+    assert len(db.requests) == 1
+    w.close()
+
+def test_writer_splits_batches_at_max_docs():
+    db = _BulkDB()
+    w = BufferedWriter(db, max_docs=3, max_age=10.)
+    futs = [w.write({ "i" : i }) for i in range(7)]
+    w.flush()
+    assert [len(r) for r in db.requests] == [3, 3, 1]
+    assert all(f.done() for f in futs)
+    assert w.stats()["written"] == 7
+    w.close()
+
+def test_writer_drop_oldest_fails_dropped_document():
+    db = _BulkDB()
+    db.gate.clear()
+    w = BufferedWriter(db, max_docs=1, max_age=0., max_queued=1, overflow="drop_oldest")
+    first = w.write({ "i" : 0 })
+    # Wait until the first document is being sent (blocked on the gate)
+    while w.stats()["queued"]: pass
+    second = w.write({ "i" : 1 })
+    third = w.write({ "i" : 2 })
+    with pytest.raises(PynEDMException):
+        second.result(5)
+    db.gate.set()
+    assert first.result(5)["ok"] and third.result(5)["ok"]
+    assert w.stats()["dropped"] == 1
+    w.close()
+
+def test_writer_fails_documents_when_server_unreachable():
+    db = _BulkDB()
+    db.fail = True
+    errors = []
+    w = BufferedWriter(db, max_age=0., on_error=lambda d, e: errors.append(d))
+    fut = w.write({ "i" : 0 })
+    with pytest.raises(PynEDMException):
+        fut.result(5)
+    assert errors and errors[0]["i"] == 0
+    w.close()
+
+def test_batch_errors_raised_for_ignore_errors_false(po, couch):
+    po.enable_batch_writes(max_age=10.)
+    po.write_document_to_db({ "_id" : "x", "type" : "data" })
+    po.flush()
+    # Conflict: the document exists
+    po.write_document_to_db({ "_id" : "x", "type" : "data" }, ignoreErrors=False)
+    with pytest.raises(PynEDMException):
+        po.flush()
+
+def test_closed_writer_rejects_writes():
+    w = BufferedWriter(_BulkDB())
+    w.close()
+    with pytest.raises(PynEDMException):
+        w.write({})